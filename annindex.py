@@ -0,0 +1,474 @@
+# 作品の特徴量から、似ている作品を近似最近傍探索で探す
+
+import argparse
+import math
+import pathlib
+import numpy
+import pandas
+from scipy import sparse
+from typing import List, Optional, Tuple
+import narou
+import storage
+from bookmark import NarouBookmark
+from features import Features
+from featurestore import load_features
+
+
+# 一度に類似度を計算する行数、作品数×クラスタ数の行列を一度に作らないため
+chunk_rows = 4096
+
+# クラスタの中心に残す特徴量の数
+# キーワードの語彙は10万を越えるので、中心を密な行列で持つと大きすぎる
+centroid_terms = 256
+
+
+def normalize(matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+    """
+    行ごとにL2正規化する、内積がコサイン類似度になる
+
+    Parameters
+    ----------
+    matrix: scipy.sparse.csr_matrix
+        正規化する行列
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        各行の長さを1にした行列、0の行は0のまま
+    """
+    matrix = sparse.csr_matrix(matrix, dtype=numpy.float64)
+    norms = numpy.sqrt(numpy.asarray(matrix.multiply(matrix).sum(axis=1)))
+    norms[norms == 0] = 1.0
+    return sparse.csr_matrix(matrix.multiply(1 / norms))
+
+
+def truncate(matrix: sparse.csr_matrix, terms: int) -> sparse.csr_matrix:
+    """
+    行ごとに、絶対値の大きいterms個の値だけを残す
+
+    Parameters
+    ----------
+    matrix: scipy.sparse.csr_matrix
+        切り詰める行列
+    terms: int
+        行ごとに残す値の数
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        各行の値がterms個以下の行列
+    """
+    matrix = sparse.csr_matrix(matrix)
+    keep = numpy.ones(matrix.nnz, dtype=bool)
+    for i in range(matrix.shape[0]):
+        start, stop = matrix.indptr[i], matrix.indptr[i + 1]
+        if stop - start > terms:
+            values = numpy.abs(matrix.data[start:stop])
+            small = numpy.argpartition(-values, terms)[terms:]
+            keep[start + small] = False
+    rows = numpy.repeat(numpy.arange(matrix.shape[0]),
+                        numpy.diff(matrix.indptr))
+    return sparse.csr_matrix(
+        (matrix.data[keep], (rows[keep], matrix.indices[keep])),
+        shape=matrix.shape)
+
+
+def nearest_centroids(matrix: sparse.csr_matrix,
+                      centroids: sparse.csr_matrix,
+                      n: int = 1) -> numpy.ndarray:
+    """
+    行ごとに類似度の高いクラスタを、高い順にn個返す
+
+    Parameters
+    ----------
+    matrix: scipy.sparse.csr_matrix
+        正規化した行列
+    centroids: scipy.sparse.csr_matrix
+        正規化したクラスタの中心、クラスタ数×特徴量数
+    n: int, default 1
+        返すクラスタの数
+
+    Returns
+    -------
+    numpy.ndarray
+        行数×nのクラスタ番号
+    """
+    n = min(n, centroids.shape[0])
+    result = numpy.empty((matrix.shape[0], n), dtype=numpy.int64)
+    columns = centroids.T.tocsc()
+    for start in range(0, matrix.shape[0], chunk_rows):
+        stop = min(start + chunk_rows, matrix.shape[0])
+        # 疎行列どうしの積なので、密になるのはchunk_rows×クラスタ数だけ
+        sims = (matrix[start:stop] @ columns).toarray()
+        top = numpy.argpartition(-sims, n - 1, axis=1)[:, :n]
+        order = numpy.argsort(
+            -numpy.take_along_axis(sims, top, axis=1), axis=1, kind="stable")
+        result[start:stop] = numpy.take_along_axis(top, order, axis=1)
+    return result
+
+
+def kmeans(matrix: sparse.csr_matrix, nlist: int, iterations: int,
+           rng: numpy.random.Generator) -> sparse.csr_matrix:
+    """
+    球面k-meansで、正規化した行をnlist個のクラスタに分ける
+
+    クラスタの中心は、絶対値の大きいcentroid_terms個の特徴量だけを
+    残した疎行列で持つ。
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        正規化したクラスタの中心、nlist×特徴量数
+    """
+    n = matrix.shape[0]
+    centroids = truncate(matrix[rng.choice(n, nlist, replace=False)],
+                         centroid_terms)
+    for _ in range(iterations):
+        labels = nearest_centroids(matrix, normalize(centroids))[:, 0]
+        onehot = sparse.csr_matrix(
+            (numpy.ones(n), (labels, numpy.arange(n))), shape=(nlist, n))
+        sums = sparse.csr_matrix(onehot @ matrix)
+        # 空になったクラスタは、ランダムな行からやり直す
+        empty = numpy.flatnonzero(sums.getnnz(axis=1) == 0)
+        if len(empty) > 0:
+            restart = matrix[rng.choice(n, len(empty), replace=False)]
+            rows = numpy.arange(nlist)
+            rows[empty] = nlist + numpy.arange(len(empty))
+            sums = sparse.csr_matrix(sparse.vstack([sums, restart])[rows])
+        centroids = truncate(sums, centroid_terms)
+    return normalize(centroids)
+
+
+def top_k(positions: numpy.ndarray, scores: numpy.ndarray,
+          k: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    候補から類似度の高い順にk件を選び、足りない分は-1と-infで埋める
+    """
+    result = numpy.full(k, -1, dtype=numpy.int64)
+    result_scores = numpy.full(k, -numpy.inf)
+    m = min(k, len(scores))
+    if m > 0:
+        top = numpy.argpartition(-scores, m - 1)[:m]
+        top = top[numpy.argsort(-scores[top], kind="stable")]
+        result[:m] = positions[top]
+        result_scores[:m] = scores[top]
+    return (result, result_scores)
+
+
+def exact_search(matrix: sparse.csr_matrix, queries: sparse.csr_matrix,
+                 k: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    全件との類似度を計算して、クエリごとに類似度の高いk件を返す
+
+    近似の再現率を測るときの正解に使う。
+
+    Parameters
+    ----------
+    matrix: scipy.sparse.csr_matrix
+        正規化した検索対象の行列
+    queries: scipy.sparse.csr_matrix
+        正規化したクエリの行列
+    k: int
+        返す件数
+
+    Returns
+    -------
+    numpy.ndarray, numpy.ndarray
+        クエリ数×kの行番号と類似度
+    """
+    positions = numpy.arange(matrix.shape[0])
+    result = numpy.full((queries.shape[0], k), -1, dtype=numpy.int64)
+    result_scores = numpy.full((queries.shape[0], k), -numpy.inf)
+    for start in range(0, queries.shape[0], chunk_rows):
+        stop = min(start + chunk_rows, queries.shape[0])
+        sims = numpy.asarray((queries[start:stop] @ matrix.T).todense())
+        for i, row in enumerate(sims, start):
+            result[i], result_scores[i] = top_k(positions, row, k)
+    return (result, result_scores)
+
+
+class IVFIndex:
+    """
+    転置ファイル（IVF）による近似最近傍探索の索引
+
+    作品をk-meansでクラスタに分けておき、クエリに近いnprobe個の
+    クラスタの作品とだけ類似度を計算する。
+    行列はクラスタ順に並べ替えて持つので、クラスタの作品は連続した行になる。
+    類似度はコサイン類似度。
+    """
+
+    def __init__(self, matrix: sparse.csr_matrix, ncodes: numpy.ndarray,
+                 centroids: sparse.csr_matrix, offsets: numpy.ndarray,
+                 nprobe: int = 8, version: str = "") -> None:
+        """
+        Parameters
+        ----------
+        matrix: scipy.sparse.csr_matrix
+            正規化してクラスタ順に並べた作品の特徴量
+        ncodes: numpy.ndarray
+            各行の作品のncode
+        centroids: scipy.sparse.csr_matrix
+            正規化したクラスタの中心
+        offsets: numpy.ndarray
+            クラスタiの作品がoffsets[i]からoffsets[i+1]の行にある
+        nprobe: int, default 8
+            検索するクラスタの数、大きいほど正確で遅い
+        version: str, default ""
+            索引を作った特徴量の版、Features.version
+        """
+        self.matrix = matrix
+        self.ncodes = ncodes
+        self.centroids = centroids
+        self.offsets = offsets
+        self.nprobe = nprobe
+        self.version = version
+        self.rows = pandas.Index(ncodes)
+
+    @classmethod
+    def build(cls, features: Features,
+              nlist: Optional[int] = None, iterations: int = 10,
+              sample: int = 64, seed: int = 0) -> "IVFIndex":
+        """
+        作品の特徴量から索引を作る
+
+        Parameters
+        ----------
+        features: Features
+            作品の特徴量
+        nlist: int, default None
+            クラスタの数、Noneのときは作品数の平方根
+        iterations: int, default 10
+            k-meansの反復回数
+        sample: int, default 64
+            k-meansの学習に使う、クラスタあたりの作品数
+        seed: int, default 0
+            乱数のシード
+
+        Returns
+        -------
+        IVFIndex
+            作った索引
+        """
+        matrix = normalize(features.matrix)
+        n = matrix.shape[0]
+        if nlist is None:
+            nlist = int(math.sqrt(n))
+        nlist = max(1, min(nlist, n))
+        rng = numpy.random.default_rng(seed)
+        # クラスタの中心は一部の作品で学習し、全作品をそこに割り当てる
+        training = rng.choice(n, min(n, nlist * sample), replace=False)
+        centroids = kmeans(matrix[training], nlist, iterations, rng)
+        labels = nearest_centroids(matrix, centroids)[:, 0]
+        order = numpy.argsort(labels, kind="stable")
+        offsets = numpy.zeros(nlist + 1, dtype=numpy.int64)
+        offsets[1:] = numpy.cumsum(numpy.bincount(labels, minlength=nlist))
+        return cls(matrix[order], features.ncodes[order], centroids, offsets,
+                   version=features.version)
+
+    def save(self, filename: str) -> None:
+        """
+        索引をnpzファイルに書き出す
+        """
+        numpy.savez(filename, data=self.matrix.data,
+                    indices=self.matrix.indices, indptr=self.matrix.indptr,
+                    shape=numpy.array(self.matrix.shape),
+                    ncodes=self.ncodes.astype(str),
+                    centroid_data=self.centroids.data,
+                    centroid_indices=self.centroids.indices,
+                    centroid_indptr=self.centroids.indptr,
+                    offsets=self.offsets, nprobe=numpy.array(self.nprobe),
+                    version=numpy.array(self.version))
+
+    @classmethod
+    def load(cls, filename: str) -> "IVFIndex":
+        """
+        saveで書き出した索引を読み込む
+        """
+        with numpy.load(filename) as f:
+            matrix = sparse.csr_matrix(
+                (f["data"], f["indices"], f["indptr"]),
+                shape=tuple(f["shape"]))
+            centroids = sparse.csr_matrix(
+                (f["centroid_data"], f["centroid_indices"],
+                 f["centroid_indptr"]),
+                shape=(len(f["offsets"]) - 1, matrix.shape[1]))
+            return cls(matrix, f["ncodes"], centroids, f["offsets"],
+                       int(f["nprobe"]), str(f["version"]))
+
+    @staticmethod
+    def version_of(filename: str) -> Optional[str]:
+        """
+        saveで書き出した索引を作った特徴量の版を、索引を読まずに返す
+
+        Returns
+        -------
+        str or None
+            特徴量の版、ファイルがないか版を記録していない古い索引ならNone
+        """
+        if not pathlib.Path(filename).exists():
+            return None
+        with numpy.load(filename) as f:
+            if "version" not in f.files or "centroid_data" not in f.files:
+                return None
+            return str(f["version"])
+
+    def search(self, queries: sparse.csr_matrix, k: int,
+               nprobe: Optional[int] = None
+               ) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        クエリごとに類似度の高いk件を近似的に探す
+
+        クエリをまとめて受け取り、クラスタごとに、そのクラスタを
+        検索するクエリとの類似度を疎行列の積1回で計算する。
+
+        Parameters
+        ----------
+        queries: scipy.sparse.csr_matrix
+            クエリの行列、特徴量の列は索引と同じ並び
+        k: int
+            返す件数
+        nprobe: int, default None
+            検索するクラスタの数、Noneのときは索引の既定値
+
+        Returns
+        -------
+        numpy.ndarray, numpy.ndarray
+            クエリ数×kの索引の行番号と類似度、足りない分は-1と-inf
+        """
+        if nprobe is None:
+            nprobe = self.nprobe
+        queries = normalize(queries)
+        probes = nearest_centroids(queries, self.centroids, nprobe)
+        positions: List[List[numpy.ndarray]] = [[] for _ in probes]
+        scores: List[List[numpy.ndarray]] = [[] for _ in probes]
+        # クラスタごとに、それを検索するクエリをまとめる
+        flat = probes.ravel()
+        order = numpy.argsort(flat, kind="stable")
+        nlist = self.centroids.shape[0]
+        bounds = numpy.searchsorted(flat[order], numpy.arange(nlist + 1))
+        for cluster in range(nlist):
+            start, stop = self.offsets[cluster], self.offsets[cluster + 1]
+            users = order[bounds[cluster]:bounds[cluster + 1]] \
+                // probes.shape[1]
+            if start == stop or len(users) == 0:
+                continue
+            sims = numpy.asarray(
+                (self.matrix[start:stop] @ queries[users].T).todense())
+            rows = numpy.arange(start, stop)
+            for j, query in enumerate(users):
+                positions[query].append(rows)
+                scores[query].append(sims[:, j])
+        result = numpy.full((len(probes), k), -1, dtype=numpy.int64)
+        result_scores = numpy.full((len(probes), k), -numpy.inf)
+        for i in range(len(probes)):
+            if positions[i]:
+                result[i], result_scores[i] = top_k(
+                    numpy.concatenate(positions[i]),
+                    numpy.concatenate(scores[i]), k)
+        return (result, result_scores)
+
+    def similar(self, ncodes: List[str], k: int = 10,
+                nprobe: Optional[int] = None) -> pandas.DataFrame:
+        """
+        ncodeの作品それぞれに似ている作品を、似ている順にk件ずつ返す
+
+        Parameters
+        ----------
+        ncodes: List[str]
+            クエリにする作品のncode、索引にないものは無視する
+        k: int, default 10
+            作品ごとに返す件数、クエリの作品自身は含めない
+        nprobe: int, default None
+            検索するクラスタの数、Noneのときは索引の既定値
+
+        Returns
+        -------
+        pandas.DataFrame
+            query列、ncode列、score列を持つDataFrame
+        """
+        index = self.rows.get_indexer([ncode.upper() for ncode in ncodes])
+        index = index[index >= 0]
+        positions, scores = self.search(self.matrix[index], k + 1, nprobe)
+        queries = numpy.repeat(self.ncodes[index], k + 1)
+        positions, scores = positions.ravel(), scores.ravel()
+        keep = (positions >= 0) & (positions != numpy.repeat(index, k + 1))
+        df = pandas.DataFrame({"query": queries[keep],
+                               "ncode": self.ncodes[positions[keep]],
+                               "score": scores[keep]})
+        return df.groupby("query", sort=False).head(k).reset_index(drop=True)
+
+    def recall(self, queries: sparse.csr_matrix, k: int = 10,
+               nprobe: Optional[int] = None) -> float:
+        """
+        全件検索の結果に対する、近似検索の上位k件の再現率を測る
+
+        Parameters
+        ----------
+        queries: scipy.sparse.csr_matrix
+            クエリの行列
+        k: int, default 10
+            比べる件数
+        nprobe: int, default None
+            検索するクラスタの数、Noneのときは索引の既定値
+
+        Returns
+        -------
+        float
+            全件検索の上位k件のうち、近似検索でも見つかった割合
+        """
+        approx, _ = self.search(queries, k, nprobe)
+        exact, _ = exact_search(self.matrix, normalize(queries), k)
+        found = 0
+        total = 0
+        for a, e in zip(approx, exact):
+            e = e[e >= 0]
+            found += len(numpy.intersect1d(a, e))
+            total += len(e)
+        return found / max(total, 1)
+
+
+def index_filename() -> str:
+    return str(pathlib.Path(narou.dirname).joinpath("annindex.npz"))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="ブックマークした作品に似ている作品を探す")
+    parser.add_argument("ncodes", nargs="*",
+                        help="クエリの作品、省略したら「とても好き」の作品")
+    parser.add_argument("-k", type=int, default=10, help="作品ごとの件数")
+    parser.add_argument("--nprobe", type=int, default=None,
+                        help="検索するクラスタの数")
+    parser.add_argument("--build", action="store_true",
+                        help="特徴量が変わっていなくても索引を作り直す")
+    parser.add_argument("--recall", type=int, default=0,
+                        help="ランダムな作品をクエリに、再現率を測る件数")
+    parser.add_argument("--storage", choices=storage.storage_kinds,
+                        default="sqlite", help="キャッシュの保存先")
+    args = parser.parse_args()
+    narou.set_storage(args.storage)
+    filename = index_filename()
+    # 特徴量はメモリマップで開くだけなので、版を確かめるために読み込む
+    features = load_features(narou.cache, narou.manifest)
+    if args.build or IVFIndex.version_of(filename) != features.version:
+        index = IVFIndex.build(features)
+        index.save(filename)
+    else:
+        index = IVFIndex.load(filename)
+    if args.recall > 0:
+        rng = numpy.random.default_rng()
+        sample = rng.choice(index.matrix.shape[0],
+                            min(args.recall, index.matrix.shape[0]),
+                            replace=False)
+        print("recall@{0}: {1:.3f}".format(
+            args.k, index.recall(index.matrix[sample], args.k, args.nprobe)))
+    ncodes = args.ncodes
+    if not ncodes:
+        naroubookmark = NarouBookmark()
+        naroubookmark.login_narou()
+        ncodes = naroubookmark.get_ncodes(1)
+    print(index.similar(ncodes, args.k, args.nprobe))
+
+
+if __name__ == "__main__":
+    main()
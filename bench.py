@@ -0,0 +1,161 @@
+# ローカルのAPIサーバーを相手に、取得と読み込みの性能を測る
+
+import argparse
+import contextlib
+import io
+import json
+import pathlib
+import resource
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, Any, Callable
+import requests
+import narou
+import storage
+import fakeapi
+import metrics
+
+
+# Trueのとき、tracemallocで区間ごとのメモリ使用量の最大値を測る
+# tracemallocは取得を数倍遅くするので、既定ではプロセスの最大RSSだけを測る
+trace_memory = False
+
+
+def measure(func: Callable[[], Any]) -> Dict[str, float]:
+    """
+    関数を実行して、かかった時間[s]とメモリ使用量の最大値[B]を測る
+
+    peak_rssはプロセス開始からの最大RSSなので、前の測定より小さくはならない。
+    trace_memoryがTrueのときは、関数の実行中にPythonが確保したメモリの
+    最大値をpeak_memoryに入れる。
+    """
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    result = {"seconds": seconds,
+              "peak_rss": resource.getrusage(
+                  resource.RUSAGE_SELF).ru_maxrss * 1024}
+    if trace_memory:
+        _, result["peak_memory"] = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result
+
+
+def bench_crawl(stats_url: str, workers: int) -> Dict[str, float]:
+    """
+    全区分の取得を測る
+    """
+    before = requests.get(stats_url).json()
+    metrics.registry.reset()
+    with contextlib.redirect_stdout(io.StringIO()):  # 区分ごとの出力を捨てる
+        result = measure(lambda: narou.crawl(workers))
+    after = requests.get(stats_url).json()
+    rows = len(narou.read_allcaches(["ncode"]))
+    result["requests"] = after["requests"] - before["requests"]
+    result["bytes"] = after["bytes_sent"] - before["bytes_sent"]
+    result["rows"] = rows
+    result["rows_per_second"] = rows / result["seconds"]
+    # 取得の時間の内訳
+    total = metrics.registry.snapshot().get("total", {})
+    latency = total.get("histograms", {}).get("api_latency_seconds", {})
+    result["api_latency_seconds"] = latency.get("sum", 0.0)
+    for name in ["api_network_seconds", "api_gunzip_seconds",
+                 "api_json_seconds", "write_seconds", "sleep_seconds"]:
+        result[name] = total.get("counters", {}).get(name, 0.0)
+    return result
+
+
+def bench_read(columns: Any) -> Dict[str, float]:
+    """
+    キャッシュ全体の読み込みを測る
+    """
+    rows = 0
+
+    def read() -> None:
+        nonlocal rows
+        rows = len(narou.read_allcaches(columns))
+
+    result = measure(read)
+    result["rows"] = rows
+    result["rows_per_second"] = rows / result["seconds"]
+    return result
+
+
+def run(size: int, seed: int, kind: str, workers: int,
+        dirname: str) -> Dict[str, Dict[str, float]]:
+    """
+    架空の作品情報でAPIサーバーを立てて、取得と読み込みを測る
+
+    Parameters
+    ----------
+    size: int
+        架空の作品数
+    seed: int
+        乱数のシード
+    kind: str
+        キャッシュの保存先の種類
+    workers: int
+        並列に取得するスレッドの数
+    dirname: str
+        キャッシュを置くディレクトリ
+
+    Returns
+    -------
+    Dict[str, Dict[str, float]]
+        測定項目ごとの結果
+    """
+    process, url, stats_url = fakeapi.start_process(size, seed)
+    api_url = narou.client.api_url
+    try:
+        narou.client.api_url = url
+        narou.dirname = dirname
+        narou.set_storage(kind)
+        # ローカルなので待たない
+        narou.set_ratelimit(1e9, 1000)
+        narou.make_directory()
+        results = {
+            "crawl": bench_crawl(stats_url, workers),
+            "recrawl": bench_crawl(stats_url, workers),
+            "read_all": bench_read(None),
+            "read_ncode_length": bench_read(["ncode", "length"]),
+        }
+    finally:
+        narou.client.api_url = api_url
+        narou.set_ratelimit(None)
+        process.terminate()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="ローカルのAPIサーバーを相手に、取得と読み込みの性能を測る")
+    parser.add_argument("--size", type=int, default=20000,
+                        help="架空の作品数")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    parser.add_argument("--storage", choices=storage.storage_kinds,
+                        default="sqlite", help="キャッシュの保存先")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="並列に取得するスレッドの数")
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="区間ごとのメモリ使用量の最大値を測る（遅くなる）")
+    parser.add_argument("--output", default=None,
+                        help="結果をJSONで書き出すファイル")
+    args = parser.parse_args()
+    global trace_memory
+    trace_memory = args.tracemalloc
+    with tempfile.TemporaryDirectory() as dirname:
+        results = run(args.size, args.seed, args.storage, args.workers,
+                      str(pathlib.Path(dirname).joinpath("output")))
+    for name, result in results.items():
+        print("{0:<18}".format(name) + " ".join(
+            "{0}={1:.6g}".format(key, value) for key, value in result.items()))
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,18 @@ from bs4 import BeautifulSoup
 from urllib import parse
 import pandas
 import configparser
-from typing import List
+import hashlib
+import importlib.util
+import json
+import os
+import pathlib
+from concurrent import futures
+from typing import List, Dict, Tuple
+from manifest import Manifest
+
+
+# lxmlがあれば速いlxmlで、なければ標準のhtml.parserでHTMLを解析する
+html_parser = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
 
 
 class NarouBookmark:
@@ -14,16 +25,45 @@ class NarouBookmark:
     Gecko/20100101 Firefox/69.0"
     headers = {"user-agent": user_agent}
 
-    def __init__(self) -> None:
+    # ブックマーク一覧のURL
+    list_url = "https://syosetu.com/favnovelmain/list/"
+
+    def __init__(self, dirname: str = "output", workers: int = 8) -> None:
+        """
+        Parameters
+        ----------
+        dirname: str, default "output"
+            ログインのクッキーと、ブックマーク一覧のキャッシュを置くディレクトリ
+        workers: int, default 8
+            ブックマーク一覧のページを並列に取得するスレッドの数
+        """
         self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        self.session.mount("https://", adapter)
+        self.workers = workers
+        self.dirname = pathlib.Path(dirname)
+        self.cookie_filename = self.dirname.joinpath("cookies.json")
+        # ページのURLごとに、HTMLのハッシュと抜き出したncodeを記録する
+        self.pages = Manifest(str(self.dirname.joinpath("bookmarks.json")))
+        # 最後にgetしたブックマーク全体のハッシュ
+        self.digest = ""
 
-    def login_narou(self) -> None:
+    def login_narou(self, setting: str = "./setting.ini") -> None:
         """
         なろうにログインする
+
+        前回ログインしたときのクッキーが使えれば、ログインし直さない。
+
+        Parameters
+        ----------
+        setting: str, default "./setting.ini"
+            narouセクションにidとpassを書いた設定ファイル
         """
+        if self.load_cookies() and self.logged_in():
+            return
         # メールアドレスとパスワードの指定
         inifile = configparser.ConfigParser()
-        inifile.read("./setting.ini")
+        inifile.read(setting)
         login_info = {
             "narouid": inifile.get("narou", "id"),
             "pass": inifile.get("narou", "pass")
@@ -31,6 +71,127 @@ class NarouBookmark:
         # なろうURL
         login_url = "https://ssl.syosetu.com/login/login/"
         self.session.post(login_url, headers=self.headers, data=login_info)
+        self.save_cookies()
+
+    def load_cookies(self) -> bool:
+        """
+        保存したクッキーをセッションに読み込む、保存したものがなければFalse
+        """
+        try:
+            with open(self.cookie_filename, encoding="utf-8") as f:
+                cookies = json.load(f)
+        except FileNotFoundError:
+            return False
+        self.session.cookies.update(
+            requests.utils.cookiejar_from_dict(cookies))
+        return True
+
+    def save_cookies(self) -> None:
+        self.dirname.mkdir(parents=True, exist_ok=True)
+        cookies = requests.utils.dict_from_cookiejar(self.session.cookies)
+        tmppath = self.cookie_filename.with_name(
+            self.cookie_filename.name + ".tmp")
+        # ログイン情報なので、本人以外は読めないようにする
+        fd = os.open(str(tmppath), os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        with open(fd, "w", encoding="utf-8") as f:
+            json.dump(cookies, f)
+        os.replace(str(tmppath), str(self.cookie_filename))
+
+    def logged_in(self) -> bool:
+        """
+        ログインしたままか確かめる、ログインしていないとログイン画面へ飛ばされる
+        """
+        res = self.session.get(self.list_url, headers=self.headers)
+        return "login" not in parse.urlparse(res.url).path
+
+    def page_url(self, category_id: int, page: int) -> str:
+        return "{0}?nowcategory={1}&p={2}".format(
+            self.list_url, category_id, page)
+
+    def get_page(self, url: str) -> Tuple[List[str], int]:
+        """
+        ブックマーク一覧の1ページを取得して、ncodeと最後のページ番号を返す
+
+        前回のETagがあれば条件付きで取得し、変わっていなければ前回の結果を返す。
+        取得したHTMLのハッシュが前回と同じときも、解析せずに前回の結果を返す。
+
+        Parameters
+        ----------
+        url: str
+            ブックマーク一覧のページのURL
+
+        Returns
+        -------
+        ncodes: List[str]
+            ページにあるncodeのリスト
+        last: int
+            ページ送りにある最後のページ番号
+        """
+        entry = self.pages.get(url)
+        headers = dict(self.headers)
+        if entry is not None and entry.get("etag"):
+            headers["if-none-match"] = entry["etag"]
+        res = self.session.get(url, headers=headers)
+        if entry is not None and res.status_code == 304:
+            return (entry["ncodes"], entry["last"])
+        digest = hashlib.sha256(res.content).hexdigest()
+        if entry is not None and entry["hash"] == digest:
+            return (entry["ncodes"], entry["last"])
+        res.encoding = res.apparent_encoding
+        ncodes, last = NarouBookmark.parse_page(res.text)
+        self.pages.update(url, hash=digest, etag=res.headers.get("etag"),
+                          ncodes=ncodes, last=last)
+        return (ncodes, last)
+
+    @staticmethod
+    def parse_page(html: str) -> Tuple[List[str], int]:
+        """
+        ブックマーク一覧のHTMLから、ncodeと最後のページ番号を抜き出す
+        """
+        soup = BeautifulSoup(html, html_parser)
+        anchors = soup.select("a.title")
+        ncodes = [NarouBookmark.url2ncode(str(x.attrs["href"]))
+                  for x in anchors]
+        # ページ送りのリンクは'?nowcategory=1&p=3'のようなクエリを持つ
+        last = 1
+        for anchor in soup.select("a[href]"):
+            query = parse.parse_qs(parse.urlparse(str(anchor["href"])).query)
+            for page in query.get("p", []):
+                if page.isdigit():
+                    last = max(last, int(page))
+        return (ncodes, last)
+
+    def get_categories(self, category_ids: List[int]
+                       ) -> Dict[int, List[str]]:
+        """
+        複数のカテゴリのブックマークを、すべてのページについて並列に取得する
+
+        まず各カテゴリの1ページ目を並列に取得して最後のページ番号を調べ、
+        残りのページをまとめて並列に取得する。
+
+        Parameters
+        ----------
+        category_ids: List[int]
+            小説家になろうのマイページで作ったブックマークカテゴリの番号
+
+        Returns
+        -------
+        Dict[int, List[str]]
+            カテゴリの番号から、ページ順に並べたncodeのリストへの辞書
+        """
+        with futures.ThreadPoolExecutor(self.workers) as executor:
+            firsts = list(executor.map(
+                lambda c: self.get_page(self.page_url(c, 1)), category_ids))
+            rests = [(c, page) for c, (_, last) in zip(category_ids, firsts)
+                     for page in range(2, last + 1)]
+            pages = list(executor.map(
+                lambda cp: self.get_page(self.page_url(*cp))[0], rests))
+        result = {c: list(ncodes)
+                  for c, (ncodes, _) in zip(category_ids, firsts)}
+        for (c, _), ncodes in zip(rests, pages):
+            result[c].extend(ncodes)
+        return result
 
     def get_ncodes(self, category_id: int) -> List[str]:
         """
@@ -46,14 +207,7 @@ class NarouBookmark:
         ncodes: List[str]
             ncodeのリスト
         """
-        url = "https://syosetu.com/favnovelmain/list/?nowcategory={0}".format(
-            str(category_id))
-        res = self.session.get(url, headers=self.headers)
-        res.encoding = res.apparent_encoding
-        soup = BeautifulSoup(res.text, "html.parser")
-        anchors = soup.select("a.title")
-        ncodes = [NarouBookmark.url2ncode(x.attrs["href"]) for x in anchors]
-        return ncodes
+        return self.get_categories([category_id])[category_id]
 
     def get(self) -> pandas.DataFrame:
         """
@@ -65,6 +219,9 @@ class NarouBookmark:
         category2: まあまあ好きな作品 -> 1point
         category3: 好きではない作品   -> 0point
 
+        ブックマーク全体のハッシュをdigestに入れるので、
+        前回と比べれば変わっていないブックマークを学習し直さずに済む。
+
         Returns
         -------
         df: 2 colums DataFrame
@@ -73,12 +230,14 @@ class NarouBookmark:
         0    n3803fw      2
         1    n2509eu      1
         """
-        love = [(ncode, 2) for ncode in self.get_ncodes(1)]
-        like = [(ncode, 1) for ncode in self.get_ncodes(2)]
-        dislike = [(ncode, 0) for ncode in self.get_ncodes(3)]
+        categories = self.get_categories([1, 2, 3])
+        love = [(ncode, 2) for ncode in categories[1]]
+        like = [(ncode, 1) for ncode in categories[2]]
+        dislike = [(ncode, 0) for ncode in categories[3]]
         bookmarks = love + like + dislike
 
         df = pandas.DataFrame(bookmarks, columns=["ncode", "point"])
+        self.digest = bookmark_digest(df)
         return df
 
     @staticmethod
@@ -98,6 +257,14 @@ class NarouBookmark:
         return ncode
 
 
+def bookmark_digest(bookmarks: pandas.DataFrame) -> str:
+    """
+    ncode列とpoint列を持つブックマークのハッシュを返す
+    """
+    csv = bookmarks[["ncode", "point"]].to_csv(index=False)
+    return hashlib.sha256(csv.encode("utf-8")).hexdigest()
+
+
 def main() -> None:
     naroubookmark = NarouBookmark()
     naroubookmark.login_narou()
@@ -0,0 +1,233 @@
+# キャッシュした作品情報を、少ないメモリで読み込む
+
+import functools
+import os
+from concurrent import futures
+import pandas
+from typing import Dict, List, Optional
+import storage
+from ncodeindex import NcodeIndex, read_current, read_all_current
+
+
+# 長い文字列の列、明示的に求められたときだけ読み込む
+text_columns = ["title", "writer", "story", "gensaku", "keyword"]
+
+# 値の種類が少ない列、カテゴリ型にする
+category_columns = ["biggenre", "genre", "novel_type", "end", "pc_or_k"]
+
+# 0か1の列、bool型にする
+flag_columns = [
+    "isstop", "isr15", "isbl", "isgl", "iszankoku", "istensei", "istenni"
+]
+
+# 日時の列、文字列ではなくdatetime型にする
+date_columns = [
+    "general_firstup", "general_lastup", "novelupdated_at", "updated_at"
+]
+
+# まとめて読んだ作品情報の型の変換を、並列にする1プロセスあたりの最小の行数
+# 少ない行を分けても、プロセス間で受け渡す時間のほうがかかる
+compact_min_rows = 100000
+
+
+def default_columns(cache: storage.Storage) -> List[str]:
+    """
+    文字列の列を除いた、キャッシュにあるすべての列を返す
+
+    列は区分ごとに違うことはないので、最初の区分だけを見る。
+    """
+    keys = cache.keys()
+    if not keys:
+        return []
+    columns = cache.read(keys[:1]).columns
+    return [column for column in columns if column not in text_columns]
+
+
+def downcast(series: pandas.Series) -> pandas.Series:
+    """
+    数値の列を、値が収まる最小の型に変換する
+    """
+    if pandas.api.types.is_bool_dtype(series):
+        return series
+    if pandas.api.types.is_integer_dtype(series):
+        kind = "unsigned" if len(series) == 0 or series.min() >= 0 \
+            else "integer"
+        return pandas.to_numeric(series, downcast=kind)
+    if pandas.api.types.is_float_dtype(series):
+        return pandas.to_numeric(series, downcast="float")
+    return series
+
+
+def compact(df: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    作品情報の列を、メモリの少ない型に変換する
+
+    カテゴリ型への変換は、区分ごとにカテゴリが変わらないよう、
+    すべての区分をつなげてからcategorizeで行う。
+
+    Parameters
+    ----------
+    df: pandas.DataFrame
+        作品情報
+
+    Returns
+    -------
+    pandas.DataFrame
+        日時をdatetime型、0か1の列をbool型、数値を最小の型にした作品情報
+    """
+    columns: Dict[str, pandas.Series] = {}
+    for column in df.columns:
+        series = df[column]
+        if column in flag_columns:
+            series = series.fillna(0).astype(bool)
+        elif column in date_columns:
+            series = pandas.to_datetime(series, errors="coerce")
+        else:
+            series = downcast(series)
+        columns[column] = series
+    return pandas.DataFrame(columns, index=df.index)
+
+
+def compact_parallel(df: pandas.DataFrame,
+                     processes: Optional[int] = None) -> pandas.DataFrame:
+    """
+    作品情報を行で分けて、複数のプロセスでcompactする
+
+    Parameters
+    ----------
+    df: pandas.DataFrame
+        作品情報
+    processes: int, default None
+        変換するプロセスの数、Noneのときはコア数
+
+    Returns
+    -------
+    pandas.DataFrame
+        compactした作品情報、インデックスはdfのまま
+    """
+    if processes is None:
+        processes = os.cpu_count() or 1
+    chunks = min(processes, len(df) // compact_min_rows)
+    if chunks <= 1:
+        return compact(df)
+    size = -(-len(df) // chunks)  # 切り上げ
+    parts = [df.iloc[i:i + size] for i in range(0, len(df), size)]
+    with futures.ProcessPoolExecutor(chunks) as executor:
+        return pandas.concat(list(executor.map(compact, parts)))
+
+
+def categorize(df: pandas.DataFrame) -> pandas.DataFrame:
+    """
+    値の種類が少ない列をカテゴリ型にする
+    """
+    for column in category_columns:
+        if column in df.columns:
+            df[column] = df[column].astype("category")
+    return df
+
+
+def load_partition(cache: storage.Storage, key: str,
+                   columns: Optional[List[str]],
+                   index: Optional[NcodeIndex] = None) -> pandas.DataFrame:
+    """
+    1つの区分を読み込んで型を変換する、子プロセスで呼ばれる
+
+    indexを与えると、索引がこの区分を指している作品の行だけを読む。
+    """
+    if index is None:
+        return compact(cache.read([key], columns=columns))
+    return compact(read_current(cache, key, columns, index))
+
+
+def load(cache: storage.Storage,
+         columns: Optional[List[str]] = None,
+         keys: Optional[List[str]] = None,
+         processes: Optional[int] = None,
+         index: Optional[NcodeIndex] = None) -> pandas.DataFrame:
+    """
+    キャッシュされている作品情報を、少ないメモリで読み込む
+
+    csvやParquetのように区分ごとのファイルに保存する保存先では、
+    区分ごとに読み込んで型を変換してからつなげるので、
+    既定の型で全体を持つことはない。
+    区分の読み込みと型の変換は、複数のプロセスで並列に行う。
+    SQLiteのようにまとめて読むほうが速い保存先と、並列にしないときは、
+    1回でまとめて読み込んでから、型の変換だけを並列に行う。
+
+    Parameters
+    ----------
+    cache: storage.Storage
+        作品情報のキャッシュ
+    columns: List[str], default None
+        読み込む列、Noneのときはtext_columnsを除いたすべての列
+    keys: List[str], default None
+        読み込む区分のキー、Noneのときはすべての区分
+    processes: int, default None
+        読み込むプロセスの数、Noneのときはコア数
+    index: NcodeIndex, default None
+        複数の区分にある作品の最新の行を選ぶ索引、Noneのときはすべての行
+
+    Returns
+    -------
+    pandas.DataFrame
+        インデックスが0からの連番の作品情報
+    """
+    if columns is None:
+        columns = default_columns(cache)
+    if cache.bulk_read or processes == 1:
+        df = cache.read(keys, columns) if index is None \
+            else read_all_current(cache, keys, columns, index)
+        return categorize(compact_parallel(df, processes))
+    return categorize(storage.read_parallel(
+        cache, keys, columns, processes,
+        functools.partial(load_partition, index=index)))
+
+
+class Corpus:
+    """
+    キャッシュした作品情報を、文字列の列は必要になるまで読まずに持つ
+
+    数値の列だけをframeに持ち、あらすじやキーワードなどの長い文字列は
+    textを呼んだときに、その列だけをキャッシュから読み込む。
+    """
+
+    def __init__(self, cache: storage.Storage,
+                 columns: Optional[List[str]] = None,
+                 processes: Optional[int] = None) -> None:
+        """
+        Parameters
+        ----------
+        cache: storage.Storage
+            作品情報のキャッシュ
+        columns: List[str], default None
+            最初に読み込む列、Noneのときはtext_columnsを除いたすべての列
+            ncode列は指定しなくても読み込む
+        processes: int, default None
+            読み込むプロセスの数、Noneのときはコア数
+        """
+        if columns is None:
+            columns = default_columns(cache)
+        if "ncode" not in columns:
+            columns = ["ncode"] + columns
+        self.cache = cache
+        self.frame = load(cache, columns, processes=processes)
+
+    def text(self, column: str) -> pandas.Series:
+        """
+        文字列の列をキャッシュから読み込み、frameの行にそろえて返す
+
+        Parameters
+        ----------
+        column: str
+            読み込む列
+
+        Returns
+        -------
+        pandas.Series
+            frameと同じインデックスを持つ列、キャッシュにない作品は欠損値
+        """
+        df = self.cache.read(columns=["ncode", column])
+        df = df.drop_duplicates("ncode", keep="last").set_index("ncode")
+        series = df[column].reindex(self.frame["ncode"])
+        series.index = self.frame.index
+        return series
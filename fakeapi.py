@@ -0,0 +1,356 @@
+# なろう小説APIの代わりにローカルで動くAPIサーバー
+
+import argparse
+import datetime
+import gzip
+import http.server
+import json
+import multiprocessing
+import random
+import threading
+import urllib.parse
+from typing import List, Dict, Any, Optional, Tuple, Callable
+import narou
+
+
+# ofパラメータの出力項目の略称と、項目名の対応
+of_fields = {
+    "t": "title", "n": "ncode", "u": "userid", "w": "writer", "s": "story",
+    "bg": "biggenre", "g": "genre", "k": "keyword",
+    "gf": "general_firstup", "gl": "general_lastup", "nt": "novel_type",
+    "e": "end", "ga": "general_all_no", "l": "length", "ti": "time",
+    "gp": "global_point", "f": "fav_novel_cnt", "a": "all_point",
+    "ka": "kaiwaritu", "nu": "novelupdated_at", "ua": "updated_at"
+}
+
+# 作品に付けるキーワードの候補
+keywords = [
+    "異世界", "転生", "転移", "チート", "ハーレム", "ざまぁ", "悪役令嬢",
+    "婚約破棄", "スローライフ", "恋愛", "ファンタジー", "冒険", "魔法",
+    "ダンジョン", "ほのぼの", "シリアス", "ラブコメ", "学園", "SF", "VRMMO",
+    "ホラー", "ミステリー", "日常", "コメディ", "残酷な描写あり", "R15"
+]
+
+# JST
+jst = datetime.timezone(datetime.timedelta(hours=9))
+
+
+def make_ncode(i: int) -> str:
+    """
+    通し番号からncodeを作る、'N0001AB'のような形式
+    """
+    letters = ""
+    n = i // 10000
+    for _ in range(2):
+        letters = chr(ord("A") + n % 26) + letters
+        n //= 26
+    return "N{0:04d}{1}".format(i % 10000, letters)
+
+
+def format_time(unixtime: int) -> str:
+    return datetime.datetime.fromtimestamp(unixtime, jst).strftime(
+        "%Y-%m-%d %H:%M:%S")
+
+
+def make_corpus(size: int,
+                seed: int = 0,
+                genres: Optional[List[str]] = None,
+                short_ratio: float = 0.4,
+                short_length: Tuple[float, float] = (8.0, 1.0),
+                serial_length: Tuple[float, float] = (11.0, 1.2),
+                now: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    なろう小説APIが返す形式の、架空の作品情報を作る
+
+    ジャンルは先頭ほど多くなるように偏らせる。
+    作品の長さは、短編と連載でそれぞれ対数正規分布に従わせるので、
+    全体ではフタコブラクダの分布になる。
+
+    Parameters
+    ----------
+    size: int
+        作品数
+    seed: int, default 0
+        乱数のシード
+    genres: List[str], default None
+        使うジャンル、Noneのときはnarou.genresのすべて
+    short_ratio: float, default 0.4
+        短編の割合
+    short_length: (float, float), default (8.0, 1.0)
+        短編の長さの対数の平均と標準偏差
+    serial_length: (float, float), default (11.0, 1.2)
+        連載の長さの対数の平均と標準偏差
+    now: int, default None
+        最新の更新時刻（unixtime）、Noneのときは現在時刻
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+        作品情報のリスト
+        フィルタ用に、更新時刻のunixtimeを'_lastup'に持つ。
+    """
+    rng = random.Random(seed)
+    if genres is None:
+        genres = narou.genres
+    if now is None:
+        now = int(datetime.datetime.now().timestamp())
+    weights = [1 / (i + 1) for i in range(len(genres))]
+    corpus = []
+    for i in range(size):
+        genre = rng.choices(genres, weights)[0]
+        short = rng.random() < short_ratio
+        mu, sigma = short_length if short else serial_length
+        length = max(1, round(rng.lognormvariate(mu, sigma)))
+        firstup = now - rng.randrange(10 * 365 * 24 * 60 * 60)
+        lastup = firstup if short else rng.randrange(firstup, now + 1)
+        point = round(rng.paretovariate(1.2)) - 1
+        corpus.append({
+            "title": "作品{0}".format(i),
+            "ncode": make_ncode(i),
+            "userid": rng.randrange(1, size // 10 + 2),
+            "writer": "作者{0}".format(rng.randrange(size // 10 + 1)),
+            "story": "あらすじ" * rng.randrange(10, 100),
+            "biggenre": int(genre) // 100,
+            "genre": int(genre),
+            "keyword": " ".join(rng.sample(keywords, rng.randrange(1, 6))),
+            "general_firstup": format_time(firstup),
+            "general_lastup": format_time(lastup),
+            "novel_type": 2 if short else 1,
+            "end": 0 if short or rng.random() < 0.3 else 1,
+            "general_all_no": 1 if short else max(1, length // 3000),
+            "length": length,
+            "time": max(1, length // 500),
+            "global_point": point * 2,
+            "fav_novel_cnt": point // 2,
+            "all_point": point,
+            "kaiwaritu": min(100, max(0, round(rng.gauss(35, 18)))),
+            "novelupdated_at": format_time(lastup),
+            "updated_at": format_time(lastup),
+            "_lastup": lastup,
+            "_buntai": rng.choices([1, 2, 4, 6], [5, 2, 2, 1])[0],
+        })
+    return corpus
+
+
+def parse_range(value: str) -> Tuple[Optional[int], Optional[int]]:
+    """
+    'N-M'、'-M'、'N-'、'N'形式の範囲を、最小と最大に分ける
+    """
+    if "-" not in value:
+        return (int(value), int(value))
+    lo, hi = value.split("-", 1)
+    return (int(lo) if lo != "" else None, int(hi) if hi != "" else None)
+
+
+def in_range(value: int, bounds: Tuple[Optional[int], Optional[int]]) -> bool:
+    lo, hi = bounds
+    return (lo is None or lo <= value) and (hi is None or value <= hi)
+
+
+def make_filter(params: Dict[str, str]) -> Callable[[Dict[str, Any]], bool]:
+    """
+    GETパラメータから、作品を絞り込む関数を作る
+    """
+    conditions: List[Callable[[Dict[str, Any]], bool]] = []
+    if "ncode" in params:
+        ncodes = set(params["ncode"].upper().split("-"))
+        conditions.append(lambda novel: novel["ncode"] in ncodes)
+    if "genre" in params:
+        genres = set(int(g) for g in params["genre"].split("-"))
+        conditions.append(lambda novel: novel["genre"] in genres)
+    if "buntai" in params:
+        buntais = set(int(b) for b in params["buntai"].split("-"))
+        conditions.append(lambda novel: novel["_buntai"] in buntais)
+    if "kaiwaritu" in params:
+        kaiwa = parse_range(params["kaiwaritu"])
+        conditions.append(lambda novel: in_range(novel["kaiwaritu"], kaiwa))
+    if "length" in params:
+        length = parse_range(params["length"])
+        conditions.append(lambda novel: in_range(novel["length"], length))
+    if "lastup" in params:
+        lastup = parse_range(params["lastup"])
+        conditions.append(lambda novel: in_range(novel["_lastup"], lastup))
+    if "type" in params:
+        types = {
+            "t": [(2, 0)], "r": [(1, 1)], "er": [(1, 0)],
+            "re": [(1, 1), (1, 0)], "ter": [(2, 0), (1, 0)]
+        }[params["type"]]
+        conditions.append(
+            lambda novel: (novel["novel_type"], novel["end"]) in types)
+    return lambda novel: all(condition(novel) for condition in conditions)
+
+
+# orderパラメータと、並べ替えのキーと降順かどうかの対応
+orders: Dict[str, Tuple[str, bool]] = {
+    "new": ("_lastup", True), "old": ("_lastup", False),
+    "hyoka": ("global_point", True), "favnovelcnt": ("fav_novel_cnt", True),
+    "lengthdesc": ("length", True), "lengthasc": ("length", False),
+    "ncodedesc": ("ncode", True)
+}
+
+
+class FakeNarouAPI(http.server.ThreadingHTTPServer):
+    """
+    作品情報のリストを、なろう小説APIと同じGETパラメータで返すサーバー
+
+    allcount、st、lim、length、of、orderなどは本物のAPIと同じに扱う。
+    stは1から2000、limは1から500までで、範囲外は404を返す。
+    そのため、1つの検索で取れるのは2499件までになる。
+    リクエスト数と送ったバイト数を数えていて、/statsで取得できる。
+    """
+
+    def __init__(self, corpus: List[Dict[str, Any]],
+                 port: int = 0) -> None:
+        """
+        Parameters
+        ----------
+        corpus: List[Dict[str, Any]]
+            make_corpusで作った作品情報
+        port: int, default 0
+            待ち受けるポート、0のときは空いているポート
+        """
+        super().__init__(("127.0.0.1", port), FakeNarouAPIHandler)
+        self.corpus = corpus
+        # ジャンルと文体を指定した検索を速くするための索引
+        self.index: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        for novel in corpus:
+            for key in [(str(novel["genre"]), ""),
+                        (str(novel["genre"]), str(novel["_buntai"]))]:
+                self.index.setdefault(key, []).append(novel)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{0}/novelapi/api/".format(
+            self.server_address[1])
+
+    @property
+    def stats_url(self) -> str:
+        return "http://127.0.0.1:{0}/stats".format(self.server_address[1])
+
+    def start(self) -> "FakeNarouAPI":
+        """
+        別スレッドでサーバーを動かす
+        """
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def respond(self, params: Dict[str, str]) -> Optional[bytes]:
+        """
+        GETパラメータに対するレスポンスの本文を作る、範囲外ならNone
+        """
+        st = max(1, int(params.get("st", 1)))
+        lim = int(params.get("lim", 20))
+        if st > 2000 or not 1 <= lim <= 500:
+            return None
+        candidates = self.corpus
+        genre = params.get("genre", "-")
+        buntai = params.get("buntai", "")
+        if "-" not in genre and "-" not in buntai:
+            candidates = self.index.get((genre, buntai), [])
+        accept = make_filter(params)
+        novels = [novel for novel in candidates if accept(novel)]
+        key, reverse = orders[params.get("order", "new")]
+        novels.sort(key=lambda novel: novel[key], reverse=reverse)
+        # 偽の作品情報が持たない項目は、指定されても返さない
+        fields = [of_fields[f] for f in params["of"].split("-")
+                  if f in of_fields] \
+            if "of" in params else list(of_fields.values())
+        jsondata: List[Dict[str, Any]] = [{"allcount": len(novels)}]
+        for novel in novels[st - 1:st - 1 + lim]:
+            jsondata.append({field: novel[field] for field in fields})
+        body = json.dumps(jsondata, ensure_ascii=False).encode("utf-8")
+        if "gzip" in params:
+            body = gzip.compress(body, int(params["gzip"]))
+        return body
+
+
+class FakeNarouAPIHandler(http.server.BaseHTTPRequestHandler):
+    server: FakeNarouAPI
+
+    def do_GET(self) -> None:
+        url = urllib.parse.urlparse(self.path)
+        if url.path == "/stats":
+            with self.server.lock:
+                stats = {"requests": self.server.requests,
+                         "bytes_sent": self.server.bytes_sent}
+            self.send_body(json.dumps(stats).encode("utf-8"))
+            return
+        params = dict(urllib.parse.parse_qsl(url.query))
+        body = self.server.respond(params)
+        if body is None:
+            self.send_error(404)
+            return
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.bytes_sent += len(body)
+        self.send_body(body)
+
+    def send_body(self, body: bytes) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def serve(size: int, seed: int, conn: Any) -> None:
+    server = FakeNarouAPI(make_corpus(size, seed))
+    conn.send((server.url, server.stats_url))
+    server.serve_forever()
+
+
+def start_process(size: int, seed: int = 0
+                  ) -> Tuple[multiprocessing.Process, str, str]:
+    """
+    別プロセスでサーバーを動かす
+
+    測定する側のプロセスにサーバーの処理やメモリが混ざらないようにする。
+
+    Parameters
+    ----------
+    size: int
+        架空の作品数
+    seed: int, default 0
+        乱数のシード
+
+    Returns
+    -------
+    multiprocessing.Process, str, str
+        サーバーのプロセスと、APIのURLと、統計のURL
+    """
+    parent, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve, args=(size, seed, child),
+                                      daemon=True)
+    process.start()
+    url, stats_url = parent.recv()
+    return (process, url, stats_url)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="なろう小説APIの代わりにローカルで動くAPIサーバー")
+    parser.add_argument("--size", type=int, default=100000,
+                        help="架空の作品数")
+    parser.add_argument("--seed", type=int, default=0, help="乱数のシード")
+    parser.add_argument("--port", type=int, default=8080,
+                        help="待ち受けるポート")
+    args = parser.parse_args()
+    server = FakeNarouAPI(make_corpus(args.size, args.seed), args.port)
+    print("serving on " + server.url)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+# キャッシュした作品情報から、作品ごとの特徴量を作る
+
+import numpy
+import pandas
+from scipy import sparse
+from typing import List, Optional, Tuple
+
+
+# 特徴量を作るのに使う作品情報の列
+feature_columns = [
+    "ncode", "keyword", "genre", "length", "kaiwaritu",
+    "general_lastup", "end", "novel_type"
+]
+
+
+class Features:
+    """
+    作品ごとの特徴量をまとめた疎行列
+
+    行は作品、列は特徴量に対応する。
+    列はキーワードのTF-IDF、ジャンルのone-hot、数値の特徴量の順に並ぶ。
+    """
+
+    def __init__(self, matrix: sparse.csr_matrix, ncodes: numpy.ndarray,
+                 names: List[str],
+                 columns: Optional[sparse.csc_matrix] = None,
+                 version: str = "") -> None:
+        """
+        Parameters
+        ----------
+        matrix: scipy.sparse.csr_matrix
+            作品数×特徴量数の行列
+        ncodes: numpy.ndarray
+            各行の作品のncode
+        names: List[str]
+            各列の特徴量の名前
+        columns: scipy.sparse.csc_matrix, default None
+            matrixをCSC形式にした行列、Noneのときは必要になったときに作る
+        version: str, default ""
+            保存した特徴量の版、保存していない特徴量は空文字列
+        """
+        self.matrix = matrix
+        self.ncodes = ncodes
+        self.names = names
+        self.rows = pandas.Index(ncodes)
+        self.columns = columns
+        self.version = version
+
+    def csc(self) -> sparse.csc_matrix:
+        """
+        特徴量の列を切り出すための、CSC形式の行列を返す
+        """
+        if self.columns is None:
+            self.columns = self.matrix.tocsc()
+        return self.columns
+
+    def index(self, ncodes: List[str]) -> numpy.ndarray:
+        """
+        ncodeに対応する行番号を返す、特徴量にないncodeは-1になる
+        """
+        return self.rows.get_indexer([ncode.upper() for ncode in ncodes])
+
+
+def keyword_matrix(keywords: pandas.Series
+                   ) -> Tuple[sparse.csr_matrix, numpy.ndarray]:
+    """
+    空白区切りのキーワードから、作品がキーワードを持てば1になる行列を作る
+
+    Parameters
+    ----------
+    keywords: pandas.Series
+        作品ごとの空白区切りのキーワード
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix, numpy.ndarray
+        作品数×キーワード数の行列と、各列のキーワード
+    """
+    n = len(keywords)
+    keywords = keywords.reset_index(drop=True)
+    tokens = keywords.fillna("").astype(str).str.split().explode()
+    tokens = tokens[tokens.notna() & (tokens != "")]
+    rows = tokens.index.to_numpy()
+    codes, vocabulary = pandas.factorize(tokens.to_numpy())
+    matrix = sparse.csr_matrix(
+        (numpy.ones(len(codes)), (rows, codes)),
+        shape=(n, len(vocabulary)))
+    matrix.data[:] = 1.0        # 重複したキーワードは1つに数える
+    return (matrix, numpy.asarray(vocabulary, dtype=str))
+
+
+def tfidf(matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+    """
+    0か1のキーワードの行列を、行ごとにL2正規化したTF-IDFにする
+
+    1作品に同じキーワードは1回しか現れないので、TFは0か1になる。
+    IDFはlog((1 + 作品数) / (1 + キーワードを持つ作品数)) + 1。
+    """
+    n = matrix.shape[0]
+    document_frequency = numpy.bincount(matrix.indices,
+                                        minlength=matrix.shape[1])
+    idf = numpy.log((1 + n) / (1 + document_frequency)) + 1
+    matrix = matrix.multiply(idf).tocsr()
+    norms = numpy.sqrt(numpy.asarray(matrix.multiply(matrix).sum(axis=1)))
+    norms[norms == 0] = 1.0
+    return sparse.csr_matrix(matrix.multiply(1 / norms))
+
+
+def keyword_tfidf(keywords: pandas.Series
+                  ) -> Tuple[sparse.csr_matrix, List[str]]:
+    """
+    空白区切りのキーワードから、行ごとにL2正規化したTF-IDFの行列を作る
+
+    Parameters
+    ----------
+    keywords: pandas.Series
+        作品ごとの空白区切りのキーワード
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix, List[str]
+        作品数×キーワード数の行列と、各列のキーワード
+    """
+    matrix, vocabulary = keyword_matrix(keywords)
+    return (tfidf(matrix), ["keyword:" + str(word) for word in vocabulary])
+
+
+def numeric_features(df: pandas.DataFrame, now: pandas.Timestamp
+                     ) -> pandas.DataFrame:
+    """
+    作品長さ、会話率、更新に関する数値の特徴量を、平均0分散1にそろえて返す
+    """
+    lastup = pandas.to_datetime(df["general_lastup"], errors="coerce")
+    days = (now - lastup).dt.total_seconds() / (24 * 60 * 60)
+    numeric = pandas.DataFrame({
+        "log_length": numpy.log1p(df["length"].astype(float).clip(lower=0)),
+        "kaiwaritu": df["kaiwaritu"].astype(float) / 100,
+        "log_days_since_update": numpy.log1p(days.clip(lower=0)),
+        "serial": (df["novel_type"] == 1).astype(float),
+        "ongoing": (df["end"] == 1).astype(float),
+    })
+    numeric = numeric.fillna(numeric.mean()).fillna(0)
+    std = numeric.std().replace(0, 1).fillna(1)
+    return (numeric - numeric.mean()) / std
+
+
+def make_features(df: pandas.DataFrame,
+                  now: Optional[pandas.Timestamp] = None) -> Features:
+    """
+    キャッシュした作品情報から、作品ごとの特徴量を作る
+
+    Parameters
+    ----------
+    df: pandas.DataFrame
+        feature_columnsの列を持つ作品情報
+    now: pandas.Timestamp, default None
+        更新からの経過日数を測る基準時刻、Noneのときは現在時刻
+
+    Returns
+    -------
+    Features
+        作品ごとの特徴量
+    """
+    df = df.drop_duplicates("ncode").reset_index(drop=True)
+    keyword, keyword_names = keyword_tfidf(df["keyword"])
+    return combine(df, keyword, keyword_names, now)
+
+
+def combine(df: pandas.DataFrame, keyword: sparse.csr_matrix,
+            keyword_names: List[str],
+            now: Optional[pandas.Timestamp] = None) -> Features:
+    """
+    キーワードのTF-IDFに、ジャンルと数値の特徴量を並べて特徴量にする
+
+    Parameters
+    ----------
+    df: pandas.DataFrame
+        feature_columnsのうちkeyword以外の列を持つ、ncodeが重複しない作品情報
+    keyword: scipy.sparse.csr_matrix
+        dfと同じ行の並びの、キーワードのTF-IDF
+    keyword_names: List[str]
+        keywordの各列の特徴量の名前
+    now: pandas.Timestamp, default None
+        更新からの経過日数を測る基準時刻、Noneのときは現在時刻
+
+    Returns
+    -------
+    Features
+        作品ごとの特徴量
+    """
+    if now is None:
+        now = pandas.Timestamp.now()
+    df = df.reset_index(drop=True)
+    genre_codes, genre_values = pandas.factorize(df["genre"].astype(str))
+    genre = sparse.csr_matrix(
+        (numpy.ones(len(df)), (numpy.arange(len(df)), genre_codes)),
+        shape=(len(df), len(genre_values)))
+    numeric = numeric_features(df, now)
+    matrix = sparse.hstack([keyword, genre, sparse.csr_matrix(numeric.values)],
+                           format="csr")
+    names = keyword_names + ["genre:" + g for g in genre_values] \
+        + list(numeric.columns)
+    ncodes = df["ncode"].astype(str).str.upper().to_numpy()
+    return Features(matrix, ncodes, names)
@@ -0,0 +1,310 @@
+# 作品の特徴量をファイルに保存しておき、推薦の起動時にメモリマップで読み込む
+
+import argparse
+import json
+import os
+import pathlib
+import shutil
+import time
+import numpy
+import pandas
+from scipy import sparse
+from typing import List, Dict, Any, Optional
+import narou
+import storage
+from features import (
+    Features, feature_columns, keyword_matrix, tfidf, combine, make_features
+)
+from manifest import Manifest
+from ncodeindex import updated_of
+
+
+# 区分ごとに保存する、キーワード以外の特徴量の元になる列
+raw_columns = [
+    "genre", "length", "kaiwaritu", "general_lastup", "end", "novel_type"
+]
+
+# 書き出す行列の形式の版、変えたときは次のbuildで行列を書き出しなおす
+store_format = 2
+
+# 目録の記録のうち、区分のキャッシュの中身が変わったときに変わる項目
+# checked_atやgrowthなど、中身を変えずに毎回書き換わる項目は見ない
+signature_fields = ["count", "fetched_at", "written_at"]
+
+# 区分のキャッシュから読む列、更新時刻は区分をまたいだ重複の除去に使う
+read_columns = feature_columns + ["novelupdated_at", "updated_at"]
+
+
+class FeatureStore:
+    """
+    作品ごとの特徴量をファイルに保存する
+
+    buildは2段で特徴量を作る。
+    まず区分ごとに、キーワードを0か1にした行列とキーワード以外の列を
+    partitionsディレクトリのnpzファイルに保存する。
+    キャッシュが変わった区分だけを作りなおすので、キーワードの文字列を
+    解析するのは変わった区分の分だけで済む。
+    次にすべての区分をつなげ、複数の区分にある作品は更新時刻が新しい行を残し、
+    TF-IDFと正規化をかけた行列を.npyファイルに書き出す。
+    loadは.npyファイルをメモリマップで開くので、すぐに読み込めて、
+    複数のプロセスが同じページキャッシュを共有する。
+
+    行列は書き出すたびに新しいディレクトリに置き、current.jsonを
+    置き換えて切り替える。読み込み中のプロセスが古い行列を開いていても、
+    ファイルが消えて読めなくなることはない。
+    更新からの経過日数は、行列を書き出した時刻を基準にする。
+    """
+
+    def __init__(self, dirname: str) -> None:
+        """
+        Parameters
+        ----------
+        dirname: str
+            特徴量を保存するディレクトリ
+        """
+        self.dirname = pathlib.Path(dirname)
+        # 区分ごとに、特徴量を作ったときのキャッシュの状態を記録する
+        self.partitions = Manifest(str(self.dirname.joinpath(
+            "partitions.json")))
+
+    def partition_path(self, key: str) -> pathlib.Path:
+        return self.dirname.joinpath("partitions", key + ".npz")
+
+    def build(self, cache: storage.Storage,
+              manifest: Optional[Manifest] = None,
+              force: bool = False) -> int:
+        """
+        キャッシュが変わった区分の特徴量を作りなおし、行列を書き出す
+
+        区分が変わったかどうかは、取得の目録の記録のsignature_fieldsで
+        判断する。
+        目録に記録がない区分は、キャッシュの作品数で判断する。
+        作りなおした区分も消えた区分もなく、行列の形式も変わっていなければ、
+        行列は書き出さない。
+
+        Parameters
+        ----------
+        cache: storage.Storage
+            作品情報のキャッシュ
+        manifest: Manifest, default None
+            区分ごとの取得状況の目録、Noneのときは作品数だけで判断する
+        force: bool, default False
+            Trueならすべての区分を作りなおす
+
+        Returns
+        -------
+        int
+            作りなおした区分の数
+        """
+        self.dirname.mkdir(parents=True, exist_ok=True)
+        keys = cache.keys()
+        rebuilt = 0
+        for key in keys:
+            entry = manifest.get(key) if manifest is not None else None
+            signature = {"count": cache.count(key)} if entry is None \
+                else {field: entry[field] for field in signature_fields
+                      if field in entry}
+            previous = self.partitions.get(key)
+            if not force and previous is not None \
+               and previous.get("signature") == signature \
+               and self.partition_path(key).exists():
+                continue
+            self.build_partition(cache, key)
+            self.partitions.update(key, signature=signature)
+            rebuilt += 1
+        removed = [key for key in self.partitions.load() if key not in keys]
+        for key in removed:
+            path = self.partition_path(key)
+            if path.exists():
+                path.unlink()
+            self.partitions.remove(key)
+        current = self.current()
+        if rebuilt > 0 or removed or current is None \
+           or current.get("format") != store_format:
+            self.write(self.assemble(keys))
+        return rebuilt
+
+    def build_partition(self, cache: storage.Storage, key: str) -> None:
+        """
+        区分のキャッシュを読んで、区分の特徴量をnpzファイルに保存する
+        """
+        df = cache.read([key], columns=read_columns)
+        keyword, vocabulary = keyword_matrix(df["keyword"])
+        path = self.partition_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmppath = path.with_name(path.name + ".tmp")
+        with open(tmppath, "wb") as f:
+            numpy.savez(
+                f, ncode=df["ncode"].astype(str).str.upper().to_numpy(str),
+                updated=updated_of(df).to_numpy(str),
+                genre=df["genre"].astype(str).to_numpy(str),
+                general_lastup=pandas.to_datetime(
+                    df["general_lastup"], errors="coerce").to_numpy(),
+                indptr=keyword.indptr, indices=keyword.indices,
+                vocabulary=vocabulary,
+                **{column: df[column].to_numpy(float)
+                   for column in ["length", "kaiwaritu", "end",
+                                  "novel_type"]})
+        os.replace(str(tmppath), str(path))
+
+    def assemble(self, keys: List[str]) -> Features:
+        """
+        区分の特徴量をつなげて、すべての作品の特徴量にする
+        """
+        frames: List[pandas.DataFrame] = []
+        matrices: List[sparse.csr_matrix] = []
+        vocabularies: List[numpy.ndarray] = []
+        for key in keys:
+            with numpy.load(str(self.partition_path(key))) as f:
+                frames.append(pandas.DataFrame(
+                    {column: f[column]
+                     for column in ["ncode", "updated"] + raw_columns}))
+                vocabularies.append(f["vocabulary"])
+                matrices.append(sparse.csr_matrix(
+                    (numpy.ones(len(f["indices"])), f["indices"],
+                     f["indptr"]),
+                    shape=(len(f["indptr"]) - 1, len(f["vocabulary"]))))
+        if not frames:
+            return make_features(
+                pandas.DataFrame(columns=feature_columns))
+        # 区分ごとのキーワードの列を、全体の語彙の列に付けかえる
+        vocabulary = pandas.Index(numpy.concatenate(vocabularies)).unique()
+        for i, words in enumerate(vocabularies):
+            codes = vocabulary.get_indexer(words)
+            m = matrices[i]
+            matrices[i] = sparse.csr_matrix(
+                (m.data, codes[m.indices], m.indptr),
+                shape=(m.shape[0], len(vocabulary)))
+        keyword = sparse.vstack(matrices, format="csr")
+        df = pandas.concat(frames, ignore_index=True)
+        # 複数の区分にある作品は、更新時刻が新しい行を残す
+        latest = df.sort_values("updated", kind="stable") \
+            .drop_duplicates("ncode", keep="last").index.to_numpy()
+        rows = numpy.sort(latest)
+        keyword = keyword[rows]
+        used = numpy.flatnonzero(keyword.getnnz(axis=0) > 0)
+        keyword = keyword[:, used]
+        names = ["keyword:" + str(word) for word in vocabulary[used]]
+        return combine(df.iloc[rows], tfidf(keyword), names)
+
+    def current(self) -> Optional[Dict[str, Any]]:
+        """
+        いま使う行列の記録を返す、まだ書き出していなければNone
+        """
+        try:
+            with open(self.dirname.joinpath("current.json"),
+                      encoding="utf-8") as f:
+                return dict(json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def write(self, features: Features) -> None:
+        """
+        特徴量の行列を新しいディレクトリに書き出して、current.jsonで切り替える
+        """
+        version = "matrix-{0}".format(time.time_ns())
+        path = self.dirname.joinpath(version)
+        path.mkdir(parents=True)
+        matrix = features.matrix
+        numpy.save(str(path.joinpath("data.npy")), matrix.data)
+        numpy.save(str(path.joinpath("indices.npy")), matrix.indices)
+        numpy.save(str(path.joinpath("indptr.npy")), matrix.indptr)
+        # 特徴量の列を切り出す増分学習のために、CSC形式も書き出す
+        columns = features.csc()
+        numpy.save(str(path.joinpath("csc_data.npy")), columns.data)
+        numpy.save(str(path.joinpath("csc_indices.npy")), columns.indices)
+        numpy.save(str(path.joinpath("csc_indptr.npy")), columns.indptr)
+        numpy.save(str(path.joinpath("ncodes.npy")),
+                   numpy.asarray(features.ncodes, dtype=str))
+        with open(path.joinpath("names.json"), "w", encoding="utf-8") as f:
+            json.dump(features.names, f, ensure_ascii=False)
+        current = {"version": version, "shape": list(matrix.shape),
+                   "format": store_format, "built_at": int(time.time())}
+        filename = self.dirname.joinpath("current.json")
+        tmppath = filename.with_name(filename.name + ".tmp")
+        with open(tmppath, "w", encoding="utf-8") as f:
+            json.dump(current, f)
+        os.replace(str(tmppath), str(filename))
+        # 古い行列を消す、開いているプロセスはそのまま読み続けられる
+        for old in self.dirname.glob("matrix-*"):
+            if old.name != version:
+                shutil.rmtree(str(old), ignore_errors=True)
+
+    def load(self) -> Optional[Features]:
+        """
+        書き出した特徴量の行列を、メモリマップで読み込む
+
+        Returns
+        -------
+        Features or None
+            作品ごとの特徴量、まだ書き出していなければNone
+        """
+        current = self.current()
+        if current is None:
+            return None
+        path = self.dirname.joinpath(current["version"])
+
+        def mmap(name: str) -> numpy.ndarray:
+            return numpy.load(str(path.joinpath(name)), mmap_mode="r")
+
+        shape = tuple(current["shape"])
+        matrix = sparse.csr_matrix(
+            (mmap("data.npy"), mmap("indices.npy"), mmap("indptr.npy")),
+            shape=shape, copy=False)
+        columns = sparse.csc_matrix(
+            (mmap("csc_data.npy"), mmap("csc_indices.npy"),
+             mmap("csc_indptr.npy")), shape=shape, copy=False)
+        with open(path.joinpath("names.json"), encoding="utf-8") as f:
+            names = json.load(f)
+        return Features(matrix, mmap("ncodes.npy"), names, columns,
+                        current["version"])
+
+
+def store_dirname() -> str:
+    return str(pathlib.Path(narou.dirname).joinpath("features"))
+
+
+def load_features(cache: storage.Storage,
+                  manifest: Optional[Manifest] = None) -> Features:
+    """
+    変わった区分の特徴量を作りなおしてから、特徴量を読み込む
+
+    Parameters
+    ----------
+    cache: storage.Storage
+        作品情報のキャッシュ
+    manifest: Manifest, default None
+        区分ごとの取得状況の目録
+
+    Returns
+    -------
+    Features
+        キャッシュにあるすべての作品の特徴量
+    """
+    store = FeatureStore(store_dirname())
+    store.build(cache, manifest)
+    features = store.load()
+    assert features is not None
+    return features
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="キャッシュから作品の特徴量を作って保存する")
+    parser.add_argument("--storage", choices=storage.storage_kinds,
+                        default="sqlite", help="キャッシュの保存先")
+    parser.add_argument("--force", action="store_true",
+                        help="すべての区分の特徴量を作りなおす")
+    args = parser.parse_args()
+    narou.set_storage(args.storage)
+    store = FeatureStore(store_dirname())
+    start = time.perf_counter()
+    rebuilt = store.build(narou.cache, narou.manifest, args.force)
+    current = store.current()
+    print("rebuilt {0} partitions in {1:.1f}s, {2}".format(
+        rebuilt, time.perf_counter() - start,
+        None if current is None else current["shape"]))
+
+
+if __name__ == "__main__":
+    main()
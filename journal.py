@@ -0,0 +1,202 @@
+# 中断した取得を途中から再開するための、取得済みの単位の記録
+
+import json
+import os
+import pathlib
+import shutil
+import time
+from typing import List, Dict, Any, Optional, Set
+import pandas
+import storage
+
+
+class JournalWriter(storage.Writer):
+    """
+    取得したページを区分の一時ディレクトリに保存しながら書き込むWriter
+
+    checkpointを呼ぶと、それまでに書き込んだ作品情報を1ページ分として
+    一時ファイルに書き出してから名前を変え、取得済みの単位を記録簿に追記する。
+    commitで保存したページをまとめて元のWriterへ流し込み、区分を置き換える。
+    abortしたときはページを残すので、次回の取得で済んだ単位を飛ばせる。
+    """
+
+    def __init__(self, dirname: pathlib.Path, writer: storage.Writer,
+                 resume: bool) -> None:
+        """
+        Parameters
+        ----------
+        dirname: pathlib.Path
+            区分のページを保存するディレクトリ
+        writer: storage.Writer
+            commitのときに書き込む区分のWriter
+        resume: bool
+            Trueなら前回保存したページを使う、Falseなら捨ててやり直す
+        """
+        self.dirname = dirname
+        self.writer = writer
+        if not resume:
+            shutil.rmtree(str(dirname), ignore_errors=True)
+        dirname.mkdir(parents=True, exist_ok=True)
+        self.filename = dirname.joinpath("journal.jsonl")
+        self.records = JournalWriter.load(self.filename)
+        self.units = {record["unit"] for record in self.records}
+        self.buffer: List[pandas.DataFrame] = []
+
+    @staticmethod
+    def load(filename: pathlib.Path) -> List[Dict[str, Any]]:
+        """
+        記録簿を読み込む、追記の途中で落ちた最後の行は無視する
+        """
+        records = []
+        try:
+            with open(filename, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+        except FileNotFoundError:
+            pass
+        return records
+
+    def write(self, df: pandas.DataFrame) -> None:
+        self.buffer.append(df)
+
+    def completed(self, unit: str) -> bool:
+        return unit in self.units
+
+    def checkpoint(self, unit: str) -> None:
+        df = storage.concat(self.buffer)
+        self.buffer = []
+        page = "{0:05d}.pkl".format(len(self.records))
+        path = self.dirname.joinpath(page)
+        tmppath = path.with_name(page + ".tmp")
+        df.to_pickle(str(tmppath))
+        os.replace(str(tmppath), str(path))
+        record = {"unit": unit, "page": page, "rows": len(df)}
+        with open(self.filename, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.records.append(record)
+        self.units.add(unit)
+
+    def commit(self) -> None:
+        # 区切られなかった残りも1ページとして扱う
+        if self.buffer:
+            self.checkpoint("")
+        # 再開の前後で分割が変わると同じ作品を2回取得しうるので、
+        # ncodeで重複を除く
+        seen: Set[str] = set()
+        for record in self.records:
+            df = pandas.read_pickle(str(self.dirname.joinpath(
+                record["page"])))
+            if "ncode" in df.columns:
+                df = df[~df["ncode"].isin(seen)]
+                seen.update(df["ncode"])
+            self.writer.write(df)
+            self.written += len(df)
+        self.writer.commit()
+        shutil.rmtree(str(self.dirname), ignore_errors=True)
+
+    def abort(self) -> None:
+        self.buffer = []
+        self.writer.abort()
+
+
+class Journal:
+    """
+    全区分の取得の進み具合を記録する記録簿
+
+    取得を始めた時刻をrun.jsonに記録し、区分ごとのディレクトリに、
+    取得済みのページとその記録を保存する。
+    再開するときは前回の開始時刻を使うので、それ以降に取得し終えた区分を
+    飛ばせる。
+    """
+
+    def __init__(self, dirname: str) -> None:
+        """
+        Parameters
+        ----------
+        dirname: str
+            記録簿のディレクトリ
+        """
+        self.dirname = pathlib.Path(dirname)
+        # 取得を始めた時刻（unixtime）、startするまではNone
+        self.started_at: Optional[int] = None
+        self.resume = False
+
+    def start(self, resume: bool = False) -> int:
+        """
+        全区分の取得を始める
+
+        Parameters
+        ----------
+        resume: bool, default False
+            Trueなら前回の取得の続きとして始める
+            Falseなら前回の途中のページを捨てて、新しく始める
+
+        Returns
+        -------
+        int
+            取得を始めた時刻（unixtime）、再開のときは前回の開始時刻
+        """
+        path = self.dirname.joinpath("run.json")
+        self.resume = resume
+        started_at = None
+        if resume:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    started_at = int(json.load(f)["started_at"])
+            except (FileNotFoundError, ValueError, KeyError):
+                pass
+        if started_at is None:
+            shutil.rmtree(str(self.dirname), ignore_errors=True)
+            self.dirname.mkdir(parents=True, exist_ok=True)
+            started_at = int(time.time())
+            tmppath = path.with_name(path.name + ".tmp")
+            with open(tmppath, "w", encoding="utf-8") as f:
+                json.dump({"started_at": started_at}, f)
+            os.replace(str(tmppath), str(path))
+        self.started_at = started_at
+        return started_at
+
+    def finished(self, entry: Optional[Dict[str, Any]]) -> bool:
+        """
+        目録の記録から、区分が今回の取得で取得済みかを返す
+
+        Parameters
+        ----------
+        entry: Dict[str, Any] or None
+            区分の目録の記録
+
+        Returns
+        -------
+        bool
+            再開した取得で、開始時刻以降に取得を終えていればTrue
+        """
+        if not self.resume or self.started_at is None or entry is None:
+            return False
+        # 更新された作品がなかった差分取得は、verified_atだけを記録する
+        done = max(int(entry.get("synced_at", 0)),
+                   int(entry.get("verified_at", 0)))
+        return done >= self.started_at
+
+    def writer(self, key: str, writer: storage.Writer) -> JournalWriter:
+        """
+        区分のページを記録しながら書き込むWriterを返す
+
+        Parameters
+        ----------
+        key: str
+            区分のキー
+        writer: storage.Writer
+            区分のキャッシュのWriter
+
+        Returns
+        -------
+        JournalWriter
+            commitでwriterへまとめて書き込むWriter
+        """
+        return JournalWriter(self.dirname.joinpath(key), writer,
+                             self.resume)
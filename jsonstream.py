@@ -0,0 +1,95 @@
+# gzip圧縮されたJSON配列を、少しずつ展開して要素ごとに取り出す
+
+import codecs
+import json
+import zlib
+from typing import Iterable, Iterator, Any
+
+
+# 一度に展開するバイト数の上限
+chunk_size = 64 * 1024
+
+
+def gunzip(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    gzip圧縮されたバイト列を少しずつ展開する
+
+    1回に返す展開後のバイト列はchunk_size以下になる。
+    そのため、圧縮率が高くても展開後のデータ全体をメモリに持たない。
+
+    Parameters
+    ----------
+    chunks: Iterable[bytes]
+        gzip圧縮されたバイト列を分割したもの
+
+    Returns
+    -------
+    Iterator[bytes]
+        展開したバイト列
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = decompressor.decompress(chunk, chunk_size)
+        while len(data) > 0:
+            yield data
+            data = decompressor.decompress(
+                decompressor.unconsumed_tail, chunk_size)
+    data = decompressor.flush()
+    if len(data) > 0:
+        yield data
+
+
+def iter_array(chunks: Iterable[bytes]) -> Iterator[Any]:
+    """
+    UTF-8のJSON配列を分割したバイト列から、要素を1つずつ取り出す
+
+    バッファには、読みかけの要素1つと次に読むバイト列しか持たない。
+
+    Parameters
+    ----------
+    chunks: Iterable[bytes]
+        UTF-8のJSON配列を分割したもの
+
+    Returns
+    -------
+    Iterator[Any]
+        配列の要素
+
+    Raises
+    ------
+    ValueError
+        JSON配列として読めなかったとき
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    started = False             # 配列の開き括弧を読んだか
+    finished = False            # 配列の閉じ括弧を読んだか
+    for chunk in chunks:
+        buffer += utf8.decode(chunk)
+        index = 0
+        while True:
+            # 空白と区切りのカンマを読み飛ばす
+            while index < len(buffer) and buffer[index] in " \t\r\n,":
+                index += 1
+            if index == len(buffer) or finished:
+                break
+            if not started:
+                if buffer[index] != "[":
+                    raise ValueError("JSON array is expected")
+                started = True
+                index += 1
+                continue
+            if buffer[index] == "]":
+                finished = True
+                index += 1
+                continue
+            try:
+                element, index = decoder.raw_decode(buffer, index)
+            except json.JSONDecodeError:
+                break           # 要素が途中で切れているので続きを読む
+            yield element
+        buffer = buffer[index:]
+    buffer += utf8.decode(b"", final=True)
+    if not finished or buffer.strip() != "":
+        raise ValueError("JSON array is truncated or has trailing data")
@@ -0,0 +1,144 @@
+# ncodeを指定してなろう小説の情報を取得し、ディスクにキャッシュする
+
+import json
+import pathlib
+import sqlite3
+import time
+import pandas
+from typing import List, Dict, Any, Optional
+import narou
+
+
+class NcodeLookup:
+    """
+    ncodeのリストから小説情報をまとめて引くためのオブジェクト
+
+    キャッシュにない小説は、なろう小説APIのncodeパラメータにハイフンで
+    つないだ複数のncodeを与えて、まとめて取得する。
+    取得した小説情報はSQLiteのファイルにキャッシュする。
+    キャッシュは取得からttl秒で古くなり、次に引いたときに取りなおす。
+    max_entries件を越えると、最後に引かれたのが古いものから消していく。
+
+    Examples
+    --------
+    >>> bookmarks = NarouBookmark().get()
+    >>> df = NcodeLookup().get(list(bookmarks["ncode"]))
+    """
+
+    def __init__(self,
+                 filename: Optional[str] = None,
+                 ttl: float = 7 * 24 * 60 * 60,
+                 max_entries: int = 100000,
+                 batch_size: int = 100) -> None:
+        """
+        Parameters
+        ----------
+        filename: str, default None
+            キャッシュのファイル、Noneのときはoutputディレクトリのlookup.sqlite3
+        ttl: float, default 1週間
+            キャッシュした小説情報を使う期間[s]
+        max_entries: int, default 100000
+            キャッシュする小説の最大数
+        batch_size: int, default 100
+            1回のリクエストで取得する小説の数、APIの制限により500以下
+        """
+        if filename is None:
+            filename = str(pathlib.Path(narou.dirname).joinpath(
+                "lookup.sqlite3"))
+        self.filename = filename
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.batch_size = min(batch_size, 500)
+
+    def connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.filename, timeout=60)
+        con.execute("CREATE TABLE IF NOT EXISTS novels ("
+                    "ncode TEXT PRIMARY KEY, data TEXT, "
+                    "fetched_at REAL, accessed_at REAL)")
+        con.execute("CREATE INDEX IF NOT EXISTS novels_accessed_at "
+                    "ON novels (accessed_at)")
+        return con
+
+    def get(self, ncodes: List[str]) -> pandas.DataFrame:
+        """
+        ncodeのリストに対応する小説情報を返す
+
+        Parameters
+        ----------
+        ncodes: List[str]
+            小説のncode、大文字小文字は問わない
+
+        Returns
+        -------
+        pandas.DataFrame
+            小説情報、列はなろう小説APIが返す項目名
+            行はncodesの順で、重複したncodeは1行にまとめる。
+            削除された小説など、APIが返さなかったncodeの行は含まない。
+        """
+        ncodes = list(dict.fromkeys(ncode.upper() for ncode in ncodes))
+        now = time.time()
+        con = self.connect()
+        try:
+            with con:
+                found = self.load(con, ncodes, now)
+                missing = [ncode for ncode in ncodes if ncode not in found]
+            for i in range(0, len(missing), self.batch_size):
+                batch = missing[i:i + self.batch_size]
+                rows = self.fetch(batch)
+                with con:
+                    self.store(con, rows, time.time())
+                found.update((str(row["ncode"]).upper(), row) for row in rows)
+            with con:
+                self.evict(con)
+        finally:
+            con.close()
+        rows = [found[ncode] for ncode in ncodes if ncode in found]
+        return pandas.DataFrame.from_records(rows)
+
+    def load(self, con: sqlite3.Connection, ncodes: List[str],
+             now: float) -> Dict[str, Dict[str, Any]]:
+        """
+        キャッシュから期限内の小説情報を読み、最後に引いた時刻を更新する
+        """
+        found: Dict[str, Dict[str, Any]] = {}
+        # SQLiteのパラメータ数の制限に収まるよう分けて問い合わせる
+        for i in range(0, len(ncodes), 500):
+            batch = ncodes[i:i + 500]
+            sql = "SELECT ncode, data FROM novels WHERE fetched_at >= ? " \
+                "AND ncode IN ({0})".format(", ".join("?" for _ in batch))
+            params: List[Any] = [now - self.ttl]
+            for ncode, data in con.execute(sql, params + batch):
+                found[ncode] = json.loads(data)
+            con.executemany("UPDATE novels SET accessed_at = ? "
+                            "WHERE ncode = ?",
+                            ((now, ncode) for ncode in batch
+                             if ncode in found))
+        return found
+
+    def fetch(self, ncodes: List[str]) -> List[Dict[str, Any]]:
+        """
+        なろう小説APIから小説情報をまとめて取得する
+        """
+        get_params: Dict[str, Any] = {
+            "ncode": "-".join(ncodes), "lim": len(ncodes)
+        }
+        jsondata = narou.get_jsondata(get_params)
+        narou.delay(1)
+        return [elem for elem in jsondata if "allcount" not in elem]
+
+    def store(self, con: sqlite3.Connection,
+              rows: List[Dict[str, Any]], now: float) -> None:
+        con.executemany(
+            "INSERT OR REPLACE INTO novels VALUES (?, ?, ?, ?)",
+            ((str(row["ncode"]).upper(), json.dumps(row, ensure_ascii=False),
+              now, now) for row in rows))
+
+    def evict(self, con: sqlite3.Connection) -> None:
+        """
+        max_entriesを越えた分を、最後に引いた時刻が古いものから消す
+        """
+        count = con.execute("SELECT COUNT(*) FROM novels").fetchone()[0]
+        if count > self.max_entries:
+            con.execute("DELETE FROM novels WHERE ncode IN ("
+                        "SELECT ncode FROM novels ORDER BY accessed_at "
+                        "LIMIT ?)", (count - self.max_entries,))
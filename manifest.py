@@ -0,0 +1,152 @@
+# キャッシュした区分ごとの取得状況を記録する
+
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import Dict, Any, Optional
+
+
+# touchで更新した記録を、ファイルに書き出すまでに待つ最長の時間[s]
+flush_seconds = 60.0
+
+
+class Manifest:
+    """
+    区分ごとの取得状況をJSONファイルに記録する目録
+
+    キャッシュの中身を読まずに、前回の取得状況を確認するために使う。
+    区分のキーごとに、以下のような項目を記録する。
+      count: キャッシュしている作品数
+      fetched_at: 取得した時刻（unixtime）
+      written_at: 差分取得や項目の補完で、区分を書き換えた時刻（unixtime）
+      synced_at: 次の差分取得の起点にする、前回の取得を始めた時刻（unixtime）
+      verified_at: 取得しなおす必要がないと確かめた時刻（unixtime）
+      allcount: 取得したときになろう小説APIが返した全作品数
+      lengths: 取得に使った作品長さの分割、分割していなければ空のリスト
+
+    更新するたびに一時ファイルへ書き出してから置き換えるので、
+    途中で落ちても壊れたファイルは残らない。
+    作品数の観測のように毎回書き換わる記録はtouchで更新し、
+    flush_secondsごとかflushを呼んだときにまとめて書き出す。
+    """
+
+    def __init__(self, filename: str) -> None:
+        """
+        Parameters
+        ----------
+        filename: str
+            目録のJSONファイルのパス
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.entries: Optional[Dict[str, Dict[str, Any]]] = None
+        self.dirty = False      # 書き出していないtouchがある
+        self.saved_at = time.monotonic()
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        """
+        目録を読み込む、一度読み込んだらメモリ上のものを使う
+
+        Returns
+        -------
+        Dict[str, Dict[str, Any]]
+            区分のキーから取得状況への辞書
+        """
+        if self.entries is None:
+            try:
+                with open(self.filename, encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except FileNotFoundError:
+                self.entries = {}
+        return self.entries
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        区分の取得状況を返す
+
+        Parameters
+        ----------
+        key: str
+            区分のキー
+
+        Returns
+        -------
+        Dict[str, Any] or None
+            区分の取得状況、記録がなければNone
+        """
+        with self.lock:
+            entry = self.load().get(key)
+            return None if entry is None else dict(entry)
+
+    def update(self, key: str, **fields: Any) -> None:
+        """
+        区分の取得状況を更新してファイルに書き出す
+
+        Parameters
+        ----------
+        key: str
+            区分のキー
+        **fields
+            更新する項目、与えなかった項目は前回の値が残る
+        """
+        with self.lock:
+            entries = self.load()
+            entry = entries.setdefault(key, {})
+            entry.update(fields)
+            self.save()
+
+    def touch(self, key: str, **fields: Any) -> None:
+        """
+        区分の取得状況をメモリ上で更新し、ファイルへはまとめて書き出す
+
+        前回の書き出しからflush_seconds以上たっていれば書き出す。
+        updateやflushを呼んだときにも、まとめて書き出される。
+
+        Parameters
+        ----------
+        key: str
+            区分のキー
+        **fields
+            更新する項目、与えなかった項目は前回の値が残る
+        """
+        with self.lock:
+            entries = self.load()
+            entries.setdefault(key, {}).update(fields)
+            self.dirty = True
+            if time.monotonic() - self.saved_at >= flush_seconds:
+                self.save()
+
+    def flush(self) -> None:
+        """
+        touchで更新して、まだ書き出していない記録をファイルに書き出す
+        """
+        with self.lock:
+            if self.dirty:
+                self.save()
+
+    def remove(self, key: str) -> None:
+        """
+        区分の記録を消してファイルに書き出す
+
+        Parameters
+        ----------
+        key: str
+            区分のキー
+        """
+        with self.lock:
+            entries = self.load()
+            if entries.pop(key, None) is not None:
+                self.save()
+
+    def save(self) -> None:
+        path = pathlib.Path(self.filename)
+        tmppath = path.with_name(path.name + ".tmp")
+        # indentを指定するとCの実装が使われず遅いので、1行で書き出す
+        data = json.dumps(self.entries, ensure_ascii=False, sort_keys=True)
+        with open(tmppath, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(str(tmppath), str(path))
+        self.dirty = False
+        self.saved_at = time.monotonic()
@@ -0,0 +1,280 @@
+# 取得にかかった時間や通信量を区分ごとに集計して書き出す
+
+import bisect
+import contextlib
+import functools
+import json
+import os
+import pathlib
+import threading
+import time
+from typing import (
+    Dict, List, Tuple, Any, Callable, Iterable, Iterator, TypeVar, cast
+)
+
+
+# 時間のヒストグラムのバケットの上限[s]
+default_buckets = [
+    0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0
+]
+
+F = TypeVar("F", bound=Callable[..., Any])
+
+
+class Histogram:
+    """
+    観測値をバケットごとに数えるヒストグラム
+    """
+
+    def __init__(self, buckets: List[float]) -> None:
+        """
+        Parameters
+        ----------
+        buckets: List[float]
+            昇順に並べたバケットの上限、これを超える値は最後の+Infに入る
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """
+        Prometheusと同じく、上限以下の観測数を累積して返す
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            total += count
+            result.append(("+Inf" if bound == float("inf")
+                           else "{0:g}".format(bound), total))
+        return result
+
+
+class Metrics:
+    """
+    区分ごとのカウンタとヒストグラムを集める
+
+    partitionで区分を指定すると、同じスレッドで記録した値はその区分に入る。
+    並列取得では区分ごとにスレッドが違うので、区分の値は混ざらない。
+    区分の外で記録した値は、区分のキーが空文字列の値になる。
+    """
+
+    def __init__(self, buckets: List[float] = default_buckets) -> None:
+        """
+        Parameters
+        ----------
+        buckets: List[float], default default_buckets
+            ヒストグラムのバケットの上限
+        """
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.counters: Dict[Tuple[str, str], float] = {}
+        self.histograms: Dict[Tuple[str, str], Histogram] = {}
+
+    def reset(self) -> None:
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def current_partition(self) -> str:
+        return getattr(self.local, "partition", "")
+
+    @contextlib.contextmanager
+    def partition(self, key: str) -> Iterator[None]:
+        """
+        with文の中で記録した値を、区分keyの値にする
+        """
+        previous = self.current_partition()
+        self.local.partition = key
+        try:
+            yield
+        finally:
+            self.local.partition = previous
+
+    def add(self, name: str, value: float = 1.0) -> None:
+        """
+        カウンタに値を足す
+        """
+        key = (name, self.current_partition())
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0.0) + value
+
+    def total(self, name: str) -> float:
+        """
+        カウンタの、すべての区分の合計を返す
+        """
+        with self.lock:
+            return sum(value for (n, _), value in self.counters.items()
+                       if n == name)
+
+    def observe(self, name: str, value: float) -> None:
+        """
+        ヒストグラムに値を記録する
+        """
+        key = (name, self.current_partition())
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(self.buckets)
+            self.histograms[key].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """
+        with文の中にかかった時間[s]をヒストグラムに記録する
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name: str) -> Callable[[F], F]:
+        """
+        関数の呼び出しにかかった時間をヒストグラムに記録するデコレータ
+        """
+        def decorator(func: F) -> F:
+            @functools.wraps(func)
+            def wrapper(*args: Any, **kwargs: Any) -> Any:
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return cast(F, wrapper)
+        return decorator
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """
+        区分ごとの値を、JSONに書き出せる辞書にして返す
+
+        区分ごとにcounters、histograms、rows_per_secondを持つ。
+        rows_per_secondは、rowsカウンタをpartition_secondsの合計で割った値。
+        全区分の合計は"total"に入る。
+
+        Returns
+        -------
+        Dict[str, Dict[str, Any]]
+            区分のキーから、その区分の値への辞書
+        """
+        result: Dict[str, Dict[str, Any]] = {}
+
+        def entry(partition: str) -> Dict[str, Any]:
+            return result.setdefault(partition,
+                                     {"counters": {}, "histograms": {}})
+
+        with self.lock:
+            for (name, partition), value in self.counters.items():
+                for p in {partition or "total", "total"}:
+                    counters = entry(p)["counters"]
+                    counters[name] = counters.get(name, 0.0) + value
+            for (name, partition), histogram in self.histograms.items():
+                for p in {partition or "total", "total"}:
+                    histograms = entry(p)["histograms"]
+                    h = histograms.setdefault(
+                        name, {"count": 0, "sum": 0.0,
+                               "buckets": [0] * len(histogram.counts)})
+                    h["count"] += histogram.count
+                    h["sum"] += histogram.sum
+                    h["buckets"] = [a + b for a, b in zip(
+                        h["buckets"], histogram.counts)]
+        bounds = ["{0:g}".format(b) for b in self.buckets] + ["+Inf"]
+        for values in result.values():
+            for h in values["histograms"].values():
+                h["buckets"] = dict(zip(bounds, h["buckets"]))
+            rows = values["counters"].get("rows", 0.0)
+            seconds = values["histograms"].get(
+                "partition_seconds", {}).get("sum", 0.0)
+            if rows > 0 and seconds > 0:
+                values["rows_per_second"] = rows / seconds
+        return result
+
+    def to_prometheus(self, prefix: str = "narou_") -> str:
+        """
+        Prometheusのテキスト形式にして返す
+
+        区分はpartitionラベルになる。
+
+        Parameters
+        ----------
+        prefix: str, default "narou_"
+            メトリクス名の接頭辞
+
+        Returns
+        -------
+        str
+            Prometheusのテキスト形式の文字列
+        """
+        lines: List[str] = []
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, h.cumulative(), h.count, h.sum)
+                for key, h in self.histograms.items())
+        typed = set()
+        for (name, partition), value in counters:
+            metric = prefix + name + "_total"
+            if metric not in typed:
+                lines.append("# TYPE {0} counter".format(metric))
+                typed.add(metric)
+            lines.append('{0}{{partition="{1}"}} {2:g}'.format(
+                metric, partition, value))
+        for (name, partition), buckets, count, total in histograms:
+            metric = prefix + name
+            if metric not in typed:
+                lines.append("# TYPE {0} histogram".format(metric))
+                typed.add(metric)
+            for le, n in buckets:
+                lines.append('{0}_bucket{{partition="{1}",le="{2}"}} {3}'
+                             .format(metric, partition, le, n))
+            lines.append('{0}_sum{{partition="{1}"}} {2:g}'.format(
+                metric, partition, total))
+            lines.append('{0}_count{{partition="{1}"}} {2}'.format(
+                metric, partition, count))
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename: str) -> None:
+        """
+        ファイルに書き出す、拡張子が.promならPrometheus形式、それ以外はJSON
+
+        一時ファイルに書き出してから置き換えるので、読む側は書きかけの
+        ファイルを見ない。
+        """
+        path = pathlib.Path(filename)
+        if path.suffix == ".prom":
+            data = self.to_prometheus()
+        else:
+            data = json.dumps(self.snapshot(), ensure_ascii=False,
+                              sort_keys=True)
+        tmppath = path.with_name(path.name + ".tmp")
+        with open(tmppath, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(str(tmppath), str(path))
+
+
+def timed_iter(iterable: Iterable[Any], elapsed: List[float]
+               ) -> Iterator[Any]:
+    """
+    iterableから要素を取り出すのにかかった時間を、elapsed[0]に足していく
+
+    取り出した要素を使う側の時間は含まないので、ストリームの各段の
+    時間を分けて測れる。
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            elapsed[0] += time.perf_counter() - start
+            return
+        elapsed[0] += time.perf_counter() - start
+        yield item
+
+
+# 取得の計測値を集める、プロセスで共有の記録先
+registry = Metrics()
@@ -1,13 +1,23 @@
-import requests
-import gzip
-import json
 import pathlib
 import sys
 import time
 import pandas
 import statistics
 import math
-from typing import List, Dict, Union, Tuple
+import bisect
+import argparse
+import functools
+from concurrent import futures
+from typing import List, Dict, Union, Tuple, Iterator, Iterable, Optional
+from ratelimit import TokenBucket
+import storage
+import metrics
+import profiles
+import scheduler
+from narouapi import NarouAPI, APIError
+from manifest import Manifest
+from journal import Journal
+from ncodeindex import NcodeIndex, read_current, read_all_current
 
 
 dirname = "output"
@@ -27,30 +37,122 @@ kaiwas = [
 buntais = [1, 2, 4, 6]
 types = ["t", "re"]
 
+# 作品情報のキャッシュの保存先
+cache: storage.Storage = storage.open_storage("sqlite", dirname)
+
+# 区分ごとの取得状況の目録
+manifest = Manifest(str(pathlib.Path(dirname).joinpath("manifest.json")))
+
+# 中断した取得を再開するための記録簿
+journal = Journal(str(pathlib.Path(dirname).joinpath("journal")))
+
+# 作品ごとに最新の行を持つ区分の索引
+ncode_index = NcodeIndex(str(pathlib.Path(dirname).joinpath("ncodes.sqlite3")))
+
+# 作品長さで分割して取得するときの、1区間の作品数の上限
+# APIは最大2499件とれるが、取得中に増える分の余裕をもたせる
+slice_max = 2400
+
+# 作品長さの分割を、サンプリングせずにキャッシュから決めるのに必要な作品数
+statistics_min_cached = 100
+
+# 差分取得で、前回の取得時刻からさかのぼって取得する時間[s]
+sync_margin = 3600
+
+# なろう小説APIのクライアント、並列取得時は全スレッドで共有する
+# レートリミッタが設定されていないときは、従来どおりdelayによる
+# 固定時間の待ちでアクセス頻度を抑える
+client = NarouAPI()
+
+# 区分の取得で使うプロファイル、profiles.profilesのキー
+profile = "full"
+
+# 重い項目を補うときに、1回のリクエストで取得する作品数
+backfill_batch = 100
+
+
+def set_storage(kind: str) -> None:
+    """
+    作品情報のキャッシュの保存先を設定する
+
+    保存先ごとに中身が異なるので、目録も保存先ごとのファイルを使う。
+
+    Parameters
+    ----------
+    kind: str
+        保存先の種類、"csv"、"sqlite"、"parquet"のどれか
+    """
+    global cache, manifest, journal, ncode_index
+    cache = storage.open_storage(kind, dirname)
+    suffix = "" if kind == "sqlite" else "_" + kind
+    manifest = Manifest(str(pathlib.Path(dirname).joinpath(
+        "manifest{0}.json".format(suffix))))
+    journal = Journal(str(pathlib.Path(dirname).joinpath(
+        "journal" + suffix)))
+    ncode_index = NcodeIndex(str(pathlib.Path(dirname).joinpath(
+        "ncodes{0}.sqlite3".format(suffix))))
+
+
+def set_profile(name: str) -> None:
+    """
+    区分の取得で、なろう小説APIから取得する項目のプロファイルを設定する
+
+    あらすじなどの重い項目を取得しないプロファイルでは、
+    前回から更新されていない作品の項目を前回のキャッシュから引き継ぐ。
+    新しい作品や更新された作品の項目は欠損値になるので、backfillで補う。
+
+    Parameters
+    ----------
+    name: str
+        プロファイル名、"full"、"light"、"minimal"のどれか
+    """
+    global profile
+    if name not in profiles.profiles:
+        raise ValueError("unknown profile: " + name)
+    profile = name
+
+
+def set_ratelimit(rate: Optional[float], capacity: int = 1) -> None:
+    """
+    なろう小説APIへのリクエスト頻度の上限を設定する
+
+    設定するとget_jsondataの直前でトークンバケットによる待ちが入り、
+    delayによる固定時間の待ちは行われなくなる。
+
+    Parameters
+    ----------
+    rate: float or None
+        1秒あたりのリクエスト数の上限、Noneで制限を解除してdelayに戻す
+    capacity: int, default 1
+        瞬間的に許すリクエスト数
+    """
+    client.limiter = None if rate is None else TokenBucket(rate, capacity)
+
 
 def delay(s: int = 10) -> None:
     """
     なろう小説APIを叩いたあとに一定時間待つ
 
+    レートリミッタが設定されているときは、アクセス頻度はリミッタが
+    管理するため待たない。
+
     Parameters
     ----------
-    s: int, default 3
+    s: int, default 10
         時間[s]
     """
-    time.sleep(s)
+    if client.limiter is None:
+        metrics.registry.add("sleep_seconds", s)
+        time.sleep(s)
 
 
+@metrics.registry.timed("get_jsondata_seconds")
 def get_jsondata(get_params: Dict[str, Union[str, int]]
                  ) -> List[Dict[str, Union[str, int]]]:
     """
     指定したGETパラメータでなろう小説APIからJSONデータを取る
 
-    GETパラメータにはgzip圧縮5、出力json、を追加で指定して通信する。
-
-    アクセスがエラーだった場合は、エラーメッセージを出力して
-    プログラムを終了する。
-    例えば、GETパラメータが不正だったり、ネットワークが落ちていたり、
-    アクセスが拒否されたときに起こる。
+    iter_jsondataの結果をリストにして返す。
 
     Parameters
     ----------
@@ -62,19 +164,36 @@ def get_jsondata(get_params: Dict[str, Union[str, int]]
     json
         APIから帰ってきたJSON
     """
-    get_params = dict(get_params)  # コピー
-    get_params["gzip"] = 5
-    get_params["out"] = "json"
-    api_url = "https://api.syosetu.com/novelapi/api/"
-    res = requests.get(api_url, params=get_params)
-    if res.ok:
-        jsondata: List[Dict[str, Union[str, int]]] = json.loads(
-            gzip.decompress(res.content))
-        return jsondata
-    else:                       # アクセスエラー
-        print("Error: API response is BAD.")
-        print("  request with " + str(get_params))
-        sys.exit(1)
+    return list(iter_jsondata(get_params))
+
+
+def iter_jsondata(get_params: Dict[str, Union[str, int]]
+                  ) -> Iterator[Dict[str, Union[str, int]]]:
+    """
+    指定したGETパラメータでなろう小説APIからJSONデータを1要素ずつ取る
+
+    GETパラメータにはgzip圧縮5、出力json、を追加で指定して通信する。
+    レスポンスは受け取りながら少しずつ展開して、JSON配列の要素を順に返す。
+    そのため、レスポンス全体や展開後のデータ全体をメモリに持たない。
+    先頭の要素は{'allcount': n}になる。
+
+    通信は共有のクライアントを通すので、接続は使い回され、
+    一時的なエラーは待ち時間をおいて再試行される。
+    再試行しても失敗した場合は、APIError例外を投げる。
+    例えば、GETパラメータが不正だったり、ネットワークが長く落ちていたり、
+    アクセスが拒否され続けたときに起こる。
+
+    Parameters
+    ----------
+    get_params: dict
+        なろう小説APIを叩くGETのパラメータ
+
+    Returns
+    -------
+    Iterator[dict]
+        APIから帰ってきたJSON配列の要素
+    """
+    return client.iter_json(get_params)
 
 
 def get_allcount(get_params: Dict[str, Union[str, int]]) -> int:
@@ -105,35 +224,46 @@ def get_allcount(get_params: Dict[str, Union[str, int]]) -> int:
         raise TypeError
 
 
-def write_json(jsondata: List[Dict[str, Union[str, int]]],
-               filename: str
+def write_json(jsondata: Iterable[Dict[str, Union[str, int]]],
+               writer: storage.Writer
                ) -> None:
     """
-    なろう小説APIにて取得したJSONデータをファイルに書き込む関数
+    なろう小説APIにて取得したJSONデータをキャッシュに書き込む関数
 
-    JSONデータをpandasにて取り込みを経由してCSVへと変換して追記で書き込む。
+    JSONデータの要素を1つずつ、キャッシュのWriterへ流し込む。
     なろう小説APIから帰ってきたallcountを含むデータを、JSONデータとして与える。
-    保存されたファイルはヘッダーつきのcsvファイルになる。
+    iter_jsondataの結果を与えれば、ページ全体をメモリに持たずに書き込める。
 
     Parameters
     ----------
-    jsondata: dict
+    jsondata: Iterable[dict]
         なろう小説APIにて取得したJSONデータ
-    filename: str
-        保存先のファイル名
+    writer: storage.Writer
+        書き込み先の区分のWriter
     """
-    if len(jsondata) == 1:  # [{'allcount': 0}]のとき
-        return
-    else:
-        jsondata = jsondata[1:]  # 先頭の{'allcount': n}を削る
-        df = pandas.io.json.json_normalize(jsondata)
-        header = not(pathlib.Path(filename).exists)
-        df.to_csv(filename, index=False, header=header, mode="a")
-
-
-def make_filename(genre: str, kaiwa: str, buntai: int, ty: str) -> str:
+    # 先頭の{'allcount': n}を除く
+    rows = (elem for elem in jsondata if "allcount" not in elem)
+    # APIから読む時間を除いて、書き込みにかかった時間を測る
+    reading = [0.0]
+    counted = [0]
+
+    def count(rows: Iterator[Dict[str, Union[str, int]]]
+              ) -> Iterator[Dict[str, Union[str, int]]]:
+        for row in rows:
+            counted[0] += 1
+            yield row
+
+    start = time.perf_counter()
+    writer.write_rows(count(metrics.timed_iter(rows, reading)))
+    total = time.perf_counter() - start
+    metrics.registry.observe("write_json_seconds", total)
+    metrics.registry.add("write_seconds", total - reading[0])
+    metrics.registry.add("rows", counted[0])
+
+
+def make_key(genre: str, kaiwa: str, buntai: int, ty: str) -> str:
     """
-    なろう小説の情報が出力されるファイル名を作成する
+    なろう小説の情報をキャッシュする区分のキーを作成する
 
     Parameters
     ----------
@@ -149,66 +279,136 @@ def make_filename(genre: str, kaiwa: str, buntai: int, ty: str) -> str:
     Returns
     -------
     str
-        ファイルのパス、'output/201_0-10_1_re.csv'のような形式
+        区分のキー、'201_0-10_1_re'のような形式
     """
-    filename = "{0}_{1}_{2}_{3}.csv".format(genre, kaiwa,
-                                            buntai, ty)
-    filename = str(pathlib.Path(dirname).joinpath(filename))
-    return filename
+    return "{0}_{1}_{2}_{3}".format(genre, kaiwa, buntai, ty)
+
 
+def select_keys(genres: Optional[Iterable[str]] = None,
+                kaiwas: Optional[Iterable[str]] = None,
+                buntais: Optional[Iterable[int]] = None,
+                types: Optional[Iterable[str]] = None) -> List[str]:
+    """
+    キャッシュが存在する区分のうち、条件に合う区分のキーを返す
+
+    Parameters
+    ----------
+    genres: Iterable[str], default None
+        ジャンル、"201"など、Noneのときはすべて
+    kaiwas: Iterable[str], default None
+        会話率、"0-10"など、Noneのときはすべて
+    buntais: Iterable[int], default None
+        文体、1/2/4/6、Noneのときはすべて
+    types: Iterable[str], default None
+        小説のタイプ、"t"または"re"、Noneのときはすべて
 
-def read_allcaches() -> pandas.DataFrame:
+    Returns
+    -------
+    List[str]
+        条件に合う区分のキー
+    """
+    conditions = [None if values is None else set(str(v) for v in values)
+                  for values in (genres, kaiwas, buntais, types)]
+    keys = []
+    for key in cache.keys():
+        parts = key.split("_")
+        if all(values is None or part in values
+               for part, values in zip(parts, conditions)):
+            keys.append(key)
+    return keys
+
+
+def read_allcaches(columns: Optional[List[str]] = None,
+                   keys: Optional[List[str]] = None,
+                   processes: Optional[int] = 1,
+                   dedup: bool = True) -> pandas.DataFrame:
     """
     キャッシュされているすべてのなろう小説の情報を取得する
 
-    返すDataFrameには、なろう小説APIが返すインデックスがつく。
+    返すDataFrameのインデックスは0からの連番になる。
+    会話率などが変わって複数の区分にある作品は、ncodeの索引が指す
+    最新の行だけを返す。
+
+    Parameters
+    ----------
+    columns: List[str], default None
+        読み込む列、Noneのときはすべての列
+    keys: List[str], default None
+        読み込む区分のキー、select_keysで絞り込む、Noneのときはすべて
+    processes: int, default 1
+        区分を並列に読み込むプロセスの数、Noneのときはコア数
+        1のときやSQLiteのキャッシュは、並列にせずまとめて1回で読む
+    dedup: bool, default True
+        Falseのときは、索引を使わずすべての行を返す
 
     Returns
     -------
     pandas.DataFrame
         キャッシュされているすべてのなろう小説の情報
     """
-    df = pandas.DataFrame()     # Empty DataFrame
-    for genre in genres:
-        for kaiwa in kaiwas:
-            for buntai in buntais:
-                for ty in types:
-                    filename = make_filename(genre, kaiwa, buntai, ty)
-                    try:
-                        cache_df = pandas.read_csv(filename)
-                        df = df.append(cache_df)
-                    except FileNotFoundError:
-                        pass
-    return df
+    if cache.bulk_read or processes == 1:
+        # 区分ごとに読まず、まとめて1回で読んで1回で重複を除く
+        if not dedup:
+            return cache.read(keys, columns)
+        return read_all_current(cache, keys, columns, ncode_index)
+    if not dedup:
+        return storage.read_parallel(cache, keys, columns, processes)
+    return storage.read_parallel(
+        cache, keys, columns, processes,
+        functools.partial(read_current, index=ncode_index))
+
+
+def read_novel(ncode: str) -> Optional[pandas.Series]:
+    """
+    ncodeの作品の最新の情報を、索引が指す区分だけを読んで返す
 
+    Parameters
+    ----------
+    ncode: str
+        作品のncode、大文字小文字は問わない
 
-def count_cache(filename: str) -> int:
+    Returns
+    -------
+    pandas.Series or None
+        作品の情報、索引になければNone
     """
-    キャッシュしている作品数を返す
+    found = ncode_index.get(ncode)
+    if found is None:
+        return None
+    df = cache.read([found[0]])
+    df = df[df["ncode"].astype(str).str.upper() == ncode.upper()]
+    return None if len(df) == 0 else df.iloc[-1]
+
 
-    作品情報のcsvファイルは先頭行にヘッダーが入っている前提でカウントする。
+@metrics.registry.timed("count_cache_seconds")
+def count_cache(key: str) -> int:
+    """
+    キャッシュしている作品数を返す
 
-    作品情報のcsvファイルは改行を含んだ文字列を持っているため、ファイルの
-    行数カウントとこの関数の結果は一致しない。
+    目録に記録があれば、キャッシュの中身は読まずにその作品数を返す。
+    記録がなければキャッシュを数えて、目録に記録しておく。
 
     Parameters
     ----------
-    filename: str
-        作品情報をキャッシュしているcsvファイルの名前
+    key: str
+        作品情報をキャッシュしている区分のキー
 
     Returns
     -------
     int
         キャッシュしている作品数
-        キャッシュファイルが存在しないときは0を返す。
+        キャッシュが存在しないときは0を返す。
     """
-    try:
-        df = pandas.read_csv(filename)
-        return len(df)
-    except FileNotFoundError:
-        return 0
+    entry = manifest.get(key)
+    if entry is not None and "count" in entry:
+        return int(entry["count"])
+    count = cache.count(key)
+    if count > 0:
+        manifest.update(key, count=count)
+    return count
 
 
+@metrics.registry.timed("get_statistics_seconds")
 def get_statistics(get_params: Dict[str, Union[str, int]]
                    ) -> Tuple[int, float]:
     """
@@ -241,16 +441,17 @@ def get_statistics(get_params: Dict[str, Union[str, int]]
         get_params["st"] = 500 * i + 1
         jsondata = get_jsondata(get_params)
         jsondata = jsondata[1:]     # 先頭のallcountを削る
-        length = [elem["length"] for elem in jsondata]
-        if isinstance(length, int):
-            lengths += length
-        else:
-            raise TypeError
+        for elem in jsondata:
+            length = elem["length"]
+            if isinstance(length, int):
+                lengths.append(length)
+            else:
+                raise TypeError
         delay()
     # 中央値を取る
     median = round(statistics.median(lengths))
-    # logスケールでの標準偏差をとる
-    log_lengths = [math.log(l) for l in lengths]
+    # logスケールでの標準偏差をとる、長さ0の作品はlogが取れないので1とみなす
+    log_lengths = [math.log(max(length, 1)) for length in lengths]
     log_stdev = statistics.stdev(log_lengths)
     return (median, log_stdev)
 
@@ -286,26 +487,9 @@ def make_splitlengths(allcount: int,
     List[str]
         なろう小説APIのパラメータのlengthに与えることができる文字列のリスト
     """
-    # HACK:
-    #   この固定値sigma_biasesは標準正規分布における累積分布の表から求めた。
-    #   この数値によって正規分布に従うデータをおおよそ2^n等分できる。
-    #   表のURLは
-    #     https://www.koka.ac.jp/morigiwa/sjs/standard_normal_distribution.htm
-    #   現状、全作品数に対して約24000件までの対応としている。
-    #   それを越えると下記配列siguma_biasesの範囲外アクセスとなる。
-    #   2019/09/05現在、なろう小説APIから帰ってくる全件数は、GETパラメータの調整で
-    #   12000件ほどまで抑えられている。
-    #   そのため、しばらくはこの制限を越えることはないと思われる。
-    sigma_biases: List[List[float]] = [
-        [0],
-        [-0.68, 0, 0.68],
-        [-1.16, -0.68, -0.32, 0, 0.32, 0.68, 1.16],
-        [-1.54, -1.16, -0.89, -0.68, -0.49, -0.32, -0.16, 0,
-         0.16, 0.32, 0.49, 0.68, 0.89, 1.16, 1.54]
-    ]
-    split_n = allcount / 1500  # APIは最大2499件とれるが、余裕ある1500件を狙う
-    split_index = math.ceil(math.log2(split_n)) - 1  # n分割以上となる2^m分割
-    sigma_bias = sigma_biases[split_index]
+    split_m = split_exponent(allcount)
+    sigma_bias = [inverse_normal_cdf(i / 2 ** split_m)
+                  for i in range(1, 2 ** split_m)]
     split_lengths = [round(median * math.exp(log_stdev * bias))
                      for bias in sigma_bias]
     starts = [""] + [str(start + 1) for start in split_lengths]
@@ -314,9 +498,268 @@ def make_splitlengths(allcount: int,
     return ranges
 
 
+def split_exponent(allcount: int) -> int:
+    """
+    各区間が1500件前後になるよう2^m分割するときの、mを返す
+    """
+    split_n = allcount / 1500  # APIは最大2499件とれるが、余裕ある1500件を狙う
+    return max(1, math.ceil(math.log2(split_n)))  # n分割以上となる2^m分割
+
+
+def quantile_splitlengths(allcount: int, lengths: List[int]) -> List[str]:
+    """
+    キャッシュにある作品長さの経験分布から、作品長さの範囲を作成する
+
+    make_splitlengthsと同じく2^m分割するが、正規分布を仮定せず、
+    キャッシュの作品長さの分位点で区切る。
+    キャッシュと現在の作品の分布はほぼ同じなので、フタコブラクダの
+    分布でも各区間の作品数がおおよそ等しくなる。
+
+    Parameters
+    ----------
+    allcount: int
+        全作品数
+    lengths: List[int]
+        キャッシュにある作品長さ
+
+    Returns
+    -------
+    List[str]
+        なろう小説APIのパラメータのlengthに与えることができる文字列のリスト
+    """
+    lengths = sorted(lengths)
+    split_m = split_exponent(allcount)
+    edges = sorted(set(lengths[len(lengths) * i // 2 ** split_m]
+                       for i in range(1, 2 ** split_m)))
+    los: List[Optional[int]] = [None]
+    los += [edge + 1 for edge in edges]
+    his: List[Optional[int]] = list(edges)
+    his.append(None)
+    return [format_length(lo, hi) for (lo, hi) in zip(los, his)]
+
+
+def inverse_normal_cdf(p: float) -> float:
+    """
+    標準正規分布の累積分布の値がpになる点を返す
+
+    累積分布は単調増加なので、math.erfを使って二分法で求める。
+
+    Parameters
+    ----------
+    p: float
+        累積分布の値、0より大きく1より小さい
+
+    Returns
+    -------
+    float
+        累積分布の値がpになる点
+    """
+    lo, hi = -10.0, 10.0
+    for _ in range(64):
+        mid = (lo + hi) / 2
+        if (1 + math.erf(mid / math.sqrt(2))) / 2 < p:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2
+
+
+def format_length(lo: Optional[int], hi: Optional[int]) -> str:
+    """
+    作品長さの範囲を、なろう小説APIのlengthに与える文字列にする
+
+    Parameters
+    ----------
+    lo: int or None
+        最小の作品長さ、Noneのときは下限なし
+    hi: int or None
+        最大の作品長さ、Noneのときは上限なし
+
+    Returns
+    -------
+    str
+        '100-200'、'-100'、'201-'のような文字列
+    """
+    return "{0}-{1}".format("" if lo is None else lo, "" if hi is None else hi)
+
+
+def parse_length(length: str) -> Tuple[Optional[int], Optional[int]]:
+    """
+    なろう小説APIのlengthに与える文字列を、作品長さの範囲に戻す
+
+    Parameters
+    ----------
+    length: str
+        '100-200'、'-100'、'201-'のような文字列
+
+    Returns
+    -------
+    int or None, int or None
+        最小と最大の作品長さ、制限がなければNone
+    """
+    lo, hi = length.split("-")
+    return (int(lo) if lo != "" else None, int(hi) if hi != "" else None)
+
+
+def split_point(lo: Optional[int], hi: Optional[int],
+                lengths: List[int]) -> Optional[int]:
+    """
+    作品長さの範囲を2つに分ける点を返す
+
+    範囲は lo-mid と (mid+1)-hi に分かれる。
+    キャッシュにある作品長さが範囲内にあれば、その中央値で分ける。
+    なければlogスケールでの中点で分ける。
+
+    Parameters
+    ----------
+    lo: int or None
+        最小の作品長さ、Noneのときは下限なし
+    hi: int or None
+        最大の作品長さ、Noneのときは上限なし
+    lengths: List[int]
+        キャッシュにある作品長さ、昇順に並んでいる
+
+    Returns
+    -------
+    int or None
+        分ける点、範囲が1点でこれ以上分けられないときはNone
+    """
+    low = 0 if lo is None else lo
+    if hi is not None and low >= hi:
+        return None
+    left = bisect.bisect_left(lengths, low)
+    right = len(lengths) if hi is None else bisect.bisect_right(lengths, hi)
+    if left < right:
+        mid = lengths[(left + right - 1) // 2]
+    elif hi is None:
+        mid = max(low * 2, low + 1)
+    else:
+        mid = round(math.sqrt(max(low, 1) * hi))
+    # midは low <= mid < hi に収める
+    mid = max(mid, low)
+    if hi is not None:
+        mid = min(mid, hi - 1)
+    return mid
+
+
+def search_splitlengths(get_params: Dict[str, Union[str, int]],
+                        boundaries: List[int],
+                        lengths: List[int]
+                        ) -> List[Tuple[str, int]]:
+    """
+    各区間の作品数がslice_max以下になる作品長さの分割を探す
+
+    初めの分割をboundariesで与え、各区間の作品数をなろう小説APIで数える。
+    作品数がslice_maxを越える区間は2つに分けて、下側だけを数えなおす。
+    上側の作品数は引き算で求まるので、分けるたびにリクエストは1回で済む。
+    最後に、隣り合う区間を作品数がslice_maxを越えない範囲でまとめて、
+    取得のリクエスト数を減らす。
+
+    作品長さが1点になっても作品数がslice_maxを越える区間は、警告を出して
+    そのまま返す。
+
+    Parameters
+    ----------
+    get_params: dict
+        なろう小説APIのGETパラメータ
+    boundaries: List[int]
+        初めの分割の各区間の最大の作品長さ、最後の上限なしの区間は含めない
+    lengths: List[int]
+        キャッシュにある作品長さ、分ける点を決めるのに使う
+
+    Returns
+    -------
+    List[Tuple[str, int]]
+        なろう小説APIのlengthに与える文字列と、その作品数の組のリスト
+    """
+    get_params = dict(get_params)  # コピー
+    lengths = sorted(lengths)
+
+    def probe(lo: Optional[int], hi: Optional[int]) -> int:
+        get_params["length"] = format_length(lo, hi)
+        count = get_allcount(get_params)
+        delay(1)
+        return count
+
+    edges = [b for b in sorted(set(boundaries)) if b >= 0]
+    los: List[Optional[int]] = [None]
+    los += [b + 1 for b in edges]
+    his: List[Optional[int]] = list(edges)
+    his.append(None)
+    pending = [(lo, hi, probe(lo, hi)) for (lo, hi) in zip(los, his)]
+    slices: List[Tuple[Optional[int], Optional[int], int]] = []
+    while len(pending) > 0:
+        lo, hi, count = pending.pop(0)
+        if count <= slice_max:
+            slices.append((lo, hi, count))
+            continue
+        mid = split_point(lo, hi, lengths)
+        if mid is None:
+            print("Warning: {0} novels have length {1}, over API limit".format(
+                count, format_length(lo, hi)))
+            print("  request with " + str(get_params))
+            slices.append((lo, hi, count))
+            continue
+        lower = probe(lo, mid)
+        pending[0:0] = [(lo, mid, lower), (mid + 1, hi, max(0, count - lower))]
+    # 隣り合う小さな区間をまとめる
+    merged: List[Tuple[Optional[int], Optional[int], int]] = []
+    for (lo, hi, count) in slices:
+        if len(merged) > 0 and merged[-1][2] + count <= slice_max:
+            merged[-1] = (merged[-1][0], hi, merged[-1][2] + count)
+        else:
+            merged.append((lo, hi, count))
+    return [(format_length(lo, hi), count) for (lo, hi, count) in merged]
+
+
+def split_lengths(get_params: Dict[str, Union[str, int]],
+                  allcount: int,
+                  key: str
+                  ) -> List[Tuple[str, int]]:
+    """
+    区分の全作品を、作品長さで2500件未満ずつに分割する
+
+    初めの分割には、前回の取得で使った分割を目録から使う。
+    目録になければ、区分のキャッシュにある作品長さの分位点で分割する。
+    キャッシュもなければ、作品長さをなろう小説APIでサンプリングして、
+    正規分布を仮定した分割を使う。
+    その分割をsearch_splitlengthsで調整する。
+    分ける点には、区分のキャッシュにある作品長さを使う。
+
+    Parameters
+    ----------
+    get_params: dict
+        区分を指定するなろう小説APIのGETパラメータ
+    allcount: int
+        get_paramsによる作品件数
+    key: str
+        区分のキー
+
+    Returns
+    -------
+    List[Tuple[str, int]]
+        なろう小説APIのlengthに与える文字列と、その作品数の組のリスト
+    """
+    entry = manifest.get(key)
+    ranges: List[str] = [] if entry is None else entry.get("lengths", [])
+    lengths: List[int] = []
+    if count_cache(key) > 0:
+        lengths = cache.read([key], columns=["length"])["length"].tolist()
+    if len(ranges) == 0 and len(lengths) >= statistics_min_cached:
+        # キャッシュの作品長さの分位点で分割するので、サンプリングしない
+        ranges = quantile_splitlengths(allcount, lengths)
+    elif len(ranges) == 0:      # 作品の長さに対して正規分布を仮定して分割
+        median, log_stdev = get_statistics(get_params)
+        delay()
+        ranges = make_splitlengths(allcount, median, log_stdev)
+    boundaries = [hi for (_, hi) in map(parse_length, ranges)
+                  if hi is not None]
+    return search_splitlengths(get_params, boundaries, lengths)
+
+
 def get_write_lessthan2500(get_params: Dict[str, Union[str, int]],
                            allcount: int,
-                           filename: str
+                           writer: storage.Writer
                            ) -> None:
     """
     与えられたGETパラメータで2500件未満の小説情報を取得する
@@ -339,8 +782,8 @@ def get_write_lessthan2500(get_params: Dict[str, Union[str, int]],
         なろう小説APIのGETパラメータ
     allcount: int
         get_paramsによる作品件数
-    filename: str
-        保存先のファイル名
+    writer: storage.Writer
+        書き込み先の区分のWriter
     """
     if allcount == 0:
         return
@@ -356,22 +799,47 @@ def get_write_lessthan2500(get_params: Dict[str, Union[str, int]],
         #   st=1のときは499件という特殊な区間にする
         get_params["lim"] = 499 if i == 0 else 500
         get_params["st"] = 500 * i
-        jsondata = get_jsondata(get_params)
-        write_json(jsondata, filename)
+        # 中断した前回の取得で済んだページは飛ばす
+        unit = page_unit(get_params)
+        if writer.completed(unit):
+            continue
+        write_json(iter_jsondata(get_params), writer)
+        writer.checkpoint(unit)
         delay()
 
 
-def get_data(genre: str, kaiwa: str, buntai: int, ty: str) -> None:
+def page_unit(get_params: Dict[str, Union[str, int]]) -> str:
+    """
+    取得するページを表す文字列を作る、途中から再開するときの記録に使う
+
+    Parameters
+    ----------
+    get_params: dict
+        なろう小説APIのGETパラメータ
+
+    Returns
+    -------
+    str
+        'length=100-200&st=500&lim=500'のような文字列
+    """
+    return "&".join("{0}={1}".format(name, get_params[name])
+                    for name in ["length", "lastup", "st", "lim"]
+                    if name in get_params)
+
+
+def get_data(genre: str, kaiwa: str, buntai: int, ty: str,
+             incremental: bool = False) -> None:
     """
-    なろう小説APIを使って小説情報を取得してファイルに保存する
+    なろう小説APIを使って小説情報を取得してキャッシュに保存する
 
-    ファイル名は以下のようになり、outputディレクトリに保存される
-      [ジャンル]_[会話率]_[文体]_[タイプ].csv
+    キャッシュは以下のキーの区分ごとに、outputディレクトリに保存される
+      [ジャンル]_[会話率]_[文体]_[タイプ]
     例：ジャンル9801、会話率31-40、文体1、タイプreの場合
-      ./output/9801_31-40_1_re.csv
+      9801_31-40_1_re
 
-    また、保存されるcsvファイルは、先頭にヘッダーを含んでいる。
-    このヘッダーはなろう小説APIが返す文字列をそのまま使っている。
+    列名はなろう小説APIが返す項目名をそのまま使っている。
+    区分のキャッシュは、すべて取得し終えたときにまとめて置き換わる。
+    途中でエラー終了した場合は、前回のキャッシュがそのまま残る。
 
     取得の際には、ローカルにキャッシュがあるかを先に確認する。
     キャッシュに対して、現在のなろう小説の件数が5%以上増加していないと
@@ -385,6 +853,15 @@ def get_data(genre: str, kaiwa: str, buntai: int, ty: str) -> None:
     おおよそ、各ジャンル、会話率は10%ずつ区切り、各文体、各タイプで
     この関数を呼び出せば、全作品の情報を取得できる。
 
+    incrementalを指定すると、前回の取得以降に更新された作品だけを取得して、
+    キャッシュをncodeで上書きする。
+    前回の取得記録がないときや、更新された作品が2500件以上のときは、
+    区分をすべて取得しなおす。
+
+    set_profileで取得する項目を絞ると、なろう小説APIのofパラメータで
+    プロファイルの項目だけを取得し、残りの項目は前回のキャッシュから
+    引き継ぐ。
+
     引数の詳細は以下URLのAPI仕様における、ジャンル、会話率、文体、タイプを参照。
     https://dev.syosetu.com/man/api/
 
@@ -398,60 +875,221 @@ def get_data(genre: str, kaiwa: str, buntai: int, ty: str) -> None:
         小説の文体、1/2/4/6のどれか
     ty: str
         小説のタイプ、"t"と"re"で全作品を網羅できる
+    incremental: bool, default False
+        前回の取得以降に更新された作品だけを取得する
     """
-    print("ジャンル:{0:<4},会話率:{1:<6},文体:{2},タイプ:{3:<2}".
-          format(genre, kaiwa, buntai, ty), end="")
+    # 並列取得で他のスレッドの出力と混ざらないよう、1行にまとめて出力する
+    log = "ジャンル:{0:<4},会話率:{1:<6},文体:{2},タイプ:{3:<2}".format(
+        genre, kaiwa, buntai, ty)
 
-    # ファイル名
-    filename = make_filename(genre, kaiwa, buntai, ty)
+    # 区分のキー
+    key = make_key(genre, kaiwa, buntai, ty)
 
     # 前回取得した作品数
-    cached_allcount = count_cache(filename)
-    print(" | cache:" + "{0:>6}".format(cached_allcount), end="")
+    cached_allcount = count_cache(key)
+    log += " | cache:" + "{0:>6}".format(cached_allcount)
+
+    # 中断した今回の取得で取得し終えていれば、作品数も問い合わせない
+    if journal.finished(manifest.get(key)):
+        print(log + " | DONE")
+        return
 
     # 最新の作品数
     get_params: Dict[str, Union[str, int]] = {
         "genre": genre, "kaiwaritu": kaiwa,
         "buntai": buntai, "type": ty
     }
+    fields = profiles.profile_fields(profile)
+    if fields is not None:      # プロファイルの項目だけを取得する
+        get_params["of"] = profiles.of_param(fields)
     allcount = get_allcount(get_params)
-    print(" | allcount:" + "{0:>6}".format(allcount), end="")
+    log += " | allcount:" + "{0:>6}".format(allcount)
     delay(1)
-
-    # 5%以上の増分がなければ再取得しない
-    if allcount < cached_allcount * 1.05:
-        print(" | SKIP")
+    observe_allcount(key, allcount)
+
+    entry = manifest.get(key)
+    if incremental and cached_allcount > 0 and entry is not None \
+       and "fetched_at" in entry:
+        # 前回の取得以降に更新された作品だけを取得する
+        since = int(entry.get("synced_at", entry["fetched_at"]))
+        updated = sync_data(get_params, key, since, allcount)
+        if updated is not None:
+            print(log + " | SYNC:" + "{0:>6}".format(updated))
+            return
+        print(log + " | GET")
+    elif allcount < cached_allcount * 1.05:  # 5%以上の増分がなければ再取得しない
+        # 再開したときに作品数を問い合わせなおさないよう、確かめたことを記録する
+        manifest.touch(key, verified_at=int(time.time()))
+        print(log + " | SKIP")
         return
     else:
-        print(" | GET")
+        print(log + " | GET")
+
+    # 取得中に更新された作品を次回の差分取得で拾うため、開始時刻を記録する
+    synced_at = int(time.time())
+    # 取得したページは記録簿に保存していき、最後にまとめて区分を置き換える
+    inner = cache.writer(key)
+    if fields is not None:      # 取得しなかった項目は前回から引き継ぐ
+        inner = profiles.ProfileWriter(cache, key, inner, fields)
+    with journal.writer(key, ncode_index.writer(key, inner)) as writer:
+        lengths = get_write(get_params, allcount, key, writer)
+    manifest.update(key, count=writer.written, fetched_at=int(time.time()),
+                    synced_at=synced_at, allcount=allcount, lengths=lengths)
+
+
+def observe_allcount(key: str, allcount: int) -> None:
+    """
+    区分の作品数を観測した時刻と、1日あたりに増える作品数を目録に記録する
+
+    記録はscheduler.Schedulerが区分の優先度を決めるのに使う。
+    区分を取得するたびに書き換わるので、目録にはまとめて書き出す。
+    """
+    now = time.time()
+    growth = scheduler.update_growth(manifest.get(key), allcount, now)
+    manifest.touch(key, checked_at=int(now), checked_allcount=allcount,
+                   growth=growth)
+
+
+def sync_data(get_params: Dict[str, Union[str, int]],
+              key: str,
+              since: int,
+              allcount: int
+              ) -> Optional[int]:
+    """
+    指定時刻以降に更新された作品を取得して、キャッシュをncodeで上書きする
+
+    なろう小説APIのlastup（最終掲載日）で更新された作品を絞り込み、
+    新着更新順で取得する。
+    時計のずれや取得中の更新を取りこぼさないよう、指定時刻より少し前から
+    取得する。
+
+    Parameters
+    ----------
+    get_params: dict
+        区分を指定するなろう小説APIのGETパラメータ
+    key: str
+        区分のキー
+    since: int
+        前回取得した時刻（unixtime）
+    allcount: int
+        区分の現在の全作品数
+
+    Returns
+    -------
+    int or None
+        取得した作品数
+        更新された作品が2500件以上で差分取得できないときはNone
+    """
+    synced_at = int(time.time())
+    get_params = dict(get_params)  # コピー
+    get_params["lastup"] = "{0}-{1}".format(since - sync_margin, synced_at)
+    get_params["order"] = "new"
+    count = get_allcount(get_params)
+    delay(1)
+    if count >= 2500:
+        return None
+    elif count == 0:
+        # 区分は変わっていないので、次の差分取得の起点も変えない
+        manifest.touch(key, verified_at=synced_at, allcount=allcount)
+        return 0
+    upserter = cache.upserter(key)
+    with ncode_index.writer(key, upserter, replace=False) as writer:
+        get_write_lessthan2500(get_params, count, writer)
+    manifest.update(key, count=upserter.count, synced_at=synced_at,
+                    written_at=time.time(), allcount=allcount)
+    return count
+
+
+def backfill(fields: Optional[List[str]] = None,
+             keys: Optional[List[str]] = None) -> int:
+    """
+    キャッシュで項目が欠けている作品だけ、その項目を取得して補う
+
+    プロファイルで取得しなかった項目は、新しい作品や更新された作品で
+    欠損値になっている。
+    区分ごとに、索引がその区分を指している作品のうち、項目が欠けている
+    作品のncodeをbackfill_batch件ずつAPIのncodeパラメータに与え、
+    欠けた項目だけを取得して、キャッシュのその列だけを書き換える。
+
+    Parameters
+    ----------
+    fields: List[str], default None
+        補う項目、Noneのときはprofiles.heavy_fields
+    keys: List[str], default None
+        補う区分のキー、Noneのときはすべての区分
+
+    Returns
+    -------
+    int
+        項目を補った作品数
+    """
+    if fields is None:
+        fields = profiles.heavy_fields
+    if keys is None:
+        keys = cache.keys()
+    of = profiles.of_param(["ncode"] + fields)
+    total = 0
+    for key in keys:
+        df = read_current(cache, key, ["ncode"] + fields, ncode_index)
+        ncodes = list(df.loc[df[fields].isna().any(axis=1), "ncode"])
+        updated = 0
+        for i in range(0, len(ncodes), backfill_batch):
+            batch = ncodes[i:i + backfill_batch]
+            get_params: Dict[str, Union[str, int]] = {
+                "ncode": "-".join(batch), "of": of, "lim": len(batch)
+            }
+            rows = [elem for elem in get_jsondata(get_params)
+                    if "allcount" not in elem]
+            delay()
+            if rows:
+                df = pandas.DataFrame.from_records(rows)
+                updated += cache.update_columns(key, df[["ncode"] + fields])
+        if updated > 0:
+            manifest.update(key, written_at=time.time())
+        total += updated
+        print("{0} | backfill:{1:>6}".format(key, len(ncodes)))
+    metrics.registry.add("backfill_rows", total)
+    return total
+
+
+def get_write(get_params: Dict[str, Union[str, int]],
+              allcount: int,
+              key: str,
+              writer: storage.Writer
+              ) -> List[str]:
+    """
+    与えられたGETパラメータの全作品を、必要なら作品長さで分割して取得する
 
-    # キャッシュを削除する
-    path = pathlib.Path("filename")
-    if path.exists():
-        path.unlink()
+    Parameters
+    ----------
+    get_params: dict
+        なろう小説APIのGETパラメータ
+    allcount: int
+        get_paramsによる作品件数
+    key: str
+        区分のキー
+    writer: storage.Writer
+        書き込み先の区分のWriter
 
-    get_params = {"genre": genre, "kaiwaritu": kaiwa,
-                  "buntai": buntai, "type": ty}
+    Returns
+    -------
+    List[str]
+        取得に使った作品長さの分割、分割しなかったときは空のリスト
+    """
+    get_params = dict(get_params)  # コピー
+    lengths: List[str] = []
     if allcount < 2500:         # 分割取得の必要なし
-        get_write_lessthan2500(get_params, allcount, filename)
+        get_write_lessthan2500(get_params, allcount, writer)
     else:                       # 作品の長さで分割して取得する
-        if genre == "9902":
-            # ADHOCK: ジャンル「詩」は分布が特殊。特に作品長さが100-1000に
-            #         作品が集中している。なので、それを細かく固定分割する。
-            r = range(100, 1001, 20)
-            starts = [str(start + 1) for start in r[0:len(r)-1]]
-            ends = [str(end) for end in r[1:]]
-            lengths = [start + "-" + end for (start, end) in zip(starts, ends)]
-            lengths = ["-100"] + lengths + ["1001-"]
-        else:                   # 作品の長さに対して正規分布を仮定して分割
-            median, log_stdev = get_statistics(get_params)
-            delay()
-            lengths = make_splitlengths(allcount, median, log_stdev)
-        for length in lengths:
+        slices = split_lengths(get_params, allcount, key)
+        lengths = [length for (length, _) in slices]
+        # 中断して再開したときに同じ分割から始められるよう、先に記録する
+        manifest.update(key, lengths=lengths)
+        for (length, count) in slices:
             get_params["length"] = length  # lengthを追加
-            count = get_allcount(get_params)
-            delay(1)
-            get_write_lessthan2500(get_params, count, filename)
+            # 分けきれなかった区間は、取れる2499件までを取得する
+            get_write_lessthan2500(get_params, min(count, 2499), writer)
+    return lengths
 
 
 def make_directory() -> None:
@@ -470,13 +1108,189 @@ but file already exists.")
         path.mkdir(exist_ok=True)
 
 
-def main() -> None:
-    make_directory()     # ディレクトリの作成
+def partitions() -> Iterator[Tuple[str, str, int, str]]:
+    """
+    全作品を網羅するジャンル、会話率、文体、タイプの組を順に返す
+
+    Returns
+    -------
+    Iterator[Tuple[str, str, int, str]]
+        get_dataに与える引数の組
+    """
     for genre in genres:
         for kaiwa in kaiwas:
             for buntai in buntais:
                 for ty in types:
-                    get_data(genre, kaiwa, buntai, ty)
+                    yield (genre, kaiwa, buntai, ty)
+
+
+def crawl(workers: int = 1, incremental: bool = False,
+          resume: bool = False) -> None:
+    """
+    全作品の情報を取得してキャッシュに保存する
+
+    workersが2以上のときは、スレッドプールで複数の組を並列に取得する。
+    各組は別々の区分に保存されるため、書き込みは衝突しない。
+    APIError以外の例外で失敗したときは、直列のときと同じく、
+    まだ始まっていない組は取得せずに例外を送出する。
+    並列取得するときは、set_ratelimitでリクエスト頻度の上限を設定しておく。
+
+    取得したページは記録簿に残るので、途中で落ちてもresumeを指定して
+    呼びなおせば、取得し終えた区分とページを飛ばして続きから取得する。
+
+    Parameters
+    ----------
+    workers: int, default 1
+        並列に取得するスレッドの数
+    incremental: bool, default False
+        前回の取得以降に更新された作品だけを取得する
+    resume: bool, default False
+        中断した前回の取得の続きから取得する
+    """
+    journal.start(resume)
+    try:
+        if workers <= 1:
+            for partition in partitions():
+                try_get_data(partition, incremental)
+            return
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            tasks = [executor.submit(try_get_data, partition, incremental)
+                     for partition in partitions()]
+            try:
+                for task in futures.as_completed(tasks):
+                    task.result()  # スレッド内の例外をここで送出する
+            except BaseException:
+                # 直列のときと同じく、まだ始まっていない区分は取得しない
+                for task in tasks:
+                    task.cancel()
+                raise
+    finally:
+        manifest.flush()        # touchでまとめた作品数の観測を書き出す
+
+
+def daemon(budget: int, cycles: Optional[int] = None) -> None:
+    """
+    変わっていそうな区分から順に、1時間あたりbudget回のリクエストで取得し続ける
+
+    区分の優先度は、観測した作品数の増え方と前回の取得からの経過時間から
+    scheduler.priorityで決める。
+    区分は差分取得するので、増えた作品が少ない区分は数回のリクエストで済む。
+
+    Parameters
+    ----------
+    budget: int
+        1時間あたりに使ってよいリクエスト数
+    cycles: int, default None
+        繰り返す時間数、Noneのときは止めるまで続ける
+    """
+    journal.start()
+    by_key = {make_key(*partition): partition for partition in partitions()}
+    runner = scheduler.Scheduler(
+        manifest, list(by_key),
+        lambda key: try_get_data(by_key[key], incremental=True),
+        lambda: metrics.registry.total("api_requests"))
+    runner.run(budget, cycles)
+
+
+def try_get_data(partition: Tuple[str, str, int, str],
+                 incremental: bool = False) -> bool:
+    """
+    get_dataを呼び出し、APIへのアクセスに失敗したらその区分だけ諦める
+
+    失敗した区分のキャッシュは前回のまま残るので、次回の取得で取りなおす。
+
+    Parameters
+    ----------
+    partition: Tuple[str, str, int, str]
+        ジャンル、会話率、文体、タイプの組
+    incremental: bool, default False
+        前回の取得以降に更新された作品だけを取得する
+
+    Returns
+    -------
+    bool
+        取得に成功したかどうか
+    """
+    # 区分の中で記録した計測値は、その区分の値になる
+    with metrics.registry.partition(make_key(*partition)), \
+            metrics.registry.timer("partition_seconds"):
+        try:
+            get_data(*partition, incremental=incremental)
+            return True
+        except APIError as e:
+            print("Error: " + str(e))
+            return False
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="なろう小説APIから全作品の情報を取得する")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="並列に取得するスレッドの数")
+    parser.add_argument("--rate", type=float, default=None,
+                        help="全スレッド合計のリクエスト数の上限[回/s]、"
+                        "並列取得時の既定値は1.0")
+    parser.add_argument("--burst", type=int, default=1,
+                        help="瞬間的に許すリクエスト数")
+    parser.add_argument("--storage", choices=storage.storage_kinds,
+                        default="sqlite", help="キャッシュの保存先")
+    parser.add_argument("--migrate-from", choices=storage.storage_kinds,
+                        default=None,
+                        help="指定した保存先のキャッシュを--storageへ"
+                        "移し替えて終了する")
+    parser.add_argument("--incremental", action="store_true",
+                        help="前回の取得以降に更新された作品だけを取得する")
+    parser.add_argument("--resume", action="store_true",
+                        help="中断した前回の取得の続きから取得する")
+    parser.add_argument("--reindex", action="store_true",
+                        help="キャッシュからncodeの索引を作りなおして終了する")
+    parser.add_argument("--profile", choices=list(profiles.profiles),
+                        default="full",
+                        help="なろう小説APIから取得する項目、fullはすべて、"
+                        "lightはあらすじ以外、minimalは推薦に使う項目だけ")
+    parser.add_argument("--backfill", nargs="*", default=None,
+                        metavar="FIELD",
+                        help="キャッシュで欠けている項目を補って終了する、"
+                        "項目を省略したときはあらすじ")
+    parser.add_argument("--daemon", action="store_true",
+                        help="変わっていそうな区分から順に取得し続ける")
+    parser.add_argument("--budget", type=int, default=600,
+                        help="--daemonで1時間あたりに使うリクエスト数")
+    parser.add_argument("--metrics", default=None,
+                        help="区分ごとの計測値を書き出すファイル、"
+                        "拡張子が.promならPrometheus形式、それ以外はJSON")
+    args = parser.parse_args()
+    set_storage(args.storage)
+    set_profile(args.profile)
+    if args.migrate_from is not None:
+        src = storage.open_storage(args.migrate_from, dirname)
+        n = storage.migrate(src, cache)
+        print("migrated {0} partitions from {1} to {2}".format(
+            n, args.migrate_from, args.storage))
+        ncode_index.rebuild(cache)
+        return
+    if args.reindex:
+        n = ncode_index.rebuild(cache)
+        print("indexed {0} novels".format(n))
+        return
+    rate = args.rate
+    if rate is None and args.workers > 1:
+        rate = 1.0
+    set_ratelimit(rate, args.burst)
+    make_directory()     # ディレクトリの作成
+    try:
+        if args.backfill is not None:
+            n = backfill(args.backfill or None)
+            print("backfilled {0} novels".format(n))
+            return
+        if args.daemon:
+            daemon(args.budget)
+            return
+        crawl(args.workers, args.incremental, args.resume)
+    finally:
+        # 中断したときも、そこまでの計測値を書き出す
+        if args.metrics is not None:
+            metrics.registry.write(args.metrics)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,219 @@
+# なろう小説APIへ接続を使い回しながらアクセスするクライアント
+
+import email.utils
+import random
+import time
+import zlib
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from typing import Dict, Union, Iterator, Optional, Tuple, Any, List
+from ratelimit import TokenBucket
+import jsonstream
+import metrics
+
+
+class APIError(Exception):
+    """
+    なろう小説APIへのアクセスが、再試行しても成功しなかったときの例外
+    """
+    pass
+
+
+class NarouAPI:
+    """
+    なろう小説APIのクライアント
+
+    セッションの接続をプールして使い回すので、リクエストのたびに
+    TLSのハンドシェイクをしなくて済む。
+    5xx、429、接続エラー、タイムアウトのときは、指数的に伸ばした待ち時間に
+    ゆらぎを加えて再試行する。
+    Retry-Afterヘッダーがあれば、その時間だけ待つ。
+    """
+
+    api_url = "https://api.syosetu.com/novelapi/api/"
+
+    # 再試行するHTTPステータスコード
+    retry_statuses = [429, 500, 502, 503, 504]
+
+    def __init__(self,
+                 api_url: Optional[str] = None,
+                 timeout: Tuple[float, float] = (10, 60),
+                 retries: int = 5,
+                 backoff: float = 2.0,
+                 max_backoff: float = 300.0,
+                 pool_size: int = 16,
+                 limiter: Optional[TokenBucket] = None) -> None:
+        """
+        Parameters
+        ----------
+        api_url: str, default None
+            APIのURL、Noneのときはなろう小説APIのURL
+        timeout: (float, float), default (10, 60)
+            接続と読み込みのタイムアウト[s]
+        retries: int, default 5
+            再試行の最大回数
+        backoff: float, default 2.0
+            1回目の再試行の前に待つ時間[s]、再試行のたびに2倍になる
+        max_backoff: float, default 300.0
+            再試行の前に待つ時間の上限[s]
+        pool_size: int, default 16
+            プールする接続の数、並列取得のスレッド数以上にする
+        limiter: TokenBucket, default None
+            リクエストの前にトークンを取るレートリミッタ
+        """
+        if api_url is not None:
+            self.api_url = api_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.limiter = limiter
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def backoff_time(self, attempt: int) -> float:
+        """
+        attempt回目の失敗のあとに待つ時間を返す
+
+        待ち時間を半分から全部の間でゆらがせて、並列に失敗したリクエストの
+        再試行が同時に集中しないようにする。
+        """
+        wait = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return wait * random.uniform(0.5, 1.0)
+
+    @staticmethod
+    def retry_after(res: requests.Response) -> Optional[float]:
+        """
+        Retry-Afterヘッダーが指定する待ち時間[s]を返す、なければNone
+        """
+        value = res.headers.get("Retry-After")
+        if value is None:
+            return None
+        if value.strip().isdigit():
+            return float(value)
+        try:
+            date = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, date.timestamp() - time.time())
+
+    def get(self, params: Dict[str, Union[str, int]],
+            stream: bool = False) -> requests.Response:
+        """
+        GETリクエストを送って、成功したレスポンスを返す
+
+        Parameters
+        ----------
+        params: dict
+            GETパラメータ
+        stream: bool, default False
+            レスポンスの本文を読みながら受け取る
+
+        Returns
+        -------
+        requests.Response
+            成功したレスポンス
+
+        Raises
+        ------
+        APIError
+            再試行しても成功しなかったとき、または再試行しても意味のない
+            エラーが返ったとき
+        """
+        error: Any = None
+        for attempt in range(self.retries + 1):
+            if self.limiter is not None:
+                metrics.registry.add("sleep_seconds", self.limiter.acquire())
+            wait: Optional[float] = None
+            start = time.perf_counter()
+            try:
+                res = self.session.get(self.api_url, params=params,
+                                       timeout=self.timeout, stream=stream)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            else:
+                # 応答のヘッダーが届くまでの時間
+                metrics.registry.observe("api_latency_seconds",
+                                         time.perf_counter() - start)
+                metrics.registry.add("api_requests")
+                if res.ok:
+                    return res
+                res.close()
+                error = "HTTP {0}".format(res.status_code)
+                if res.status_code not in NarouAPI.retry_statuses:
+                    break       # パラメータの誤りなどは再試行しない
+                wait = NarouAPI.retry_after(res)
+            if attempt < self.retries:
+                sleep = self.backoff_time(attempt) if wait is None \
+                    else min(wait, self.max_backoff)
+                metrics.registry.add("api_retries")
+                metrics.registry.add("sleep_seconds", sleep)
+                time.sleep(sleep)
+        raise APIError("API request failed ({0}) with {1}".format(
+            error, params))
+
+    def iter_json(self, params: Dict[str, Union[str, int]]
+                  ) -> Iterator[Dict[str, Union[str, int]]]:
+        """
+        gzip圧縮のJSONでGETして、JSON配列の要素を1つずつ返す
+
+        GETパラメータにはgzip圧縮5、出力json、を追加で指定して通信する。
+        レスポンスは受け取りながら少しずつ展開するので、レスポンス全体や
+        展開後のデータ全体をメモリに持たない。
+
+        受信、展開、JSONの解析のそれぞれにかかった時間と、受信したバイト数、
+        展開後のバイト数をmetrics.registryに記録する。
+
+        Parameters
+        ----------
+        params: dict
+            GETパラメータ
+
+        Returns
+        -------
+        Iterator[dict]
+            APIから帰ってきたJSON配列の要素
+
+        Raises
+        ------
+        APIError
+            アクセスに失敗したとき、または受信中に接続が切れたとき
+        """
+        params = dict(params)   # コピー
+        params["gzip"] = 5
+        params["out"] = "json"
+        # 各段の時間は、前の段の時間を含んだ累計になる
+        network, gunzip, parse = [0.0], [0.0], [0.0]
+        wire, decompressed = [0], [0]
+
+        def count(chunks: Iterator[bytes], total: List[int]
+                  ) -> Iterator[bytes]:
+            for chunk in chunks:
+                total[0] += len(chunk)
+                yield chunk
+
+        with self.get(params, stream=True) as res:
+            chunks = res.raw.stream(jsonstream.chunk_size,
+                                    decode_content=False)
+            chunks = count(metrics.timed_iter(chunks, network), wire)
+            data = count(metrics.timed_iter(jsonstream.gunzip(chunks),
+                                            gunzip), decompressed)
+            try:
+                for element in metrics.timed_iter(
+                        jsonstream.iter_array(data), parse):
+                    yield element
+            except (urllib3.exceptions.HTTPError, zlib.error,
+                    ValueError, OSError) as e:
+                raise APIError("API response is broken ({0}) with {1}".format(
+                    e, params)) from e
+            finally:
+                metrics.registry.add("api_network_seconds", network[0])
+                metrics.registry.add("api_gunzip_seconds",
+                                     gunzip[0] - network[0])
+                metrics.registry.add("api_json_seconds", parse[0] - gunzip[0])
+                metrics.registry.add("api_wire_bytes", wire[0])
+                metrics.registry.add("api_decompressed_bytes",
+                                     decompressed[0])
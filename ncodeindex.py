@@ -0,0 +1,376 @@
+# 全区分を通して、作品ごとに最新の行がどの区分にあるかを記録する
+
+import pathlib
+import sqlite3
+import time
+import pandas
+from typing import List, Dict, Tuple, Optional
+import storage
+
+
+# 作品の更新時刻として使う列、先にあるものを優先する
+updated_columns = ["novelupdated_at", "updated_at", "general_lastup"]
+
+
+class NcodeIndex:
+    """
+    ncodeから、その作品の最新の行を持つ区分と更新時刻を引く索引
+
+    会話率や文体、作品長さが変わった作品は、前回の取得で入った区分と
+    今回の取得で入った区分の両方にキャッシュが残る。
+    索引は作品ごとに、更新時刻がいちばん新しい行を持つ区分だけを記録する。
+    SQLiteのファイルに保存するので、コーパス全体を読まずにncodeで引ける。
+    """
+
+    def __init__(self, filename: str) -> None:
+        """
+        Parameters
+        ----------
+        filename: str
+            索引のSQLiteファイル
+        """
+        self.filename = filename
+
+    def connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.filename, timeout=60,
+                              isolation_level=None)
+        con.execute("CREATE TABLE IF NOT EXISTS ncodes ("
+                    "ncode TEXT PRIMARY KEY, partition TEXT, "
+                    "updated_at TEXT, fetched_at REAL)")
+        con.execute("CREATE INDEX IF NOT EXISTS ncodes_partition "
+                    "ON ncodes (partition)")
+        # 索引に反映したことのある区分
+        con.execute("CREATE TABLE IF NOT EXISTS partitions "
+                    "(partition TEXT PRIMARY KEY)")
+        return con
+
+    def get(self, ncode: str) -> Optional[Tuple[str, str]]:
+        """
+        作品の最新の行を持つ区分と、その更新時刻を返す
+
+        Parameters
+        ----------
+        ncode: str
+            作品のncode、大文字小文字は問わない
+
+        Returns
+        -------
+        (str, str) or None
+            区分のキーと更新時刻、索引になければNone
+        """
+        if not pathlib.Path(self.filename).exists():
+            return None
+        con = self.connect()
+        try:
+            row = con.execute("SELECT partition, updated_at FROM ncodes "
+                              "WHERE ncode = ?", (ncode.upper(),)).fetchone()
+        finally:
+            con.close()
+        return None if row is None else (row[0], row[1])
+
+    def partition_ncodes(self, key: str) -> Optional[List[str]]:
+        """
+        区分が最新の行を持つ作品のncodeを返す
+
+        Parameters
+        ----------
+        key: str
+            区分のキー
+
+        Returns
+        -------
+        List[str] or None
+            ncodeのリスト、区分がまだ索引に載っていなければNone
+        """
+        if not pathlib.Path(self.filename).exists():
+            return None
+        con = self.connect()
+        try:
+            indexed = con.execute("SELECT 1 FROM partitions "
+                                  "WHERE partition = ?", (key,)).fetchone()
+            if indexed is None:
+                return None
+            rows = con.execute("SELECT ncode FROM ncodes WHERE partition = ?",
+                               (key,)).fetchall()
+        finally:
+            con.close()
+        return [row[0] for row in rows]
+
+    def current_partitions(self) -> Optional[Tuple[pandas.Series, List[str]]]:
+        """
+        すべての作品について、最新の行を持つ区分を1回の接続で返す
+
+        Returns
+        -------
+        (pandas.Series, List[str]) or None
+            ncodeから区分のキーへのSeriesと、索引に反映したことのある区分
+            索引のファイルがなければNone
+        """
+        if not pathlib.Path(self.filename).exists():
+            return None
+        con = self.connect()
+        try:
+            ncodes = pandas.read_sql_query(
+                "SELECT ncode, partition FROM ncodes", con)
+            indexed = [row[0] for row in con.execute(
+                "SELECT partition FROM partitions").fetchall()]
+        finally:
+            con.close()
+        return ncodes.set_index("ncode")["partition"], indexed
+
+    def update(self, key: str, entries: Dict[str, str],
+               replace: bool) -> None:
+        """
+        区分に書き込んだ作品を索引に反映する
+
+        他の区分により新しい行がある作品は、そちらを指したままにする。
+
+        Parameters
+        ----------
+        key: str
+            区分のキー
+        entries: Dict[str, str]
+            書き込んだ作品のncodeから更新時刻への辞書
+        replace: bool
+            Trueなら区分を丸ごと置き換えたものとして、載っていない作品を
+            区分から外す
+        """
+        now = time.time()
+        con = self.connect()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            con.execute("INSERT OR IGNORE INTO partitions VALUES (?)",
+                        (key,))
+            if replace:
+                con.execute("DELETE FROM ncodes WHERE partition = ?", (key,))
+            con.executemany(
+                "INSERT INTO ncodes VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (ncode) DO UPDATE SET "
+                "partition = excluded.partition, "
+                "updated_at = excluded.updated_at, "
+                "fetched_at = excluded.fetched_at "
+                "WHERE excluded.updated_at >= ncodes.updated_at "
+                "OR ncodes.partition = excluded.partition",
+                ((ncode, key, updated, now)
+                 for ncode, updated in entries.items()))
+            con.execute("COMMIT")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        finally:
+            con.close()
+
+    def writer(self, key: str, writer: storage.Writer,
+               replace: bool = True) -> "IndexWriter":
+        """
+        書き込んだ作品を、commitのときに索引へ反映するWriterを返す
+
+        Parameters
+        ----------
+        key: str
+            区分のキー
+        writer: storage.Writer
+            区分のキャッシュのWriter
+        replace: bool, default True
+            writerが区分を丸ごと置き換えるならTrue、ncodeで上書きするならFalse
+
+        Returns
+        -------
+        IndexWriter
+            writerへ書き込みながら、書き込んだ作品を覚えておくWriter
+        """
+        return IndexWriter(self, key, writer, replace)
+
+    def rebuild(self, cache: storage.Storage) -> int:
+        """
+        キャッシュにあるすべての区分から索引を作りなおす
+
+        Parameters
+        ----------
+        cache: storage.Storage
+            作品情報のキャッシュ
+
+        Returns
+        -------
+        int
+            索引に載った作品数
+        """
+        con = self.connect()
+        try:
+            con.execute("DELETE FROM partitions")
+            con.execute("DELETE FROM ncodes")
+        finally:
+            con.close()
+        for key in cache.keys():
+            df = cache.read([key])
+            self.update(key, entries_of(df), replace=True)
+        con = self.connect()
+        try:
+            return int(con.execute("SELECT COUNT(*) FROM ncodes")
+                       .fetchone()[0])
+        finally:
+            con.close()
+
+
+def updated_of(df: pandas.DataFrame) -> pandas.Series:
+    """
+    作品情報の各行の更新時刻を、updated_columnsの先にある列から取る
+
+    どの列も欠けている行は空文字列になる。
+    """
+    updated = pandas.Series("", index=df.index)
+    for column in reversed(updated_columns):
+        if column in df.columns:
+            values = df[column].astype(str)
+            updated = updated.where(df[column].isna(), values)
+    return updated
+
+
+def entries_of(df: pandas.DataFrame) -> Dict[str, str]:
+    """
+    作品情報から、ncodeと更新時刻の組を取り出す
+
+    同じ区分に同じ作品が複数あるときは、更新時刻が新しいものを残す。
+    """
+    if "ncode" not in df.columns or len(df) == 0:
+        return {}
+    ncodes = df["ncode"].astype(str).str.upper()
+    updated = updated_of(df)
+    entries: Dict[str, str] = {}
+    for ncode, value in zip(ncodes, updated):
+        if ncode not in entries or value >= entries[ncode]:
+            entries[ncode] = value
+    return entries
+
+
+class IndexWriter(storage.Writer):
+    """
+    区分のWriterへ書き込みながら、書き込んだ作品をcommitで索引に反映する
+
+    索引に反映するのは区分のcommitが成功してからなので、
+    abortした区分の作品が索引に載ることはない。
+    """
+
+    def __init__(self, index: NcodeIndex, key: str, writer: storage.Writer,
+                 replace: bool) -> None:
+        self.index = index
+        self.key = key
+        self.writer = writer
+        self.replace = replace
+        self.entries: Dict[str, str] = {}
+
+    def write(self, df: pandas.DataFrame) -> None:
+        self.writer.write(df)
+        self.written += len(df)
+        for ncode, updated in entries_of(df).items():
+            if ncode not in self.entries or updated >= self.entries[ncode]:
+                self.entries[ncode] = updated
+
+    def completed(self, unit: str) -> bool:
+        return self.writer.completed(unit)
+
+    def checkpoint(self, unit: str) -> None:
+        self.writer.checkpoint(unit)
+
+    def commit(self) -> None:
+        self.writer.commit()
+        self.index.update(self.key, self.entries, self.replace)
+
+    def abort(self) -> None:
+        self.writer.abort()
+
+
+def read_current(cache: storage.Storage, key: str,
+                 columns: Optional[List[str]],
+                 index: NcodeIndex) -> pandas.DataFrame:
+    """
+    区分のキャッシュから、索引がこの区分を指している作品の行だけを読む
+
+    索引に載っていない区分は、すべての行を返す。
+    storage.read_parallelに、indexを部分適用して渡す。
+    """
+    read_columns = columns
+    if columns is not None and "ncode" not in columns:
+        read_columns = ["ncode"] + columns
+    df = cache.read([key], columns=read_columns)
+    ncodes = index.partition_ncodes(key)
+    if ncodes is not None and "ncode" in df.columns:
+        df = df[df["ncode"].astype(str).str.upper().isin(ncodes)]
+    if read_columns is not columns:
+        df = df[columns]
+    return df
+
+
+def select_current(df: pandas.DataFrame,
+                   index: NcodeIndex) -> pandas.DataFrame:
+    """
+    複数の区分をまとめて読んだ作品情報から、作品ごとに最新の行だけを選ぶ
+
+    dfはStorage.read_with_keysで読んだ、区分のキーの列を持つ作品情報。
+    索引に載った区分の行は、索引がその区分を指している作品だけを残す。
+    索引に載っていない区分があって作品が重複したときは、
+    更新時刻が新しい行を残す、更新時刻の列がなければ後の行を残す。
+
+    Parameters
+    ----------
+    df: pandas.DataFrame
+        ncode列と区分のキーの列を持つ作品情報
+    index: NcodeIndex
+        作品ごとの最新の行を持つ区分の索引
+
+    Returns
+    -------
+    pandas.DataFrame
+        作品ごとに1行の作品情報、行の順はdfのまま
+    """
+    if len(df) == 0 or "ncode" not in df.columns:
+        return df
+    ncodes = df["ncode"].astype(str).str.upper()
+    current = index.current_partitions()
+    if current is not None:
+        partitions, indexed = current
+        keys = df[storage.key_column]
+        keep = ~keys.isin(indexed) | (ncodes.map(partitions) == keys)
+        df = df[keep]
+        ncodes = ncodes[keep]
+    if ncodes.is_unique:
+        return df
+    updated = updated_of(df).sort_values(kind="stable")
+    latest = ncodes[updated.index].drop_duplicates(keep="last").index
+    return df.loc[df.index.isin(latest)]
+
+
+def read_all_current(cache: storage.Storage,
+                     keys: Optional[List[str]],
+                     columns: Optional[List[str]],
+                     index: NcodeIndex) -> pandas.DataFrame:
+    """
+    区分をまとめて1回で読み、作品ごとに最新の行だけを返す
+
+    区分ごとにread_currentを呼ぶと、区分ごとにキャッシュと索引を読むので、
+    まとめて読めるときはこちらを使う。
+
+    Parameters
+    ----------
+    cache: storage.Storage
+        作品情報のキャッシュ
+    keys: List[str] or None
+        読み込む区分のキー、Noneのときはすべての区分
+    columns: List[str] or None
+        読み込む列、Noneのときはすべての列
+    index: NcodeIndex
+        作品ごとの最新の行を持つ区分の索引
+
+    Returns
+    -------
+    pandas.DataFrame
+        インデックスが0からの連番の作品情報
+    """
+    read_columns = columns
+    if columns is not None and "ncode" not in columns:
+        read_columns = ["ncode"] + columns
+    df = select_current(cache.read_with_keys(keys, read_columns), index)
+    if columns is None:
+        columns = [column for column in df.columns
+                   if column != storage.key_column]
+    return df[columns].reset_index(drop=True)
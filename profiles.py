@@ -0,0 +1,164 @@
+# 取得する項目を絞ったプロファイルと、絞った項目を前回のキャッシュから引き継ぐ
+
+import pandas
+from typing import List, Dict, Optional
+import storage
+
+
+# なろう小説APIの項目名と、ofパラメータで指定するときの記号
+# gensakuは現在使われておらず、指定する記号がない
+of_codes = {
+    "title": "t", "ncode": "n", "userid": "u", "writer": "w", "story": "s",
+    "biggenre": "bg", "genre": "g", "keyword": "k",
+    "general_firstup": "gf", "general_lastup": "gl", "novel_type": "nt",
+    "end": "e", "general_all_no": "ga", "length": "l", "time": "ti",
+    "isstop": "i", "isr15": "ir", "isbl": "ibl", "isgl": "igl",
+    "iszankoku": "izk", "istensei": "its", "istenni": "iti",
+    "pc_or_k": "p", "global_point": "gp", "daily_point": "dp",
+    "weekly_point": "wp", "monthly_point": "mp", "quarter_point": "qp",
+    "yearly_point": "yp", "fav_novel_cnt": "f", "impression_cnt": "imp",
+    "review_cnt": "r", "all_point": "a", "all_hyoka_cnt": "ah",
+    "sasie_cnt": "sa", "kaiwaritu": "ka", "novelupdated_at": "nu",
+    "updated_at": "ua"
+}
+
+# 長い文字列で、レスポンスの大半を占める項目
+heavy_fields = ["story"]
+
+# どのプロファイルでも取得する項目
+# ncodeの索引、作品長さでの分割、差分取得と引き継ぎに使う
+required_fields = ["ncode", "length", "novelupdated_at"]
+
+# プロファイル名と取得する項目、Noneはすべての項目
+profiles: Dict[str, Optional[List[str]]] = {
+    "full": None,
+    "light": [field for field in storage.api_columns
+              if field in of_codes and field not in heavy_fields],
+    "minimal": [
+        "ncode", "genre", "keyword", "general_firstup", "general_lastup",
+        "novel_type", "end", "length", "global_point", "fav_novel_cnt",
+        "all_point", "kaiwaritu", "novelupdated_at", "updated_at"
+    ]
+}
+
+
+def profile_fields(name: str) -> Optional[List[str]]:
+    """
+    プロファイルで取得する項目を返す
+
+    Parameters
+    ----------
+    name: str
+        プロファイル名、profilesのキー
+
+    Returns
+    -------
+    List[str] or None
+        取得する項目、required_fieldsを必ず含む
+        すべての項目を取得するときはNone
+    """
+    fields = profiles[name]
+    if fields is None:
+        return None
+    return required_fields + [field for field in fields
+                              if field not in required_fields]
+
+
+def of_param(fields: List[str]) -> str:
+    """
+    項目名のリストを、なろう小説APIのofパラメータにする
+
+    Parameters
+    ----------
+    fields: List[str]
+        なろう小説APIの項目名
+
+    Returns
+    -------
+    str
+        'n-l-nu'のような、記号をハイフンでつないだ文字列
+    """
+    return "-".join(of_codes[field] for field in fields)
+
+
+class ProfileWriter(storage.Writer):
+    """
+    プロファイルで取得しなかった項目を、区分の前回のキャッシュから補うWriter
+
+    前回から更新されていない作品、つまりncodeとnovelupdated_atが
+    前回と同じ作品は、取得しなかった項目に前回の値を入れる。
+    新しい作品や更新された作品は欠損値にするので、あとで取得しなおす
+    作品を欠損値で見分けられる。
+    前回のキャッシュは、最初のwriteのときに読み込む。
+    """
+
+    def __init__(self, cache: storage.Storage, key: str,
+                 writer: storage.Writer, fields: List[str]) -> None:
+        """
+        Parameters
+        ----------
+        cache: storage.Storage
+            作品情報のキャッシュ
+        key: str
+            区分のキー
+        writer: storage.Writer
+            区分のキャッシュのWriter
+        fields: List[str]
+            プロファイルで取得する項目
+        """
+        self.cache = cache
+        self.key = key
+        self.writer = writer
+        self.omitted = [field for field in storage.api_columns
+                        if field not in fields]
+        self.previous: Optional[pandas.DataFrame] = None
+
+    def load_previous(self) -> pandas.DataFrame:
+        """
+        区分の前回のキャッシュを、ncodeをインデックスにして読み込む
+        """
+        if self.previous is None:
+            df = self.cache.read([self.key])
+            if "ncode" not in df.columns \
+               or "novelupdated_at" not in df.columns:
+                df = pandas.DataFrame(columns=["ncode", "novelupdated_at"])
+            columns = ["novelupdated_at"] + [
+                column for column in self.omitted if column in df.columns]
+            self.previous = df.drop_duplicates("ncode", keep="last") \
+                .set_index("ncode")[columns]
+        return self.previous
+
+    def write(self, df: pandas.DataFrame) -> None:
+        if "ncode" not in df.columns:
+            self.writer.write(df)
+            self.written += len(df)
+            return
+        previous = self.load_previous().reindex(df["ncode"])
+        same = (previous["novelupdated_at"].astype(str).values
+                == df["novelupdated_at"].astype(str).values)
+        columns: Dict[str, pandas.Series] = {}
+        for column in self.omitted:
+            if column in df.columns:
+                continue
+            if column in previous.columns:
+                values = previous[column].where(same).values
+            else:
+                values = None
+            columns[column] = pandas.Series(values, index=df.index,
+                                            dtype=object)
+        if columns:
+            df = df.assign(**columns)
+        self.writer.write(df)
+        self.written += len(df)
+
+    def completed(self, unit: str) -> bool:
+        return self.writer.completed(unit)
+
+    def checkpoint(self, unit: str) -> None:
+        self.writer.checkpoint(unit)
+
+    def commit(self) -> None:
+        self.writer.commit()
+
+    def abort(self) -> None:
+        self.writer.abort()
@@ -0,0 +1,61 @@
+# なろう小説APIへのリクエスト頻度を制限する
+
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    トークンバケット方式のレートリミッタ
+
+    バケットには毎秒rate個のトークンが補充され、最大capacity個まで貯まる。
+    リクエストの前にacquireを呼ぶと、トークンを1個消費する。
+    トークンが足りないときは、補充されるまで呼び出し元のスレッドを待たせる。
+
+    複数のスレッドから共有して使うことで、並列に取得していても
+    全体のリクエスト頻度をrate[回/s]以下に抑えられる。
+    """
+
+    def __init__(self, rate: float, capacity: int = 1) -> None:
+        """
+        Parameters
+        ----------
+        rate: float
+            1秒あたりに補充されるトークン数[回/s]
+        capacity: int, default 1
+            バケットに貯められるトークンの最大数、瞬間的に許すリクエスト数
+        """
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        if capacity < 1:
+            raise ValueError("capacity must be 1 or more")
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.timestamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        トークンを1個消費する、足りなければ補充されるまで待つ
+
+        トークンはロックの中で予約し、待ち時間はロックの外で眠る。
+        そのため、待っているスレッドが他のスレッドの予約を妨げない。
+
+        Returns
+        -------
+        float
+            待った時間[s]
+        """
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.timestamp
+            self.timestamp = now
+            self.tokens = min(float(self.capacity),
+                              self.tokens + elapsed * self.rate)
+            self.tokens -= 1
+            # トークンが負なら、0に戻るまでの時間だけ待つ
+            wait = max(0.0, -self.tokens / self.rate)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
@@ -0,0 +1,260 @@
+# ブックマークの好みから、キャッシュした小説のおすすめを計算する
+
+import argparse
+import pathlib
+import numpy
+import pandas
+from typing import Optional
+import narou
+import corpus
+import storage
+from bookmark import NarouBookmark
+from features import Features, feature_columns, make_features
+from featurestore import load_features
+
+
+class Recommender:
+    """
+    ブックマークのpointを、作品の特徴量から予測しておすすめを選ぶ
+
+    モデルは特徴量ごとに独立なリッジ回帰で、特徴量jの重みは
+      w_j = Σ_i (y_i - center) x_ij / (Σ_i x_ij^2 + alpha)
+    になる。
+    ここでy_iはブックマークした作品iのpoint、centerはpointの中央の1である。
+    学習も採点も疎行列の積1回で済むので、数十万作品でも数秒で終わる。
+
+    重みの分子と分母は作品ごとの和なので、学習した和を持っておけば、
+    ブックマークが変わったときは変わった作品の分だけ足し引きすればよい。
+    updateは前回のブックマークとの差分で和を更新し、重みが変わった
+    特徴量の列だけをCSC形式の行列から切り出して、スコアを更新する。
+    """
+
+    # pointの中央、これより好きなら正、嫌いなら負の重みになる
+    center = 1.0
+
+    def __init__(self, features: Features, alpha: float = 1.0) -> None:
+        """
+        Parameters
+        ----------
+        features: Features
+            おすすめの候補になる作品の特徴量
+        alpha: float, default 1.0
+            重みを0に近づける正則化の強さ
+        """
+        self.features = features
+        self.alpha = alpha
+        n, m = features.matrix.shape
+        self.weights = numpy.zeros(m)
+        self.bookmarked = numpy.zeros(n, dtype=bool)
+        # 重みの分子と分母の、ブックマークした作品についての和
+        self.numerator = numpy.zeros(m)
+        self.denominator = numpy.zeros(m)
+        # 学習したブックマークの、行番号からpointへの対応
+        self.labels = pandas.Series([], dtype=float)
+        # すべての作品のスコア、scoresを呼ぶまではNone
+        self.cached_scores: Optional[numpy.ndarray] = None
+
+    def labels_of(self, bookmarks: pandas.DataFrame) -> pandas.Series:
+        """
+        ブックマークを、特徴量の行番号からpointへの対応にする
+
+        特徴量にない作品は除き、同じ作品が複数あれば最後のものを使う。
+        """
+        index = self.features.index(list(bookmarks["ncode"]))
+        points = pandas.Series(bookmarks["point"].to_numpy(dtype=float),
+                               index=index)
+        points = points[points.index >= 0]
+        return points[~points.index.duplicated(keep="last")]
+
+    def fit(self, bookmarks: pandas.DataFrame) -> "Recommender":
+        """
+        ブックマークのpointから重みを学習する
+
+        Parameters
+        ----------
+        bookmarks: pandas.DataFrame
+            ncode列とpoint列を持つブックマーク、NarouBookmark.getの結果
+
+        Returns
+        -------
+        Recommender
+            学習したself
+        """
+        labels = self.labels_of(bookmarks)
+        rows = labels.index.to_numpy()
+        x = self.features.matrix[rows]
+        self.numerator = numpy.asarray(
+            x.T @ (labels.to_numpy() - Recommender.center)).ravel()
+        self.denominator = numpy.asarray(x.multiply(x).sum(axis=0)).ravel()
+        self.weights = self.numerator / (self.denominator + self.alpha)
+        self.bookmarked = numpy.zeros(len(self.features.ncodes), dtype=bool)
+        self.bookmarked[rows] = True
+        self.labels = labels
+        self.cached_scores = None
+        return self
+
+    def update(self, bookmarks: pandas.DataFrame) -> int:
+        """
+        前回学習したブックマークとの差分だけで、重みとスコアを更新する
+
+        追加、削除、pointが変わった作品の分だけ重みの分子と分母を足し引きし、
+        それらの作品が持つ特徴量の重みを計算しなおす。
+        スコアは、重みが変わった特徴量を持つ作品の分だけを更新する。
+
+        Parameters
+        ----------
+        bookmarks: pandas.DataFrame
+            ncode列とpoint列を持つ、新しいブックマーク全体
+
+        Returns
+        -------
+        int
+            変わったブックマークの数
+        """
+        labels = self.labels_of(bookmarks)
+        rows = self.labels.index.union(labels.index)
+        old = self.labels.reindex(rows)
+        new = labels.reindex(rows)
+        changed = (old != new) & (old.notna() | new.notna())
+        if not changed.any():
+            return 0
+        old, new = old[changed], new[changed]
+        rows = new.index.to_numpy()
+        x = self.features.matrix[rows]
+        center = Recommender.center
+        self.numerator += numpy.asarray(
+            x.T @ ((new - center).fillna(0).to_numpy()
+                   - (old - center).fillna(0).to_numpy())).ravel()
+        self.denominator += numpy.asarray(
+            x.multiply(x).T @ (new.notna().to_numpy(dtype=float)
+                               - old.notna().to_numpy(dtype=float))).ravel()
+        columns = numpy.unique(x.indices)
+        weights = self.numerator[columns] \
+            / (self.denominator[columns] + self.alpha)
+        delta = weights - self.weights[columns]
+        self.weights[columns] = weights
+        if self.cached_scores is not None:
+            # 重みが変わった列を持つ作品のスコアだけが変わる
+            self.cached_scores += numpy.asarray(
+                self.features.csc()[:, columns] @ delta).ravel()
+        self.bookmarked[rows] = new.notna().to_numpy()
+        self.labels = labels
+        return len(rows)
+
+    def scores(self) -> numpy.ndarray:
+        """
+        すべての作品の予測pointから中央を引いたスコアを返す
+        """
+        if self.cached_scores is None:
+            self.cached_scores = numpy.asarray(
+                self.features.matrix @ self.weights).ravel()
+        return self.cached_scores
+
+    def recommend(self, k: int = 10) -> pandas.DataFrame:
+        """
+        ブックマークしていない作品から、スコアの高い順にk件を返す
+
+        Parameters
+        ----------
+        k: int, default 10
+            返す作品数
+
+        Returns
+        -------
+        pandas.DataFrame
+            ncode列とscore列を持つ、スコアの高い順のおすすめ
+        """
+        return top_k(self.scores(), self.bookmarked, self.features.ncodes, k)
+
+    def save(self, filename: str) -> None:
+        """
+        学習した和とブックマーク、スコアをnpzファイルに書き出す
+        """
+        numpy.savez(filename, version=numpy.array(self.features.version),
+                    alpha=numpy.array(self.alpha),
+                    numerator=self.numerator, denominator=self.denominator,
+                    rows=self.labels.index.to_numpy(),
+                    points=self.labels.to_numpy(), scores=self.scores())
+
+    @classmethod
+    def load(cls, filename: str, features: Features,
+             alpha: float = 1.0) -> Optional["Recommender"]:
+        """
+        saveで書き出したモデルを読み込む
+
+        Returns
+        -------
+        Recommender or None
+            読み込んだモデル、ファイルがないときや、書き出したときと
+            特徴量の版やalphaが違うときはNone
+        """
+        if not features.version or not pathlib.Path(filename).exists():
+            return None
+        with numpy.load(filename) as f:
+            if str(f["version"]) != features.version \
+               or float(f["alpha"]) != alpha:
+                return None
+            model = cls(features, alpha)
+            model.numerator = f["numerator"]
+            model.denominator = f["denominator"]
+            model.labels = pandas.Series(f["points"], index=f["rows"])
+            model.cached_scores = f["scores"]
+        model.weights = model.numerator / (model.denominator + alpha)
+        model.bookmarked[model.labels.index.to_numpy()] = True
+        return model
+
+
+def top_k(scores: numpy.ndarray, excluded: numpy.ndarray,
+          ncodes: numpy.ndarray, k: int) -> pandas.DataFrame:
+    """
+    除外する作品以外から、スコアの高い順にk件を選ぶ
+
+    全件を並べ替えず、argpartitionで上位k件を選んでから並べる。
+    """
+    scores = numpy.where(excluded, -numpy.inf, scores)
+    k = min(k, int((~excluded).sum()))
+    if k <= 0:
+        return pandas.DataFrame({"ncode": [], "score": []})
+    top = numpy.argpartition(-scores, k - 1)[:k]
+    top = top[numpy.argsort(-scores[top], kind="stable")]
+    return pandas.DataFrame({"ncode": ncodes[top], "score": scores[top]})
+
+
+def model_filename() -> str:
+    return str(pathlib.Path(narou.dirname).joinpath("recommender.npz"))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="ブックマークの好みから、キャッシュした小説をおすすめする")
+    parser.add_argument("-k", type=int, default=20, help="おすすめする作品数")
+    parser.add_argument("--storage", choices=storage.storage_kinds,
+                        default="sqlite", help="キャッシュの保存先")
+    parser.add_argument("--genre", action="append", default=None,
+                        help="候補にするジャンル、複数指定できる")
+    args = parser.parse_args()
+    narou.set_storage(args.storage)
+    keys = None if args.genre is None else narou.select_keys(args.genre)
+    naroubookmark = NarouBookmark()
+    naroubookmark.login_narou()
+    bookmarks = naroubookmark.get()
+    if keys is None:
+        # すべての区分の特徴量は、保存したものを読み込む
+        features = load_features(narou.cache, narou.manifest)
+        # 前回のモデルがあれば、変わったブックマークの分だけ更新する
+        recommender = Recommender.load(model_filename(), features)
+        if recommender is None:
+            recommender = Recommender(features).fit(bookmarks)
+        else:
+            recommender.update(bookmarks)
+        recommender.save(model_filename())
+    else:
+        features = make_features(
+            corpus.load(narou.cache, feature_columns, keys,
+                        index=narou.ncode_index))
+        recommender = Recommender(features).fit(bookmarks)
+    print(recommender.recommend(args.k))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+# 変わっていそうな区分から順に、1時間あたりのリクエスト数の予算内で取得し続ける
+
+import heapq
+import math
+import time
+from typing import List, Dict, Any, Callable, Optional, Tuple
+from manifest import Manifest
+
+
+# 作品数が増えていない区分も、これだけ増えているとみなす[作品/日]
+# 長く取得していない区分も、いつかは取得されるようにする
+staleness_rate = 1 / 30
+
+# 作品数の増え方の指数移動平均で、1回の観測にかける重み
+growth_weight = 0.5
+
+# 1日の秒数
+day_seconds = 24 * 60 * 60
+
+
+def update_growth(entry: Optional[Dict[str, Any]], allcount: int,
+                  now: float) -> float:
+    """
+    区分の作品数を観測して、1日あたりに増える作品数を更新する
+
+    前回観測した作品数との差を経過日数で割り、指数移動平均をとる。
+    作品が削除されて減ったときは0として扱う。
+
+    Parameters
+    ----------
+    entry: Dict[str, Any] or None
+        区分の目録の記録、checked_at、checked_allcount、growthを使う
+    allcount: int
+        いま観測した作品数
+    now: float
+        観測した時刻（unixtime）
+
+    Returns
+    -------
+    float
+        1日あたりに増える作品数
+    """
+    if entry is None:
+        return 0.0
+    if "checked_at" not in entry or "checked_allcount" not in entry:
+        return float(entry.get("growth", 0.0))
+    days = (now - float(entry["checked_at"])) / day_seconds
+    if days <= 0:
+        return float(entry.get("growth", 0.0))
+    rate = max(0, allcount - int(entry["checked_allcount"])) / days
+    if "growth" not in entry:
+        return rate
+    return growth_weight * rate \
+        + (1 - growth_weight) * float(entry["growth"])
+
+
+def priority(entry: Optional[Dict[str, Any]], now: float) -> float:
+    """
+    前回の取得から、区分で増えたと見込まれる作品数を返す
+
+    1日あたりに増える作品数に、前回の取得からの経過日数をかける。
+    更新された作品がなかった差分取得も、取得したものとして扱う。
+    取得の記録がなく、作品数を確認しただけの区分は、確認からの日数を使う。
+    取得したことのない区分は無限大になる。
+    """
+    if entry is None:
+        return math.inf
+    refreshed = [entry[field] for field in ["synced_at", "verified_at"]
+                 if field in entry]
+    since = max(refreshed) if refreshed \
+        else entry.get("fetched_at", entry.get("checked_at"))
+    if since is None:
+        return math.inf
+    days = max(0.0, (now - float(since)) / day_seconds)
+    rate = max(float(entry.get("growth", 0.0)), staleness_rate)
+    return rate * days
+
+
+def estimate_requests(entry: Optional[Dict[str, Any]],
+                      expected: float) -> int:
+    """
+    区分を取得するのにかかるリクエスト数を見積もる
+
+    差分取得は、作品数の確認2回と、増えた作品を500件ずつ取得する分になる。
+    取得したことのない区分は、記録にある作品数をすべて取得する分になる。
+    """
+    if math.isinf(expected):
+        count = 0 if entry is None \
+            else int(entry.get("allcount", entry.get("count", 0)))
+        return 2 + math.ceil(count / 500)
+    return 2 + math.ceil(expected / 500)
+
+
+class Scheduler:
+    """
+    増えたと見込まれる作品数が多い区分から順に、予算内で取得する
+
+    1時間ごとに、目録の記録から区分の優先度を計算して優先度つきキューを作り、
+    優先度の高い区分から取得する。
+    その時間に使ったリクエスト数と区分の見積もりの和が予算を越える区分は、
+    その時間は飛ばして、次に優先度の高い区分を試す。
+    """
+
+    def __init__(self, manifest: Manifest, keys: List[str],
+                 refresh: Callable[[str], Any],
+                 requests: Callable[[], float]) -> None:
+        """
+        Parameters
+        ----------
+        manifest: Manifest
+            区分ごとの取得状況の目録
+        keys: List[str]
+            取得する区分のキー
+        refresh: Callable[[str], Any]
+            区分のキーを受け取って、その区分を取得する関数
+        requests: Callable[[], float]
+            これまでに送ったリクエストの総数を返す関数
+        """
+        self.manifest = manifest
+        self.keys = keys
+        self.refresh = refresh
+        self.requests = requests
+        self.sleep: Callable[[float], None] = time.sleep
+
+    def queue(self, now: float) -> List[Tuple[float, str]]:
+        """
+        優先度の高い順に取り出せる、(-優先度, 区分のキー)のヒープを返す
+        """
+        heap = [(-priority(self.manifest.get(key), now), key)
+                for key in self.keys]
+        heapq.heapify(heap)
+        return heap
+
+    def run_once(self, budget: int) -> List[str]:
+        """
+        予算のリクエスト数まで、優先度の高い区分から取得する
+
+        Parameters
+        ----------
+        budget: int
+            使ってよいリクエスト数
+
+        Returns
+        -------
+        List[str]
+            取得した区分のキー
+        """
+        start = self.requests()
+        heap = self.queue(time.time())
+        refreshed: List[str] = []
+        while heap:
+            negative, key = heapq.heappop(heap)
+            if -negative <= 0:  # 増えたと見込まれる作品がない
+                break
+            spent = self.requests() - start
+            cost = estimate_requests(self.manifest.get(key), -negative)
+            if spent + cost > budget:
+                if spent + 2 > budget:  # もうどの区分も取得できない
+                    break
+                continue
+            self.refresh(key)
+            refreshed.append(key)
+        self.manifest.flush()   # touchでまとめた作品数の観測を書き出す
+        return refreshed
+
+    def run(self, budget: int, cycles: Optional[int] = None,
+            period: float = 60 * 60) -> None:
+        """
+        periodごとにrun_onceを繰り返す
+
+        Parameters
+        ----------
+        budget: int
+            periodごとに使ってよいリクエスト数
+        cycles: int, default None
+            繰り返す回数、Noneのときは止めるまで続ける
+        period: float, default 1時間
+            予算を使う期間[s]
+        """
+        cycle = 0
+        while cycles is None or cycle < cycles:
+            start = time.time()
+            refreshed = self.run_once(budget)
+            print("refreshed {0} partitions: {1}".format(
+                len(refreshed), " ".join(refreshed)))
+            cycle += 1
+            if cycles is None or cycle < cycles:
+                self.sleep(max(0.0, start + period - time.time()))
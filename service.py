@@ -0,0 +1,372 @@
+# 特徴量とモデルをメモリに置いたまま、複数のユーザーにおすすめを返すHTTPサーバー
+
+import argparse
+import collections
+import http.server
+import json
+import math
+import pathlib
+import threading
+import pandas
+from typing import List, Dict, Any, Optional, Tuple, Callable
+import narou
+import storage
+from bookmark import NarouBookmark, bookmark_digest
+from features import Features
+from featurestore import FeatureStore, store_dirname
+from recommender import Recommender
+
+
+CacheKey = Tuple[str, str, str]
+
+# 1件の要求の、ユーザー名、作品数、省略できるブックマーク
+Request = Tuple[str, int, Optional[pandas.DataFrame]]
+
+
+class RequestError(ValueError):
+    """
+    送られた要求の形が正しくない、HTTPでは400を返す
+    """
+    pass
+
+
+def parse_request(request: Any) -> Request:
+    """
+    1件の要求を確かめて、ユーザー名、作品数、ブックマークにする
+
+    Parameters
+    ----------
+    request: Any
+        userとk、省略できるbookmarksを持つ辞書
+        bookmarksはncodeとpointを持つ辞書のリスト
+
+    Returns
+    -------
+    Request
+        ユーザー名、作品数、ブックマーク、bookmarksがなければNone
+
+    Raises
+    ------
+    RequestError
+        userがない、kが正の整数でない、ブックマークのpointが数値でないとき
+    """
+    if not isinstance(request, dict):
+        raise RequestError("request must be an object")
+    user = request.get("user")
+    if not isinstance(user, str) or user == "":
+        raise RequestError("user must be a non-empty string")
+    k = request.get("k", 20)
+    if isinstance(k, bool) or not isinstance(k, int) or k <= 0:
+        raise RequestError("k must be a positive integer")
+    if "bookmarks" not in request:
+        return user, k, None
+    bookmarks = request["bookmarks"]
+    if not isinstance(bookmarks, list):
+        raise RequestError("bookmarks must be a list")
+    rows: List[Tuple[str, float]] = []
+    for bookmark in bookmarks:
+        if not isinstance(bookmark, dict) \
+           or not isinstance(bookmark.get("ncode"), str):
+            raise RequestError("bookmark must have a string ncode")
+        point = bookmark.get("point")
+        if isinstance(point, bool) or not isinstance(point, (int, float)) \
+           or not math.isfinite(point):
+            raise RequestError("bookmark must have a numeric point")
+        rows.append((bookmark["ncode"], float(point)))
+    return user, k, pandas.DataFrame(rows, columns=["ncode", "point"])
+
+
+class UserModel:
+    """
+    ユーザーのモデルと、そのモデルを学習するときにとるロック
+
+    ユーザーごとにロックをとるので、あるユーザーの学習が遅くても、
+    他のユーザーの要求は待たされない。
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.model: Optional[Recommender] = None
+
+
+class RecommendService:
+    """
+    ユーザーごとのブックマークから、おすすめを計算して返す
+
+    特徴量は一度読み込んだらメモリに置いたままにし、特徴量の版が
+    変わったときだけ読み込みなおす。
+    ユーザーごとのモデルもmax_models人分まで置いたままにし、
+    ブックマークが変わったときはRecommender.updateで変わった分だけ更新する。
+    おすすめは(ユーザー, ブックマークのハッシュ, 特徴量の版)ごとに
+    max_entries件までキャッシュする。
+    どちらも、最後に使ったのが古いものから捨てる。
+    """
+
+    def __init__(self, load: Callable[[], Features],
+                 version: Callable[[], str],
+                 settings: Dict[str, str],
+                 max_entries: int = 1024,
+                 max_models: int = 64) -> None:
+        """
+        Parameters
+        ----------
+        load: Callable[[], Features]
+            特徴量を読み込む関数
+        version: Callable[[], str]
+            いまの特徴量の版を返す関数、読み込んだ版と違えば読み込みなおす
+        settings: Dict[str, str]
+            ユーザー名から、そのユーザーのsetting.iniへの辞書
+        max_entries: int, default 1024
+            キャッシュするおすすめの最大数
+        max_models: int, default 64
+            置いたままにするユーザーのモデルの最大数
+        """
+        self.load = load
+        self.version = version
+        self.settings = settings
+        self.max_entries = max_entries
+        self.max_models = max_models
+        # 特徴量、モデルとキャッシュの辞書を守るロック、学習中はとらない
+        self.lock = threading.Lock()
+        self.features: Optional[Features] = None
+        self.models: "collections.OrderedDict[str, UserModel]" \
+            = collections.OrderedDict()
+        self.bookmarks: Dict[str, NarouBookmark] = {}
+        # (ユーザー, ブックマークのハッシュ, 特徴量の版)からおすすめへの辞書
+        self.cache: "collections.OrderedDict[CacheKey, pandas.DataFrame]" \
+            = collections.OrderedDict()
+        self.hits = 0
+
+    def current_features(self) -> Features:
+        """
+        特徴量を返す、版が変わっていれば読み込みなおしてモデルを捨てる
+        """
+        version = self.version()
+        if self.features is None or self.features.version != version:
+            self.features = self.load()
+            self.models.clear()
+        return self.features
+
+    def user_model(self, user: str) -> UserModel:
+        """
+        ユーザーのモデルを返す、なければ作り、max_modelsを越えた分は捨てる
+
+        selfのロックをとってから呼ぶ。
+        """
+        slot = self.models.get(user)
+        if slot is None:
+            slot = UserModel()
+            self.models[user] = slot
+        self.models.move_to_end(user)
+        while len(self.models) > self.max_models:
+            self.models.popitem(last=False)
+        return slot
+
+    def fetch_bookmarks(self, user: str) -> pandas.DataFrame:
+        """
+        ユーザーのブックマークをなろうから取得する
+
+        ログインのクッキーとブックマーク一覧のキャッシュは、ユーザーごとの
+        ディレクトリに置く。
+        """
+        if user not in self.bookmarks:
+            naroubookmark = NarouBookmark(str(pathlib.Path(
+                narou.dirname).joinpath("users", user)))
+            naroubookmark.login_narou(self.settings[user])
+            self.bookmarks[user] = naroubookmark
+        return self.bookmarks[user].get()
+
+    def recommend(self, user: str, k: int,
+                  bookmarks: Optional[pandas.DataFrame] = None
+                  ) -> Dict[str, Any]:
+        """
+        ユーザーへのおすすめをk件返す
+
+        Parameters
+        ----------
+        user: str
+            ユーザー名
+        k: int
+            返す作品数
+        bookmarks: pandas.DataFrame, default None
+            ncode列とpoint列を持つブックマーク、Noneのときはなろうから取得する
+
+        Returns
+        -------
+        Dict[str, Any]
+            user、version、cached、recommendationsを持つ辞書
+            recommendationsはncodeとscoreを持つ辞書のリスト
+        """
+        if bookmarks is None:
+            if user not in self.settings:
+                return {"user": user, "error": "unknown user"}
+            bookmarks = self.fetch_bookmarks(user)
+        digest = bookmark_digest(bookmarks)
+        with self.lock:
+            features = self.current_features()
+            key = (user, digest, features.version)
+            result = self.cache.get(key)
+            if result is not None and len(result) >= k:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return RecommendService.response(user, features.version,
+                                                 result, k, True)
+            slot = self.user_model(user)
+        with slot.lock:
+            # 特徴量を読み込みなおしていたら、モデルは学習しなおす
+            if slot.model is None or slot.model.features is not features:
+                slot.model = Recommender(features).fit(bookmarks)
+            else:
+                slot.model.update(bookmarks)
+            result = slot.model.recommend(k)
+        with self.lock:
+            self.cache[key] = result
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.max_entries:
+                self.cache.popitem(last=False)
+        return RecommendService.response(user, features.version, result, k,
+                                         False)
+
+    @staticmethod
+    def response(user: str, version: str, result: pandas.DataFrame, k: int,
+                 cached: bool) -> Dict[str, Any]:
+        return {"user": user, "version": version, "cached": cached,
+                "recommendations": [
+                    {"ncode": str(ncode), "score": float(score)}
+                    for ncode, score in zip(result["ncode"][:k],
+                                            result["score"][:k])]}
+
+    def handle(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        まとめて送られたおすすめの要求に答える
+
+        Parameters
+        ----------
+        body: Dict[str, Any]
+            requestsに、userとk、省略できるbookmarksを持つ辞書のリスト
+            bookmarksはncodeとpointを持つ辞書のリスト
+
+        Returns
+        -------
+        Dict[str, Any]
+            resultsに、要求と同じ順でrecommendの結果のリスト
+
+        Raises
+        ------
+        RequestError
+            要求の形が正しくないとき、どの要求にも答える前に送出する
+        """
+        if not isinstance(body, dict) \
+           or not isinstance(body.get("requests"), list):
+            raise RequestError("body must have a list of requests")
+        requests = [parse_request(request) for request in body["requests"]]
+        return {"results": [self.recommend(user, k, bookmarks)
+                            for user, k, bookmarks in requests]}
+
+    def status(self) -> Dict[str, Any]:
+        with self.lock:
+            return {"version": None if self.features is None
+                    else self.features.version,
+                    "users": sorted(self.settings),
+                    "models": len(self.models),
+                    "cached": len(self.cache), "hits": self.hits}
+
+
+class ServiceServer(http.server.ThreadingHTTPServer):
+    """
+    RecommendServiceをHTTPで公開するサーバー
+
+    POST /recommend にJSONで要求を送ると、JSONでおすすめを返す。
+    GET /status で特徴量の版とキャッシュの状況を返す。
+    """
+
+    def __init__(self, service: RecommendService, host: str = "127.0.0.1",
+                 port: int = 0) -> None:
+        super().__init__((host, port), ServiceHandler)
+        self.service = service
+
+    @property
+    def url(self) -> str:
+        return "http://{0}:{1}/".format(*self.server_address[:2])
+
+
+class ServiceHandler(http.server.BaseHTTPRequestHandler):
+    server: ServiceServer
+
+    def do_GET(self) -> None:
+        if self.path != "/status":
+            self.send_error(404)
+            return
+        self.send_json(self.server.service.status())
+
+    def do_POST(self) -> None:
+        if self.path != "/recommend":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            self.send_json({"error": "body must be JSON"}, 400)
+            return
+        try:
+            result = self.server.service.handle(body)
+        except RequestError as e:
+            self.send_json({"error": str(e)}, 400)
+            return
+        self.send_json(result)
+
+    def send_json(self, data: Dict[str, Any], status: int = 200) -> None:
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def read_settings(dirname: str) -> Dict[str, str]:
+    """
+    ディレクトリにある'ユーザー名.ini'から、ユーザー名と設定ファイルの辞書を作る
+    """
+    return {path.stem: str(path)
+            for path in sorted(pathlib.Path(dirname).glob("*.ini"))}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="複数のユーザーにおすすめを返すHTTPサーバー")
+    parser.add_argument("--port", type=int, default=8080,
+                        help="待ち受けるポート")
+    parser.add_argument("--users", default="users",
+                        help="ユーザーごとの'ユーザー名.ini'を置いたディレクトリ")
+    parser.add_argument("--storage", choices=storage.storage_kinds,
+                        default="sqlite", help="キャッシュの保存先")
+    parser.add_argument("--max-entries", type=int, default=1024,
+                        help="キャッシュするおすすめの最大数")
+    parser.add_argument("--max-models", type=int, default=64,
+                        help="置いたままにするユーザーのモデルの最大数")
+    args = parser.parse_args()
+    narou.set_storage(args.storage)
+    store = FeatureStore(store_dirname())
+    store.build(narou.cache, narou.manifest)
+
+    def load() -> Features:
+        features = store.load()
+        assert features is not None
+        return features
+
+    def version() -> str:
+        current = store.current()
+        return "" if current is None else str(current["version"])
+
+    service = RecommendService(load, version, read_settings(args.users),
+                               args.max_entries, args.max_models)
+    service.current_features()  # 最初の要求を待たずに読み込んでおく
+    server = ServiceServer(service, port=args.port)
+    print("serving on " + server.url)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
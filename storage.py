@@ -0,0 +1,841 @@
+# なろう小説の作品情報のキャッシュを保存、読み込みする
+
+import os
+import pathlib
+import sqlite3
+import pandas
+import itertools
+from concurrent import futures
+from typing import List, Optional, Iterable, Type, Dict, Any, Callable
+
+
+# write_rowsで1回のwriteにまとめる行数
+chunk_rows = 100
+
+# なろう小説APIが全項目を出力するときの列名と順序
+# 以前のnarou.pyはヘッダーなしでcsvを書いていたので、その読み込みに使う
+api_columns = [
+    "title", "ncode", "userid", "writer", "story", "biggenre", "genre",
+    "gensaku", "keyword", "general_firstup", "general_lastup", "novel_type",
+    "end", "general_all_no", "length", "time", "isstop", "isr15", "isbl",
+    "isgl", "iszankoku", "istensei", "istenni", "pc_or_k", "global_point",
+    "daily_point", "weekly_point", "monthly_point", "quarter_point",
+    "yearly_point", "fav_novel_cnt", "impression_cnt", "review_cnt",
+    "all_point", "all_hyoka_cnt", "sasie_cnt", "kaiwaritu",
+    "novelupdated_at", "updated_at"
+]
+
+
+class Writer:
+    """
+    1つの区分の作品情報をまとめて書き込むためのオブジェクト
+
+    writeで書き込んだデータは、commitするまで読み込み側からは見えない。
+    commitすると、その区分の以前のキャッシュと丸ごと置き換わる。
+    with文で使うと、例外なく抜けたときにcommit、例外のときにabortする。
+    """
+
+    # writeで書き込んだ作品数
+    written = 0
+
+    def write(self, df: pandas.DataFrame) -> None:
+        """
+        作品情報を書き込む
+
+        Parameters
+        ----------
+        df: pandas.DataFrame
+            書き込む作品情報
+        """
+        raise NotImplementedError
+
+    def write_rows(self, rows: Iterable[Dict[str, Any]]) -> None:
+        """
+        作品情報を1行ずつ受け取って、chunk_rows行ずつ書き込む
+
+        一度にメモリに持つのはchunk_rows行だけなので、rowsにジェネレータを
+        与えれば、全体の行数によらず使うメモリが一定になる。
+
+        Parameters
+        ----------
+        rows: Iterable[Dict[str, Any]]
+            書き込む作品情報、1要素が1作品
+        """
+        iterator = iter(rows)
+        while True:
+            chunk = list(itertools.islice(iterator, chunk_rows))
+            if len(chunk) == 0:
+                return
+            self.write(pandas.DataFrame.from_records(chunk))
+
+    def completed(self, unit: str) -> bool:
+        """
+        中断した前回の取得で、単位の書き込みが済んでいるかを返す
+
+        既定のWriterは途中から再開できないので、常にFalseを返す。
+
+        Parameters
+        ----------
+        unit: str
+            取得の単位、APIの1ページなど
+        """
+        return False
+
+    def checkpoint(self, unit: str) -> None:
+        """
+        ここまでに書き込んだ作品情報を、単位の書き込みとして確定する
+
+        既定のWriterは何もしない。
+
+        Parameters
+        ----------
+        unit: str
+            取得の単位、APIの1ページなど
+        """
+
+    def commit(self) -> None:
+        """
+        書き込んだ作品情報で、区分のキャッシュを置き換える
+        """
+        raise NotImplementedError
+
+    def abort(self) -> None:
+        """
+        書き込んだ作品情報を捨てて、区分のキャッシュを元のままにする
+        """
+        raise NotImplementedError
+
+    def __enter__(self) -> "Writer":
+        return self
+
+    def __exit__(self, exc_type: Optional[Type[BaseException]],
+                 exc_value: Optional[BaseException],
+                 traceback: Any) -> None:
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+# Storage.read_with_keysで、各行の区分のキーを入れる列
+key_column = "partition"
+
+
+class Storage:
+    """
+    作品情報のキャッシュの保存先
+
+    キャッシュは区分ごとに管理する。
+    区分はジャンル、会話率、文体、タイプの組で、'201_0-10_1_re'のような
+    文字列のキーで指定する。
+    """
+
+    # 複数の区分をまとめて1回で読むほうが、区分ごとに読むより速いならTrue
+    # Trueの保存先は、read_parallelなどで区分ごとに並列に読まない
+    bulk_read = False
+
+    def writer(self, key: str) -> Writer:
+        """
+        区分のキャッシュを書き込むWriterを返す
+
+        Parameters
+        ----------
+        key: str
+            区分のキー
+
+        Returns
+        -------
+        Writer
+            区分のキャッシュを置き換えるWriter
+        """
+        raise NotImplementedError
+
+    def read(self, keys: Optional[Iterable[str]] = None,
+             columns: Optional[List[str]] = None) -> pandas.DataFrame:
+        """
+        キャッシュされている作品情報を読み込む
+
+        Parameters
+        ----------
+        keys: Iterable[str], default None
+            読み込む区分のキー、Noneのときはすべての区分
+        columns: List[str], default None
+            読み込む列、Noneのときはすべての列
+
+        Returns
+        -------
+        pandas.DataFrame
+            キャッシュされている作品情報
+        """
+        raise NotImplementedError
+
+    def read_with_keys(self, keys: Optional[Iterable[str]] = None,
+                       columns: Optional[List[str]] = None
+                       ) -> pandas.DataFrame:
+        """
+        作品情報を、各行の区分のキーをkey_column列に付けて読み込む
+
+        Parameters
+        ----------
+        keys: Iterable[str], default None
+            読み込む区分のキー、Noneのときはすべての区分
+        columns: List[str], default None
+            読み込む列、Noneのときはすべての列
+
+        Returns
+        -------
+        pandas.DataFrame
+            key_column列を加えた作品情報
+        """
+        if keys is None:
+            keys = self.keys()
+        return concat([self.read([key], columns).assign(**{key_column: key})
+                       for key in keys])
+
+    def count(self, key: str) -> int:
+        """
+        区分にキャッシュしている作品数を返す
+
+        Parameters
+        ----------
+        key: str
+            区分のキー
+
+        Returns
+        -------
+        int
+            キャッシュしている作品数、キャッシュがないときは0
+        """
+        raise NotImplementedError
+
+    def keys(self) -> List[str]:
+        """
+        キャッシュが存在する区分のキーを返す
+
+        Returns
+        -------
+        List[str]
+            区分のキーのリスト
+        """
+        raise NotImplementedError
+
+    def upsert(self, key: str, df: pandas.DataFrame) -> int:
+        """
+        区分のキャッシュに作品情報をncodeで上書き、または追加する
+
+        既定の実装は区分を読み込んで、まとめて書き直す。
+
+        Parameters
+        ----------
+        key: str
+            区分のキー
+        df: pandas.DataFrame
+            上書き、追加する作品情報、ncode列を持つ
+
+        Returns
+        -------
+        int
+            上書き、追加したあとに区分にキャッシュしている作品数
+        """
+        old = self.read([key])
+        if len(old) > 0 and len(df) > 0:
+            old = old[~old["ncode"].isin(df["ncode"])]
+        with self.writer(key) as writer:
+            writer.write(concat([old, df]))
+        return writer.written
+
+    def update_columns(self, key: str, df: pandas.DataFrame) -> int:
+        """
+        区分のキャッシュで、ncodeが一致する作品のdfにある列だけを書き換える
+
+        upsertと違い、dfにない列は元の値のまま残す。
+        既定の実装は区分を読み込んで、まとめて書き直す。
+
+        Parameters
+        ----------
+        key: str
+            区分のキー
+        df: pandas.DataFrame
+            書き換える作品情報、ncode列と書き換える列を持つ
+
+        Returns
+        -------
+        int
+            書き換えた行数
+        """
+        old = self.read([key])
+        if len(old) == 0 or len(df) == 0:
+            return 0
+        values = df.drop_duplicates("ncode", keep="last").set_index("ncode")
+        matched = old["ncode"].isin(values.index)
+        for column in values.columns:
+            new = old["ncode"].map(values[column])
+            if column in old.columns:
+                new = new.where(matched, old[column])
+            old[column] = new
+        with self.writer(key) as writer:
+            writer.write(old)
+        return int(matched.sum())
+
+    def upserter(self, key: str) -> "UpsertWriter":
+        """
+        区分のキャッシュにncodeで上書き、追加するWriterを返す
+
+        Parameters
+        ----------
+        key: str
+            区分のキー
+
+        Returns
+        -------
+        UpsertWriter
+            commitしたときにupsertするWriter
+        """
+        return UpsertWriter(self, key)
+
+
+class UpsertWriter(Writer):
+    def __init__(self, storage: Storage, key: str) -> None:
+        self.storage = storage
+        self.key = key
+        self.dfs: List[pandas.DataFrame] = []
+        # upsertしたあとに区分にキャッシュしている作品数
+        self.count = 0
+
+    def write(self, df: pandas.DataFrame) -> None:
+        self.written += len(df)
+        self.dfs.append(df)
+
+    def commit(self) -> None:
+        self.count = self.storage.upsert(self.key, concat(self.dfs))
+
+    def abort(self) -> None:
+        self.dfs = []
+
+
+def concat(dfs: List[pandas.DataFrame]) -> pandas.DataFrame:
+    """
+    DataFrameのリストを1回の連結でまとめる
+
+    Parameters
+    ----------
+    dfs: List[pandas.DataFrame]
+        連結するDataFrame
+
+    Returns
+    -------
+    pandas.DataFrame
+        連結したDataFrame、リストが空のときは空のDataFrame
+    """
+    if len(dfs) == 0:
+        return pandas.DataFrame()
+    return pandas.concat(dfs, ignore_index=True, sort=False)
+
+
+class CsvWriter(Writer):
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self.tmppath = path.with_name(path.name + ".tmp")
+        self.columns: Optional[List[str]] = None
+        # 前回の書きかけは捨てる
+        if self.tmppath.exists():
+            self.tmppath.unlink()
+
+    def write(self, df: pandas.DataFrame) -> None:
+        self.written += len(df)
+        if self.columns is None:
+            self.columns = list(df.columns)
+            header = True
+        else:
+            # 追記するので、列を先頭のヘッダーに合わせる
+            df = df.reindex(columns=self.columns)
+            header = False
+        df.to_csv(self.tmppath, index=False, header=header, mode="a")
+
+    def commit(self) -> None:
+        if self.tmppath.exists():
+            os.replace(str(self.tmppath), str(self.path))
+        elif self.path.exists():  # 0件なら空のキャッシュにする
+            self.path.unlink()
+
+    def abort(self) -> None:
+        if self.tmppath.exists():
+            self.tmppath.unlink()
+
+
+class CsvStorage(Storage):
+    """
+    区分ごとに1つのcsvファイルへ保存する
+
+    ファイルは'output/201_0-10_1_re.csv'のようになり、先頭にヘッダーを持つ。
+    """
+
+    def __init__(self, dirname: str) -> None:
+        self.dirname = dirname
+
+    def path(self, key: str) -> pathlib.Path:
+        return pathlib.Path(self.dirname).joinpath(key + ".csv")
+
+    def writer(self, key: str) -> Writer:
+        return CsvWriter(self.path(key))
+
+    @staticmethod
+    def read_csv(path: pathlib.Path,
+                 columns: Optional[List[str]] = None) -> pandas.DataFrame:
+        """
+        キャッシュのcsvファイルを読み込む
+
+        ヘッダーのない古い形式のファイルは、api_columnsを列名として読む。
+        """
+        with open(path, encoding="utf-8") as f:
+            first = f.readline()
+        if "ncode" in first.rstrip("\n").split(","):
+            return pandas.read_csv(path, usecols=columns)
+        return pandas.read_csv(path, header=None, names=api_columns,
+                               usecols=columns)
+
+    def read(self, keys: Optional[Iterable[str]] = None,
+             columns: Optional[List[str]] = None) -> pandas.DataFrame:
+        if keys is None:
+            keys = self.keys()
+        dfs = [CsvStorage.read_csv(self.path(key), columns)
+               for key in keys if self.path(key).exists()]
+        return concat(dfs)
+
+    def count(self, key: str) -> int:
+        path = self.path(key)
+        if not path.exists():
+            return 0
+        return len(CsvStorage.read_csv(path, ["ncode"]))
+
+    def keys(self) -> List[str]:
+        return sorted(path.stem for path
+                      in pathlib.Path(self.dirname).glob("*.csv"))
+
+
+class SqliteWriter(Writer):
+    def __init__(self, storage: "SqliteStorage", key: str) -> None:
+        self.key = key
+        self.con = storage.connect()
+        # 一時テーブルに貯めておき、commitで一気に置き換える
+        # 一時テーブルへの書き込みはデータベース本体をロックしないので、
+        # 並列取得中の他の区分の書き込みを妨げない
+        self.con.execute("CREATE TEMP TABLE staging (dummy)")
+        self.columns: List[str] = []
+
+    def write(self, df: pandas.DataFrame) -> None:
+        if len(df) == 0:
+            return
+        self.written += len(df)
+        add_columns(self.con, "temp.staging", self.columns, df.columns)
+        insert_rows(self.con, "temp.staging", df)
+
+    def commit(self) -> None:
+        try:
+            self.con.execute("BEGIN IMMEDIATE")
+            table_columns = SqliteStorage.table_columns(self.con)
+            add_columns(self.con, "novels", table_columns, self.columns)
+            self.con.execute("DELETE FROM novels WHERE partition = ?",
+                             (self.key,))
+            if len(self.columns) > 0:
+                names = ", ".join(quote(name) for name in self.columns)
+                self.con.execute(
+                    "INSERT INTO novels (partition, {0}) "
+                    "SELECT ?, {0} FROM temp.staging".format(names),
+                    (self.key,))
+            self.con.execute("COMMIT")
+        except BaseException:
+            self.con.execute("ROLLBACK")
+            raise
+        finally:
+            self.con.close()
+
+    def abort(self) -> None:
+        self.con.close()
+
+
+def add_columns(con: sqlite3.Connection, table: str,
+                columns: List[str], new_columns: Iterable[str]) -> None:
+    """
+    テーブルにない列を追加する
+
+    Parameters
+    ----------
+    con: sqlite3.Connection
+        データベースへの接続
+    table: str
+        列を追加するテーブル
+    columns: List[str]
+        テーブルに既にある列、追加した列はこのリストにも加える
+    new_columns: Iterable[str]
+        テーブルに必要な列
+    """
+    for column in new_columns:
+        if column not in columns:
+            con.execute("ALTER TABLE {0} ADD COLUMN {1}".format(
+                table, quote(column)))
+            columns.append(column)
+
+
+def insert_rows(con: sqlite3.Connection, table: str,
+                df: pandas.DataFrame, key: Optional[str] = None) -> None:
+    """
+    DataFrameの行をテーブルに挿入する
+
+    Parameters
+    ----------
+    con: sqlite3.Connection
+        データベースへの接続
+    table: str
+        挿入先のテーブル、dfの列をすべて持っている必要がある
+    df: pandas.DataFrame
+        挿入する行
+    key: str, default None
+        与えたときは、partition列に区分のキーとして入れる
+    """
+    names = list(df.columns)
+    prefix: List[Any] = []
+    if key is not None:
+        names = ["partition"] + names
+        prefix = [key]
+    sql = "INSERT INTO {0} ({1}) VALUES ({2})".format(
+        table, ", ".join(quote(name) for name in names),
+        ", ".join("?" for _ in names))
+    values = df.astype(object).where(df.notna(), None).values.tolist()
+    con.executemany(sql, (prefix + row for row in values))
+
+
+def quote(name: str) -> str:
+    """
+    SQLの識別子として列名をクォートする
+    """
+    return '"' + name.replace('"', '""') + '"'
+
+
+# SqliteStorageで、1つのクエリのIN句に並べる区分のキーの最大数
+sqlite_max_keys = 500
+
+
+class SqliteStorage(Storage):
+    """
+    すべての区分を1つのSQLiteデータベースへ保存する
+
+    作品情報はnovelsテーブルに入り、partition列に区分のキーを持つ。
+    列はなろう小説APIが返した項目に応じて追加していく。
+    区分ごとに読むと、そのたびに接続してクエリを投げるので、
+    複数の区分は1回のクエリでまとめて読む。
+    """
+
+    bulk_read = True
+
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+
+    def connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.filename, timeout=60,
+                              isolation_level=None)
+        con.execute("CREATE TABLE IF NOT EXISTS novels (partition TEXT)")
+        con.execute("CREATE INDEX IF NOT EXISTS novels_partition "
+                    "ON novels (partition)")
+        return con
+
+    @staticmethod
+    def table_columns(con: sqlite3.Connection) -> List[str]:
+        rows = con.execute("PRAGMA table_info(novels)").fetchall()
+        return [row[1] for row in rows]
+
+    def writer(self, key: str) -> Writer:
+        return SqliteWriter(self, key)
+
+    @staticmethod
+    def select(con: sqlite3.Connection, columns: List[str],
+               keys: Optional[Iterable[str]]) -> pandas.DataFrame:
+        """
+        区分の列を読む、keysがNoneならWHERE句なしですべての区分を読む
+
+        SQLite 3.32より前は、1つのクエリのプレースホルダーが999個までなので、
+        区分のキーはsqlite_max_keys個ずつに分けて問い合わせる。
+        """
+        sql = "SELECT {0} FROM novels".format(
+            ", ".join(quote(column) for column in columns))
+        if keys is None:
+            return pandas.read_sql_query(sql, con)
+        params = list(keys)
+        dfs = []
+        for i in range(0, max(len(params), 1), sqlite_max_keys):
+            batch = params[i:i + sqlite_max_keys]
+            dfs.append(pandas.read_sql_query(
+                sql + " WHERE partition IN ({0})".format(
+                    ", ".join("?" for _ in batch)), con, params=batch))
+        return dfs[0] if len(dfs) == 1 else concat(dfs)
+
+    def read(self, keys: Optional[Iterable[str]] = None,
+             columns: Optional[List[str]] = None) -> pandas.DataFrame:
+        con = self.connect()
+        try:
+            if columns is None:
+                columns = [column for column
+                           in SqliteStorage.table_columns(con)
+                           if column != "partition"]
+            if len(columns) == 0:   # まだ何も書き込まれていない
+                return pandas.DataFrame()
+            return SqliteStorage.select(con, columns, keys)
+        finally:
+            con.close()
+
+    def read_with_keys(self, keys: Optional[Iterable[str]] = None,
+                       columns: Optional[List[str]] = None
+                       ) -> pandas.DataFrame:
+        con = self.connect()
+        try:
+            if columns is None:
+                columns = [column for column
+                           in SqliteStorage.table_columns(con)
+                           if column != "partition"]
+            # novelsテーブルのpartition列が、そのまま区分のキーになる
+            df = SqliteStorage.select(con, columns + ["partition"], keys)
+            return df.rename(columns={"partition": key_column})
+        finally:
+            con.close()
+
+    def count(self, key: str) -> int:
+        con = self.connect()
+        try:
+            row = con.execute("SELECT COUNT(*) FROM novels "
+                              "WHERE partition = ?", (key,)).fetchone()
+            return int(row[0])
+        finally:
+            con.close()
+
+    def keys(self) -> List[str]:
+        con = self.connect()
+        try:
+            rows = con.execute("SELECT DISTINCT partition FROM novels "
+                               "ORDER BY partition").fetchall()
+            return [row[0] for row in rows]
+        finally:
+            con.close()
+
+    def upsert(self, key: str, df: pandas.DataFrame) -> int:
+        con = self.connect()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            columns = SqliteStorage.table_columns(con)
+            add_columns(con, "novels", columns, df.columns)
+            if len(df) > 0:
+                con.executemany(
+                    "DELETE FROM novels WHERE partition = ? AND ncode = ?",
+                    ((key, ncode) for ncode in df["ncode"]))
+                insert_rows(con, "novels", df, key)
+            row = con.execute("SELECT COUNT(*) FROM novels "
+                              "WHERE partition = ?", (key,)).fetchone()
+            con.execute("COMMIT")
+            return int(row[0])
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        finally:
+            con.close()
+
+    def update_columns(self, key: str, df: pandas.DataFrame) -> int:
+        columns = [column for column in df.columns if column != "ncode"]
+        if len(df) == 0 or len(columns) == 0:
+            return 0
+        sql = "UPDATE novels SET {0} WHERE partition = ? AND ncode = ?".format(
+            ", ".join("{0} = ?".format(quote(column)) for column in columns))
+        values = df[columns].astype(object).where(df[columns].notna(), None)
+        con = self.connect()
+        try:
+            con.execute("BEGIN IMMEDIATE")
+            add_columns(con, "novels", SqliteStorage.table_columns(con),
+                        columns)
+            cursor = con.executemany(
+                sql, (row + [key, ncode] for row, ncode
+                      in zip(values.values.tolist(), df["ncode"])))
+            con.execute("COMMIT")
+            return int(cursor.rowcount)
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        finally:
+            con.close()
+
+
+class ParquetWriter(Writer):
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        self.dfs: List[pandas.DataFrame] = []
+
+    def write(self, df: pandas.DataFrame) -> None:
+        self.written += len(df)
+        self.dfs.append(df)
+
+    def commit(self) -> None:
+        df = concat(self.dfs)
+        if len(df) == 0:
+            if self.path.exists():
+                self.path.unlink()
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmppath = self.path.with_name(self.path.name + ".tmp")
+        df.to_parquet(tmppath, index=False)
+        os.replace(str(tmppath), str(self.path))
+
+    def abort(self) -> None:
+        self.dfs = []
+
+
+class ParquetStorage(Storage):
+    """
+    区分ごとに1つのParquetファイルへ、ジャンル別のディレクトリに分けて保存する
+
+    ファイルは'output/parquet/genre=201/201_0-10_1_re.parquet'のようになる。
+    pyarrowなどのParquetエンジンがインストールされている必要がある。
+    """
+
+    def __init__(self, dirname: str) -> None:
+        self.dirname = pathlib.Path(dirname).joinpath("parquet")
+
+    def path(self, key: str) -> pathlib.Path:
+        genre = key.split("_")[0]
+        return self.dirname.joinpath("genre=" + genre, key + ".parquet")
+
+    def writer(self, key: str) -> Writer:
+        return ParquetWriter(self.path(key))
+
+    def read(self, keys: Optional[Iterable[str]] = None,
+             columns: Optional[List[str]] = None) -> pandas.DataFrame:
+        if keys is None:
+            keys = self.keys()
+        dfs = [pandas.read_parquet(self.path(key), columns=columns)
+               for key in keys if self.path(key).exists()]
+        return concat(dfs)
+
+    def count(self, key: str) -> int:
+        path = self.path(key)
+        if not path.exists():
+            return 0
+        return len(pandas.read_parquet(path, columns=["ncode"]))
+
+    def keys(self) -> List[str]:
+        return sorted(path.stem for path
+                      in self.dirname.glob("genre=*/*.parquet"))
+
+
+storage_kinds = ["csv", "sqlite", "parquet"]
+
+
+def open_storage(kind: str, dirname: str) -> Storage:
+    """
+    種類を指定してキャッシュの保存先を作る
+
+    Parameters
+    ----------
+    kind: str
+        保存先の種類、"csv"、"sqlite"、"parquet"のどれか
+    dirname: str
+        キャッシュを置くディレクトリ
+
+    Returns
+    -------
+    Storage
+        キャッシュの保存先
+    """
+    storages: Dict[str, Storage] = {
+        "csv": CsvStorage(dirname),
+        "sqlite": SqliteStorage(
+            str(pathlib.Path(dirname).joinpath("narou.sqlite3"))),
+        "parquet": ParquetStorage(dirname),
+    }
+    if kind not in storages:
+        raise ValueError("unknown storage: " + kind)
+    return storages[kind]
+
+
+def read_partition(cache: Storage, key: str,
+                   columns: Optional[List[str]]) -> pandas.DataFrame:
+    """
+    1つの区分のキャッシュを読み込む、read_parallelの既定の読み込み関数
+    """
+    return cache.read([key], columns=columns)
+
+
+def read_parallel(cache: Storage, keys: Optional[Iterable[str]] = None,
+                  columns: Optional[List[str]] = None,
+                  processes: Optional[int] = None,
+                  func: Callable[[Storage, str, Optional[List[str]]],
+                                 pandas.DataFrame] = read_partition
+                  ) -> pandas.DataFrame:
+    """
+    区分ごとのキャッシュを複数のプロセスで読み込み、最後に1回だけ連結する
+
+    Storage.bulk_readがTrueの保存先を既定のfuncで読むときは、
+    並列にせず、まとめて1回で読む。
+
+    Parameters
+    ----------
+    cache: Storage
+        作品情報のキャッシュ
+    keys: Iterable[str], default None
+        読み込む区分のキー、Noneのときはキャッシュにあるすべての区分
+        キャッシュにない区分は読まずに飛ばす
+    columns: List[str], default None
+        読み込む列、Noneのときはすべての列
+    processes: int, default None
+        読み込むプロセスの数、Noneのときはコア数、1のときは並列にしない
+    func: Callable, default read_partition
+        (cache, key, columns)を受け取って1つの区分を読み込む関数
+        子プロセスで呼ぶので、モジュールのトップレベルの関数にする
+
+    Returns
+    -------
+    pandas.DataFrame
+        インデックスが0からの連番の作品情報
+    """
+    existing = cache.keys()
+    if keys is not None:
+        wanted = set(keys)
+        existing = [key for key in existing if key in wanted]
+    if func is read_partition and cache.bulk_read:
+        # 区分ごとに読むより、まとめて1回で読むほうが速い
+        if not existing:
+            return concat([])
+        return cache.read(None if keys is None else existing, columns)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    processes = min(processes, len(existing))
+    if processes <= 1:
+        return concat([func(cache, key, columns) for key in existing])
+    # 1回のやりとりで複数の区分を渡して、プロセス間通信の回数を減らす
+    chunksize = max(1, len(existing) // (processes * 4))
+    with futures.ProcessPoolExecutor(processes) as executor:
+        dfs = list(executor.map(func, itertools.repeat(cache), existing,
+                                itertools.repeat(columns),
+                                chunksize=chunksize))
+    return concat(dfs)
+
+
+def migrate(src: Storage, dst: Storage) -> int:
+    """
+    キャッシュを別の保存先へ区分ごとに移し替える
+
+    移し替え先の同じ区分のキャッシュは置き換えられる。
+    移し替え元のキャッシュは消さない。
+
+    Parameters
+    ----------
+    src: Storage
+        移し替え元
+    dst: Storage
+        移し替え先
+
+    Returns
+    -------
+    int
+        移し替えた区分の数
+    """
+    keys = src.keys()
+    for key in keys:
+        with dst.writer(key) as writer:
+            writer.write(src.read([key]))
+    return len(keys)
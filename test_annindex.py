@@ -0,0 +1,58 @@
+import pathlib
+import numpy
+import pytest
+from scipy import sparse
+import annindex
+import recommender
+from annindex import IVFIndex
+
+
+def make_features(n: int = 2000, seed: int = 0) -> recommender.Features:
+    # 20個の中心のまわりに散らばった作品
+    rng = numpy.random.default_rng(seed)
+    centers = rng.normal(size=(20, 16))
+    labels = rng.integers(0, 20, n)
+    matrix = centers[labels] + 0.3 * rng.normal(size=(n, 16))
+    ncodes = numpy.array(["N{0}".format(i) for i in range(n)])
+    names = ["f{0}".format(i) for i in range(16)]
+    return recommender.Features(sparse.csr_matrix(matrix), ncodes, names)
+
+
+def test_recall() -> None:
+    features = make_features()
+    index = IVFIndex.build(features, nlist=20)
+    queries = features.matrix[:100]
+    assert index.recall(queries, 10, nprobe=20) == 1.0
+    assert index.recall(queries, 10, nprobe=3) > 0.9
+
+
+def test_save_load_similar(tmp_path: pathlib.Path) -> None:
+    index = IVFIndex.build(make_features(), nlist=20)
+    filename = str(tmp_path.joinpath("index.npz"))
+    index.save(filename)
+    loaded = IVFIndex.load(filename)
+    df = index.similar(["n1", "N2", "N9999"], 5)
+    assert list(loaded.similar(["n1", "N2", "N9999"], 5)["ncode"]) \
+        == list(df["ncode"])
+    assert list(df["query"]) == ["N1"] * 5 + ["N2"] * 5
+    assert not ((df["query"] == df["ncode"]).any())
+    assert df.groupby("query")["score"].is_monotonic_decreasing.all()
+
+
+def test_sparse_centroids_and_version(tmp_path: pathlib.Path,
+                                      monkeypatch: pytest.MonkeyPatch
+                                      ) -> None:
+    monkeypatch.setattr(annindex, "centroid_terms", 4)
+    features = make_features()
+    features.version = "v1"
+    index = IVFIndex.build(features, nlist=20)
+    assert sparse.issparse(index.centroids)
+    assert index.centroids.getnnz(axis=1).max() <= 4
+    filename = str(tmp_path.joinpath("index.npz"))
+    assert IVFIndex.version_of(filename) is None
+    index.save(filename)
+    # 特徴量の版が変わったら、mainは索引を作りなおす
+    assert IVFIndex.version_of(filename) == "v1"
+    loaded = IVFIndex.load(filename)
+    assert loaded.version == "v1"
+    assert (loaded.centroids != index.centroids).nnz == 0
@@ -0,0 +1,71 @@
+import pathlib
+from typing import Dict, List
+from urllib import parse
+import pytest
+from bookmark import NarouBookmark
+
+
+def make_page(ncodes: List[str], last: int) -> str:
+    titles = "".join('<a class="title" href="https://ncode.syosetu.com/{0}/">'
+                     "t</a>".format(ncode) for ncode in ncodes)
+    pager = "".join('<a href="?nowcategory=1&p={0}">{0}</a>'.format(p)
+                    for p in range(2, last + 1))
+    return "<html><body>{0}<div>{1}</div></body></html>".format(titles, pager)
+
+
+class FakeResponse:
+    def __init__(self, text: str) -> None:
+        self.content = text.encode("utf-8")
+        self.text = text
+        self.status_code = 200
+        self.headers: Dict[str, str] = {}
+        self.encoding = "utf-8"
+        self.apparent_encoding = "utf-8"
+
+
+class FakeSession:
+    def __init__(self, pages: Dict[int, List[List[str]]]) -> None:
+        self.pages = pages
+        self.requested: List[str] = []
+
+    def get(self, url: str, headers: Dict[str, str]) -> FakeResponse:
+        self.requested.append(url)
+        query = parse.parse_qs(parse.urlparse(url).query)
+        pages = self.pages[int(query["nowcategory"][0])]
+        page = int(query["p"][0])
+        return FakeResponse(make_page(pages[page - 1], len(pages)))
+
+
+@pytest.fixture
+def naroubookmark(tmp_path: pathlib.Path) -> NarouBookmark:
+    return NarouBookmark(str(tmp_path), workers=4)
+
+
+def test_get_follows_pages(naroubookmark: NarouBookmark) -> None:
+    session = FakeSession({1: [["n1", "n2"], ["n3"], ["n4"]],
+                           2: [["n5"]],
+                           3: [[]]})
+    naroubookmark.session = session  # type: ignore
+    df = naroubookmark.get()
+    assert list(df["ncode"]) == ["N1", "N2", "N3", "N4", "N5"]
+    assert list(df["point"]) == [2, 2, 2, 2, 1]
+    assert len(session.requested) == 5
+    digest = naroubookmark.digest
+    assert naroubookmark.get_ncodes(2) == ["N5"]
+    naroubookmark.get()
+    assert naroubookmark.digest == digest
+
+
+def test_unchanged_page_is_not_parsed(naroubookmark: NarouBookmark,
+                                      monkeypatch: pytest.MonkeyPatch
+                                      ) -> None:
+    naroubookmark.session = FakeSession({1: [["n1"]]})  # type: ignore
+    assert naroubookmark.get_ncodes(1) == ["N1"]
+
+    def parse_page(html: str) -> None:
+        raise AssertionError("parsed again")
+
+    monkeypatch.setattr(NarouBookmark, "parse_page", parse_page)
+    assert NarouBookmark(naroubookmark.dirname.as_posix()).pages.get(
+        naroubookmark.page_url(1, 1)) is not None
+    assert naroubookmark.get_ncodes(1) == ["N1"]
@@ -0,0 +1,54 @@
+import pathlib
+import pandas
+import pytest
+import corpus
+import storage
+import fakeapi
+from corpus import Corpus, load
+
+
+def make_cache(tmp_path: pathlib.Path) -> storage.Storage:
+    cache = storage.open_storage("sqlite", str(tmp_path))
+    rows = fakeapi.make_corpus(2000, now=1500000000)
+    df = pandas.DataFrame(rows).drop(columns=["_lastup", "_buntai"])
+    for genre, group in df.groupby("genre"):
+        with cache.writer("{0}_0-10_1_t".format(genre)) as writer:
+            writer.write(group)
+    return cache
+
+
+def test_load_compact(tmp_path: pathlib.Path) -> None:
+    cache = make_cache(tmp_path)
+    full = cache.read()
+    df = load(cache)
+    assert "story" not in df.columns and "keyword" not in df.columns
+    assert df["genre"].dtype == "category"
+    assert df["kaiwaritu"].dtype == "uint8"
+    assert df["general_lastup"].dtype.kind == "M"
+    assert len(df) == len(full)
+    assert df.memory_usage(deep=True).sum() \
+        < full.memory_usage(deep=True).sum() / 4
+    assert list(load(cache, ["ncode", "length"]).columns) \
+        == ["ncode", "length"]
+
+
+def test_bulk_read_compacts_in_parallel(tmp_path: pathlib.Path,
+                                        monkeypatch: pytest.MonkeyPatch
+                                        ) -> None:
+    cache = make_cache(tmp_path)
+    assert cache.bulk_read
+    serial = load(cache, processes=1)
+    monkeypatch.setattr(corpus, "compact_min_rows", 500)
+    parallel = load(cache, processes=2)
+    pandas.testing.assert_frame_equal(parallel, serial, check_dtype=False)
+    assert parallel["general_lastup"].dtype.kind == "M"
+    assert parallel["genre"].dtype == "category"
+
+
+def test_lazy_text(tmp_path: pathlib.Path) -> None:
+    cache = make_cache(tmp_path)
+    lazy = Corpus(cache, ["length"])
+    assert list(lazy.frame.columns) == ["ncode", "length"]
+    story = lazy.text("story")
+    full = cache.read(columns=["ncode", "story"]).set_index("ncode")
+    assert list(story) == list(full["story"][lazy.frame["ncode"]])
@@ -0,0 +1,82 @@
+import pathlib
+import numpy
+import pandas
+import pytest
+import narou
+import storage
+from features import make_features
+from featurestore import FeatureStore
+from manifest import Manifest
+
+
+def make_df(ncodes: list, keywords: list, updated_at: str
+            ) -> pandas.DataFrame:
+    return pandas.DataFrame({
+        "ncode": ncodes, "keyword": keywords,
+        "genre": [201] * len(ncodes),
+        "length": [1000 * (i + 1) for i in range(len(ncodes))],
+        "kaiwaritu": [30] * len(ncodes),
+        "general_lastup": [updated_at] * len(ncodes),
+        "end": [1] * len(ncodes), "novel_type": [1] * len(ncodes),
+        "novelupdated_at": [updated_at] * len(ncodes),
+        "updated_at": [updated_at] * len(ncodes)
+    })
+
+
+def test_build_incrementally(tmp_path: pathlib.Path) -> None:
+    cache = storage.open_storage("csv", str(tmp_path))
+    manifest = Manifest(str(tmp_path.joinpath("manifest.json")))
+    first = make_df(["N1", "N2"], ["異世界 転生", "恋愛"],
+                    "2020-01-01 00:00:00")
+    # N2は会話率が変わって、別の区分に入りなおした
+    second = make_df(["N2", "N3"], ["恋愛 学園", "ホラー"],
+                     "2020-02-01 00:00:00")
+    for key, df in [("201_0-10_1_t", first), ("201_11-20_1_t", second)]:
+        with cache.writer(key) as writer:
+            writer.write(df)
+        manifest.update(key, fetched_at=1)
+    store = FeatureStore(str(tmp_path.joinpath("features")))
+    assert store.build(cache, manifest) == 2
+    features = store.load()
+    assert features is not None
+    assert isinstance(features.ncodes, numpy.memmap)
+    expected = make_features(pandas.concat([first.iloc[:1], second]))
+    assert list(features.ncodes) == list(expected.ncodes)
+    assert sorted(features.names) == sorted(expected.names)
+    columns = [features.names.index(name) for name in expected.names]
+    assert numpy.allclose(features.matrix[:, columns].toarray(),
+                          expected.matrix.toarray())
+
+    # 変わっていない区分は作りなおさない
+    assert store.build(cache, manifest) == 0
+    with cache.writer("201_0-10_1_t") as writer:
+        writer.write(make_df(["N1", "N4"], ["異世界", "チート"],
+                             "2020-03-01 00:00:00"))
+    manifest.update("201_0-10_1_t", fetched_at=2)
+    assert store.build(cache, manifest) == 1
+    features = store.load()
+    assert features is not None
+    assert list(features.ncodes) == ["N1", "N4", "N2", "N3"]
+    assert "keyword:チート" in features.names
+    assert "keyword:転生" not in features.names
+
+
+def test_bookkeeping_does_not_rebuild(tmp_path: pathlib.Path,
+                                      monkeypatch: pytest.MonkeyPatch
+                                      ) -> None:
+    cache = storage.open_storage("csv", str(tmp_path))
+    manifest = Manifest(str(tmp_path.joinpath("manifest.json")))
+    monkeypatch.setattr(narou, "manifest", manifest)
+    key = "201_0-10_1_t"
+    with cache.writer(key) as writer:
+        writer.write(make_df(["N1"], ["異世界"], "2020-01-01 00:00:00"))
+    manifest.update(key, count=1, fetched_at=1, synced_at=1)
+    store = FeatureStore(str(tmp_path.joinpath("features")))
+    assert store.build(cache, manifest) == 1
+    # 作品数の観測や、何も変わらなかった差分取得では作りなおさない
+    narou.observe_allcount(key, 2)
+    manifest.touch(key, verified_at=2, allcount=1)
+    assert store.build(cache, manifest) == 0
+    # 差分取得で書き換えた区分は作りなおす
+    manifest.update(key, written_at=3)
+    assert store.build(cache, manifest) == 1
@@ -1,5 +1,24 @@
 import bookmark                 # noqa
 import narou                    # noqa
+import ratelimit                # noqa
+import storage                  # noqa
+import manifest                 # noqa
+import jsonstream               # noqa
+import narouapi                 # noqa
+import lookup                   # noqa
+import fakeapi                  # noqa
+import bench                    # noqa
+import recommender              # noqa
+import annindex                 # noqa
+import corpus                   # noqa
+import journal                  # noqa
+import metrics                  # noqa
+import ncodeindex               # noqa
+import profiles                 # noqa
+import features                 # noqa
+import featurestore             # noqa
+import scheduler                # noqa
+import service                  # noqa
 
 
 def test_success() -> None:
@@ -0,0 +1,28 @@
+import gzip
+import json
+import pytest
+import jsonstream
+
+
+def split(data: bytes, size: int) -> list:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def test_iter_array_byte_by_byte() -> None:
+    elements = [{"allcount": 2},
+                {"ncode": "N1", "title": "転生したら,[]{}\\"},
+                {"ncode": "N2", "length": 12345}]
+    data = json.dumps(elements, ensure_ascii=False).encode("utf-8")
+    assert list(jsonstream.iter_array(split(data, 1))) == elements
+
+
+def test_gunzip_bounds_chunks() -> None:
+    data = json.dumps([{"story": "あ" * 200000}]).encode("utf-8")
+    chunks = list(jsonstream.gunzip(split(gzip.compress(data), 1000)))
+    assert max(len(chunk) for chunk in chunks) <= jsonstream.chunk_size
+    assert b"".join(chunks) == data
+
+
+def test_iter_array_truncated() -> None:
+    with pytest.raises(ValueError):
+        list(jsonstream.iter_array([b'[{"allcount": 1}, {"nco']))
@@ -0,0 +1,45 @@
+import pathlib
+from typing import Any, Dict, List
+import pytest
+import narou
+from lookup import NcodeLookup
+
+
+@pytest.fixture
+def requests(monkeypatch: pytest.MonkeyPatch) -> List[List[str]]:
+    requests: List[List[str]] = []
+
+    def get_jsondata(get_params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        ncodes = str(get_params["ncode"]).split("-")
+        requests.append(ncodes)
+        # N0は削除された小説として返さない
+        rows = [{"ncode": ncode, "length": int(ncode[1:])}
+                for ncode in ncodes if ncode != "N0"]
+        return [{"allcount": len(rows)}] + rows
+
+    monkeypatch.setattr(narou, "get_jsondata", get_jsondata)
+    monkeypatch.setattr(narou, "delay", lambda s=10: None)
+    return requests
+
+
+def test_batched_and_cached(tmp_path: pathlib.Path,
+                            requests: List[List[str]]) -> None:
+    lookup = NcodeLookup(str(tmp_path.joinpath("lookup.sqlite3")),
+                         batch_size=2)
+    df = lookup.get(["n3", "N1", "N2", "N0", "n3"])
+    assert list(df["ncode"]) == ["N3", "N1", "N2"]
+    assert requests == [["N3", "N1"], ["N2", "N0"]]
+    df = lookup.get(["N2", "N4"])
+    assert list(df["length"]) == [2, 4]
+    assert requests[2:] == [["N4"]]
+
+
+def test_ttl_and_eviction(tmp_path: pathlib.Path,
+                          requests: List[List[str]]) -> None:
+    filename = str(tmp_path.joinpath("lookup.sqlite3"))
+    NcodeLookup(filename, max_entries=2).get(["N1", "N2", "N3"])
+    con = NcodeLookup(filename).connect()
+    assert con.execute("SELECT COUNT(*) FROM novels").fetchone()[0] == 2
+    con.close()
+    NcodeLookup(filename, ttl=-1).get(["N3"])
+    assert requests[-1] == ["N3"]
@@ -0,0 +1,26 @@
+import pathlib
+from manifest import Manifest
+
+
+def test_update_is_persisted(tmp_path: pathlib.Path) -> None:
+    filename = str(tmp_path.joinpath("manifest.json"))
+    manifest = Manifest(filename)
+    assert manifest.get("101_0-10_1_t") is None
+    manifest.update("101_0-10_1_t", count=10, allcount=12, lengths=[])
+    manifest.update("101_0-10_1_t", count=11)
+    entry = Manifest(filename).get("101_0-10_1_t")
+    assert entry == {"count": 11, "allcount": 12, "lengths": []}
+    assert not tmp_path.joinpath("manifest.json.tmp").exists()
+
+
+def test_touch_is_batched(tmp_path: pathlib.Path) -> None:
+    filename = str(tmp_path.joinpath("manifest.json"))
+    manifest = Manifest(filename)
+    manifest.update("101_0-10_1_t", count=10)
+    manifest.touch("101_0-10_1_t", checked_at=1)
+    manifest.touch("201_0-10_1_t", checked_at=2)
+    assert Manifest(filename).get("201_0-10_1_t") is None
+    assert manifest.get("201_0-10_1_t") == {"checked_at": 2}
+    manifest.flush()
+    entry = Manifest(filename).get("101_0-10_1_t")
+    assert entry == {"count": 10, "checked_at": 1}
@@ -0,0 +1,42 @@
+import json
+import pathlib
+import time
+from typing import Iterator
+from metrics import Metrics, timed_iter
+
+
+def test_partitions_and_export(tmp_path: pathlib.Path) -> None:
+    metrics = Metrics(buckets=[0.1, 1.0])
+    with metrics.partition("101_0-10_1_t"):
+        metrics.observe("request_seconds", 0.05)
+        metrics.observe("request_seconds", 0.5)
+        metrics.add("rows", 500)
+        metrics.observe("partition_seconds", 2.0)
+    metrics.add("rows", 100)
+    metrics.write(str(tmp_path.joinpath("metrics.json")))
+    with open(tmp_path.joinpath("metrics.json"), encoding="utf-8") as f:
+        snapshot = json.load(f)
+    partition = snapshot["101_0-10_1_t"]
+    assert partition["histograms"]["request_seconds"]["buckets"] \
+        == {"0.1": 1, "1": 1, "+Inf": 0}
+    assert partition["rows_per_second"] == 250
+    assert snapshot["total"]["counters"]["rows"] == 600
+
+    metrics.write(str(tmp_path.joinpath("metrics.prom")))
+    text = tmp_path.joinpath("metrics.prom").read_text(encoding="utf-8")
+    assert "# TYPE narou_rows_total counter" in text
+    assert 'narou_request_seconds_bucket{partition="101_0-10_1_t",le="1"} 2' \
+        in text
+    assert 'narou_request_seconds_count{partition="101_0-10_1_t"} 2' in text
+
+
+def test_timed_iter_excludes_consumer() -> None:
+    def slow() -> Iterator[int]:
+        for i in range(3):
+            time.sleep(0.01)
+            yield i
+
+    elapsed = [0.0]
+    for _ in timed_iter(slow(), elapsed):
+        time.sleep(0.05)
+    assert 0.03 <= elapsed[0] < 0.1
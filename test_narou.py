@@ -0,0 +1,255 @@
+import pathlib
+import random
+import threading
+import time
+import pandas
+import pytest
+from typing import Dict, Iterator, List, Union
+import narou
+import storage
+from fakeapi import FakeNarouAPI, make_corpus
+from journal import Journal
+from manifest import Manifest
+from narouapi import APIError
+
+
+@pytest.fixture
+def corpus(monkeypatch: pytest.MonkeyPatch) -> List[int]:
+    rng = random.Random(0)
+    # 短編と長編のフタコブラクダの分布
+    lengths = [round(rng.lognormvariate(7, 1)) for _ in range(12000)]
+    lengths += [round(rng.lognormvariate(11, 0.8)) for _ in range(8000)]
+
+    def get_allcount(get_params: Dict[str, Union[str, int]]) -> int:
+        lo, hi = narou.parse_length(str(get_params["length"]))
+        return sum(1 for length in lengths
+                   if (lo is None or lo <= length)
+                   and (hi is None or length <= hi))
+
+    monkeypatch.setattr(narou, "get_allcount", get_allcount)
+    monkeypatch.setattr(narou, "delay", lambda s=10: None)
+    return lengths
+
+
+def test_make_splitlengths_over_24000() -> None:
+    ranges = narou.make_splitlengths(100000, 3000, 1.5)
+    assert len(ranges) == 128
+    assert ranges[0].startswith("-") and ranges[-1].endswith("-")
+
+
+def test_quantile_splitlengths(corpus: List[int]) -> None:
+    ranges = narou.quantile_splitlengths(len(corpus), corpus)
+    assert len(ranges) == 16
+    # 経験分布で区切るので、各区間の作品数がそろう
+    for length in ranges:
+        lo, hi = narou.parse_length(length)
+        count = sum(1 for n in corpus if (lo is None or lo <= n)
+                    and (hi is None or n <= hi))
+        assert abs(count - len(corpus) / 16) < 50
+
+
+def test_search_splitlengths_covers_all(corpus: List[int]) -> None:
+    slices = narou.search_splitlengths({}, [1000], [])
+    assert all(count <= narou.slice_max for (_, count) in slices)
+    assert sum(count for (_, count) in slices) == len(corpus)
+    # 区間は隙間なく並ぶ
+    bounds = [narou.parse_length(length) for (length, _) in slices]
+    assert bounds[0][0] is None and bounds[-1][1] is None
+    for (_, hi), (lo, _) in zip(bounds, bounds[1:]):
+        assert hi is not None and lo == hi + 1
+
+
+def test_search_splitlengths_merges_small_slices(corpus: List[int]) -> None:
+    boundaries = list(range(100, 100000, 100))
+    slices = narou.search_splitlengths({}, boundaries, sorted(corpus))
+    assert sum(count for (_, count) in slices) == len(corpus)
+    assert len(slices) <= 2 * len(corpus) // narou.slice_max + 1
+
+
+@pytest.fixture
+def server(monkeypatch: pytest.MonkeyPatch,
+           tmp_path: pathlib.Path) -> Iterator[FakeNarouAPI]:
+    corpus = make_corpus(6000, now=1500000000)
+    # すべて1つの区分に入れて、作品長さでの分割が必要になるようにする
+    for novel in corpus:
+        novel.update(genre=101, kaiwaritu=35, _buntai=1, novel_type=1, end=0)
+    server = FakeNarouAPI(corpus).start()
+    monkeypatch.setattr(narou.client, "api_url", server.url)
+    monkeypatch.setattr(narou.client, "limiter", None)
+    for name in ["dirname", "cache", "manifest", "journal", "ncode_index",
+                 "profile"]:
+        monkeypatch.setattr(narou, name, getattr(narou, name))
+    narou.dirname = str(tmp_path)
+    narou.set_storage("sqlite")
+    narou.set_ratelimit(1e9, 1000)  # 待たない
+    yield server
+    server.stop()
+
+
+def test_get_data_splits_and_syncs(server: FakeNarouAPI,
+                                   monkeypatch: pytest.MonkeyPatch) -> None:
+    narou.get_data("101", "31-40", 1, "re")
+    df = narou.read_allcaches(["ncode", "length"])
+    assert len(df) == 6000 and df["ncode"].is_unique
+    entry = narou.manifest.get("101_31-40_1_re")
+    assert entry is not None and entry["count"] == 6000
+    assert entry["checked_allcount"] == 6000
+    assert len(entry["lengths"]) >= 3
+
+    # 分割の記録がなくても、キャッシュがあればサンプリングしない
+    narou.manifest.update("101_31-40_1_re", count=100, lengths=[])
+    monkeypatch.setattr(narou, "get_statistics", None)
+    narou.get_data("101", "31-40", 1, "re")
+    assert narou.cache.count("101_31-40_1_re") == 6000
+
+    # 更新されていなければ取得しない
+    requests = server.requests
+    narou.get_data("101", "31-40", 1, "re")
+    assert server.requests == requests + 1
+
+    # 差分取得では更新された作品だけを取り直す
+    novel = server.corpus[0]
+    novel.update(length=novel["length"] + 1, _lastup=int(time.time()))
+    narou.get_data("101", "31-40", 1, "re", incremental=True)
+    df = narou.read_allcaches(["ncode", "length"]).set_index("ncode")
+    assert len(df) == 6000
+    assert df.loc[novel["ncode"], "length"] == novel["length"]
+
+    # 更新された作品がなければ、差分取得の起点は変えず、目録も書き出さない
+    novel.update(_lastup=1500000000)
+    entry = narou.manifest.get("101_31-40_1_re")
+    assert entry is not None
+    saved_at = pathlib.Path(narou.manifest.filename).stat().st_mtime_ns
+    narou.get_data("101", "31-40", 1, "re", incremental=True)
+    after = narou.manifest.get("101_31-40_1_re")
+    assert after is not None and after["synced_at"] == entry["synced_at"]
+    assert "verified_at" in after
+    assert pathlib.Path(narou.manifest.filename).stat().st_mtime_ns \
+        == saved_at
+
+
+def test_parallel_crawl_stops_on_error(
+        tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(narou, "manifest", Manifest(
+        str(tmp_path.joinpath("manifest.json"))))
+    monkeypatch.setattr(narou, "journal", Journal(
+        str(tmp_path.joinpath("journal"))))
+    started: List[str] = []
+    lock = threading.Lock()
+
+    def get_data(genre: str, kaiwa: str, buntai: int, ty: str,
+                 incremental: bool = False) -> None:
+        with lock:
+            started.append(narou.make_key(genre, kaiwa, buntai, ty))
+            first = len(started) == 1
+        if first:
+            raise RuntimeError("bug")
+        time.sleep(0.01)
+
+    monkeypatch.setattr(narou, "get_data", get_data)
+    with pytest.raises(RuntimeError):
+        narou.crawl(workers=4)
+    # 実行中だった区分のほかは、取得を始めない
+    assert len(started) < 20
+    assert len(list(narou.partitions())) > 1000
+
+
+def test_select_keys(tmp_path: pathlib.Path,
+                     monkeypatch: pytest.MonkeyPatch) -> None:
+    cache = storage.open_storage("csv", str(tmp_path))
+    monkeypatch.setattr(narou, "cache", cache)
+    for key in ["101_0-10_1_t", "101_11-20_2_re", "201_0-10_1_re"]:
+        with cache.writer(key) as writer:
+            writer.write(pandas.DataFrame({"ncode": [key]}))
+    assert narou.select_keys(genres=["101"]) \
+        == ["101_0-10_1_t", "101_11-20_2_re"]
+    assert narou.select_keys(buntais=[1], types=["re"]) == ["201_0-10_1_re"]
+    df = narou.read_allcaches(["ncode"], narou.select_keys(kaiwas=["0-10"]),
+                              processes=2)
+    assert sorted(df["ncode"]) == ["101_0-10_1_t", "201_0-10_1_re"]
+
+
+def test_resume_after_crash(server: FakeNarouAPI,
+                            monkeypatch: pytest.MonkeyPatch) -> None:
+    iter_jsondata = narou.iter_jsondata
+    pages: List[str] = []
+    crash_at: List[int] = [3]
+
+    def recording(get_params: Dict[str, Union[str, int]]) -> Iterator:
+        # 件数の確認などではない、作品情報のページだけを数える
+        if int(get_params.get("lim", 0)) >= 499:
+            if len(pages) == crash_at[0]:
+                raise APIError("crash")
+            pages.append(narou.page_unit(get_params))
+        return iter_jsondata(get_params)
+
+    narou.journal.start()
+    monkeypatch.setattr(narou, "iter_jsondata", recording)
+    with pytest.raises(APIError):
+        narou.get_data("101", "31-40", 1, "re")
+    assert narou.cache.count("101_31-40_1_re") == 0
+
+    # 再開すると、済んだページは取り直さない
+    done = list(pages)
+    pages.clear()
+    crash_at[0] = -1
+    narou.journal.start(resume=True)
+    narou.get_data("101", "31-40", 1, "re")
+    assert len(pages) > 0 and not set(pages) & set(done)
+    df = narou.read_allcaches(["ncode"])
+    assert len(df) == 6000 and df["ncode"].is_unique
+
+    # 取得し終えた区分は、再開しても作品数すら問い合わせない
+    requests = server.requests
+    narou.get_data("101", "31-40", 1, "re")
+    assert server.requests == requests
+
+
+def test_resume_skips_decided_partitions(server: FakeNarouAPI,
+                                         monkeypatch: pytest.MonkeyPatch
+                                         ) -> None:
+    narou.journal.start()
+    narou.get_data("101", "31-40", 1, "re")
+    # 次の取得では増えていないので飛ばし、その後の区分で落ちる
+    narou.journal.start()
+    requests = server.requests
+    narou.get_data("101", "31-40", 1, "re")
+    assert server.requests == requests + 1
+
+    def crash(get_params: Dict[str, Union[str, int]]) -> int:
+        raise RuntimeError("crash")
+
+    with monkeypatch.context() as m:
+        m.setattr(narou, "get_allcount", crash)
+        with pytest.raises(RuntimeError):
+            narou.crawl(resume=True)
+    # 落ちる前に、飛ばすと決めたことは目録に書き出されている
+    entry = Manifest(narou.manifest.filename).get("101_31-40_1_re")
+    assert entry is not None and "verified_at" in entry
+    # 再開しても、飛ばすと決めた区分は作品数を問い合わせない
+    requests = server.requests
+    narou.journal.start(resume=True)
+    narou.get_data("101", "31-40", 1, "re")
+    assert server.requests == requests
+
+
+def test_light_profile_and_backfill(server: FakeNarouAPI) -> None:
+    # 初回はあらすじなしで取得するので、すべて欠けている
+    narou.set_profile("light")
+    narou.get_data("101", "31-40", 1, "re")
+    df = narou.read_allcaches(["ncode", "story", "title"])
+    assert len(df) == 6000 and df["story"].isna().all()
+    assert df["title"].notna().all()
+    assert narou.backfill() == 6000
+    df = narou.read_allcaches(["ncode", "story"]).set_index("ncode")
+    novel = server.corpus[0]
+    assert df.loc[novel["ncode"], "story"] == novel["story"]
+
+    # 取りなおしても、更新されていない作品のあらすじは引き継ぐ
+    novel.update(novelupdated_at="2099-01-01 00:00:00")
+    narou.manifest.update("101_31-40_1_re", count=0)  # 取りなおさせる
+    narou.get_data("101", "31-40", 1, "re")
+    df = narou.read_allcaches(["ncode", "story"]).set_index("ncode")
+    assert df["story"].isna().sum() == 1
+    assert pandas.isna(df.loc[novel["ncode"], "story"])
+    assert narou.backfill() == 1
@@ -0,0 +1,55 @@
+import gzip
+import http.server
+import json
+import threading
+from typing import Iterator, List
+import pytest
+from narouapi import NarouAPI, APIError
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    statuses: List[int] = []
+
+    def do_GET(self) -> None:
+        status = Handler.statuses.pop(0) if Handler.statuses else 200
+        body = gzip.compress(json.dumps([{"allcount": 0}]).encode("utf-8"))
+        self.send_response(status)
+        if status == 429:
+            self.send_header("Retry-After", "0")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args: object) -> None:
+        pass
+
+
+@pytest.fixture
+def url() -> Iterator[str]:
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:{0}/".format(server.server_address[1])
+    server.shutdown()
+
+
+def test_retry_then_success(url: str) -> None:
+    Handler.statuses = [503, 429, 500]
+    client = NarouAPI(url, backoff=0.01)
+    assert list(client.iter_json({})) == [{"allcount": 0}]
+    assert Handler.statuses == []
+
+
+def test_give_up(url: str) -> None:
+    Handler.statuses = [503] * 3
+    client = NarouAPI(url, retries=2, backoff=0.01)
+    with pytest.raises(APIError):
+        list(client.iter_json({}))
+
+
+def test_no_retry_on_client_error(url: str) -> None:
+    Handler.statuses = [400, 503]
+    client = NarouAPI(url, backoff=0.01)
+    with pytest.raises(APIError):
+        list(client.iter_json({}))
+    assert Handler.statuses == [503]
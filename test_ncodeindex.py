@@ -0,0 +1,72 @@
+import functools
+import pathlib
+import pandas
+import pytest
+import storage
+from ncodeindex import NcodeIndex, read_current, read_all_current
+
+
+def make_df(ncodes: list, updated_at: str) -> pandas.DataFrame:
+    return pandas.DataFrame({"ncode": ncodes,
+                             "novelupdated_at": [updated_at] * len(ncodes),
+                             "length": [len(ncode) for ncode in ncodes]})
+
+
+def test_keeps_latest_row(tmp_path: pathlib.Path) -> None:
+    cache = storage.open_storage("sqlite", str(tmp_path))
+    index = NcodeIndex(str(tmp_path.joinpath("ncodes.sqlite3")))
+    with index.writer("101_0-10_1_t", cache.writer("101_0-10_1_t")):
+        pass
+    with index.writer("101_0-10_1_t", cache.writer("101_0-10_1_t")) as w:
+        w.write(make_df(["N1", "N2"], "2020-01-01 00:00:00"))
+    # N2は会話率が変わって、別の区分に入りなおした
+    with index.writer("101_11-20_1_t", cache.writer("101_11-20_1_t")) as w:
+        w.write(make_df(["N2", "N3"], "2020-02-01 00:00:00"))
+    assert index.get("n2") == ("101_11-20_1_t", "2020-02-01 00:00:00")
+    assert index.get("N9") is None
+
+    read = functools.partial(read_current, index=index)
+    df = storage.read_parallel(cache, columns=["ncode"], processes=1,
+                               func=read)
+    assert sorted(df["ncode"]) == ["N1", "N2", "N3"]
+    assert len(storage.read_parallel(cache, processes=1)) == 4
+    # まとめて読んでも、同じ行を選ぶ
+    df = read_all_current(cache, None, ["novelupdated_at"], index)
+    assert list(df.columns) == ["novelupdated_at"] and len(df) == 3
+    df = read_all_current(cache, None, None, index).set_index("ncode")
+    assert df.loc["N2", "novelupdated_at"] == "2020-02-01 00:00:00"
+
+    # 古い区分を取りなおしても、新しい行を指したまま
+    with index.writer("101_0-10_1_t", cache.writer("101_0-10_1_t")) as w:
+        w.write(make_df(["N1", "N2"], "2020-01-01 00:00:00"))
+    assert index.get("N2") == ("101_11-20_1_t", "2020-02-01 00:00:00")
+
+    # 失敗した書き込みは索引に反映しない
+    with pytest.raises(RuntimeError):
+        with index.writer("102_0-10_1_t", cache.writer("102_0-10_1_t")) as w:
+            w.write(make_df(["N4"], "2020-03-01 00:00:00"))
+            raise RuntimeError
+    assert index.get("N4") is None
+
+    index.rebuild(cache)
+    assert index.get("N2") == ("101_11-20_1_t", "2020-02-01 00:00:00")
+    assert index.partition_ncodes("101_0-10_1_t") == ["N1"]
+
+
+@pytest.mark.parametrize("kind", ["csv", "sqlite"])
+def test_read_all_current_without_index(tmp_path: pathlib.Path,
+                                        kind: str) -> None:
+    cache = storage.open_storage(kind, str(tmp_path))
+    index = NcodeIndex(str(tmp_path.joinpath("ncodes.sqlite3")))
+    with index.writer("101_0-10_1_t", cache.writer("101_0-10_1_t")) as w:
+        w.write(make_df(["N1", "N2"], "2020-01-01 00:00:00"))
+    # 索引に載っていない区分の重複は、更新時刻が新しい行を残す
+    with cache.writer("101_11-20_1_t") as writer:
+        writer.write(make_df(["N2", "N3"], "2020-02-01 00:00:00"))
+    df = read_all_current(cache, None, None, index)
+    assert list(df.index) == [0, 1, 2]
+    df = df.set_index("ncode")
+    assert sorted(df.index) == ["N1", "N2", "N3"]
+    assert df.loc["N2", "novelupdated_at"] == "2020-02-01 00:00:00"
+    assert len(read_all_current(cache, ["101_0-10_1_t"], ["ncode"],
+                                index)) == 2
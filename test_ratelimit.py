@@ -0,0 +1,23 @@
+import time
+import pytest
+from ratelimit import TokenBucket
+
+
+def test_burst_does_not_wait() -> None:
+    bucket = TokenBucket(rate=1.0, capacity=3)
+    waits = [bucket.acquire() for _ in range(3)]
+    assert waits == [0.0, 0.0, 0.0]
+
+
+def test_rate_is_limited() -> None:
+    bucket = TokenBucket(rate=20.0)
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+    # 初回はバケットのトークンを使うので、残り4回分を待つ
+    assert time.monotonic() - start >= 4 / 20.0 * 0.9
+
+
+def test_invalid_rate() -> None:
+    with pytest.raises(ValueError):
+        TokenBucket(rate=0)
@@ -0,0 +1,63 @@
+import pathlib
+import numpy
+import pandas
+import recommender
+
+
+def make_corpus() -> pandas.DataFrame:
+    return pandas.DataFrame({
+        "ncode": ["N1", "N2", "N3", "N4", "N5"],
+        "keyword": ["異世界 転生", "恋愛 学園", "異世界 転生 チート",
+                    "恋愛 婚約破棄", "ホラー"],
+        "genre": [201, 101, 201, 101, 9903],
+        "length": [100000, 20000, 150000, 30000, 5000],
+        "kaiwaritu": [30, 50, 35, 45, 10],
+        "general_lastup": ["2020-01-01 00:00:00"] * 5,
+        "end": [1, 0, 1, 0, 0],
+        "novel_type": [1, 1, 1, 1, 2],
+    })
+
+
+def test_features_shape() -> None:
+    features = recommender.make_features(make_corpus())
+    # キーワード7種、ジャンル3種、数値5種
+    assert features.matrix.shape == (5, 7 + 3 + 5)
+    assert list(features.index(["n3", "N9"])) == [2, -1]
+
+
+def test_recommend_similar_novel() -> None:
+    features = recommender.make_features(make_corpus())
+    bookmarks = pandas.DataFrame({"ncode": ["N1", "N2"], "point": [2, 0]})
+    model = recommender.Recommender(features).fit(bookmarks)
+    result = model.recommend(2)
+    assert list(result["ncode"]) == ["N3", "N5"]
+    assert "N1" not in set(model.recommend(10)["ncode"])
+
+
+def test_update_matches_fit(tmp_path: pathlib.Path) -> None:
+    features = recommender.make_features(make_corpus())
+    features.version = "test"
+    before = pandas.DataFrame({"ncode": ["N1", "N2", "N4"],
+                               "point": [2, 0, 1]})
+    # N2を「とても好き」へ移し、N4を外し、N5を追加した
+    after = pandas.DataFrame({"ncode": ["N1", "N2", "N5"],
+                              "point": [2, 2, 0]})
+    model = recommender.Recommender(features).fit(before)
+    model.scores()
+    assert model.update(before) == 0
+    assert model.update(after) == 3
+    expected = recommender.Recommender(features).fit(after)
+    assert numpy.allclose(model.weights, expected.weights)
+    assert numpy.allclose(model.scores(), expected.scores())
+    assert list(model.recommend(10)["ncode"]) \
+        == list(expected.recommend(10)["ncode"])
+
+    filename = str(tmp_path.joinpath("model.npz"))
+    model.save(filename)
+    loaded = recommender.Recommender.load(filename, features)
+    assert loaded is not None
+    assert numpy.allclose(loaded.scores(), expected.scores())
+    assert loaded.update(before) == 3
+    assert numpy.allclose(loaded.scores(),
+                          recommender.Recommender(features).fit(before)
+                          .scores())
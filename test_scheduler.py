@@ -0,0 +1,40 @@
+import pathlib
+import time
+from typing import List
+import scheduler
+from manifest import Manifest
+
+
+def test_update_growth() -> None:
+    now = time.time()
+    entry = {"checked_at": now - scheduler.day_seconds,
+             "checked_allcount": 100}
+    assert scheduler.update_growth(entry, 150, now) == 50
+    entry["growth"] = 10
+    assert scheduler.update_growth(entry, 150, now) == 30
+    # 削除されて減ったときは増えていないとみなす
+    assert scheduler.update_growth(entry, 90, now) == 5
+    assert scheduler.update_growth(None, 90, now) == 0
+
+
+def test_run_once_spends_budget_by_priority(tmp_path: pathlib.Path) -> None:
+    now = time.time()
+    manifest = Manifest(str(tmp_path.joinpath("manifest.json")))
+    # よく増える区分、ほとんど増えない区分、取得したことのない区分
+    manifest.update("A", growth=100, synced_at=now - scheduler.day_seconds)
+    manifest.update("B", growth=0, synced_at=now - 10 * scheduler.day_seconds)
+    requests = [0]
+
+    def refresh(key: str) -> None:
+        requests[0] += 3
+        manifest.update(key, synced_at=time.time())
+
+    runner = scheduler.Scheduler(manifest, ["A", "B", "C"], refresh,
+                                 lambda: requests[0])
+    assert runner.run_once(7) == ["C", "A"]
+    # 次の時間には、残っていたBから取得する
+    assert runner.run_once(7)[0] == "B"
+    sleeps: List[float] = []
+    runner.sleep = sleeps.append
+    runner.run(7, cycles=2, period=0)
+    assert requests[0] == 4 * 6 and sleeps == [0.0]
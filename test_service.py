@@ -0,0 +1,107 @@
+import json
+import threading
+import urllib.error
+import urllib.request
+import pytest
+import recommender
+from service import RecommendService, RequestError, ServiceServer
+from test_recommender import make_corpus
+
+
+def load(version: str) -> recommender.Features:
+    features = recommender.make_features(make_corpus())
+    features.version = version
+    return features
+
+
+def request(user: str, k: int, ncodes: list) -> dict:
+    return {"user": user, "k": k,
+            "bookmarks": [{"ncode": ncode, "point": 2} for ncode in ncodes]}
+
+
+def cached(service: RecommendService, *requests: dict) -> list:
+    results = service.handle({"requests": list(requests)})["results"]
+    return [result["cached"] for result in results]
+
+
+def test_cache_and_invalidate() -> None:
+    versions = {"current": "v1"}
+    service = RecommendService(lambda: load(versions["current"]),
+                               lambda: versions["current"], {}, 2)
+    results = service.handle({"requests": [request("a", 2, ["N1"]),
+                                           request("a", 1, ["N1"])]})
+    first, again = results["results"]
+    assert not first["cached"] and again["cached"]
+    assert first["recommendations"][0]["ncode"] == "N3"
+    assert again["recommendations"] == first["recommendations"][:1]
+    # キャッシュより多く求められたら計算しなおす
+    assert cached(service, request("a", 3, ["N1"])) == [False]
+    # ブックマークが変わればハッシュが変わるので、計算しなおす
+    # キャッシュは最後に使った2件だけを残す
+    assert cached(service, request("b", 2, ["N2"]),
+                  request("a", 2, ["N1", "N2"]),
+                  request("b", 2, ["N2"]),
+                  request("a", 2, ["N1"])) == [False, False, True, False]
+    assert len(service.cache) == 2
+    # 特徴量の版が変われば、キャッシュは使わない
+    versions["current"] = "v2"
+    result = service.handle({"requests": [request("a", 2, ["N1"])]})
+    assert result["results"][0]["version"] == "v2"
+    assert not result["results"][0]["cached"]
+    assert service.handle({"requests": [{"user": "c", "k": 1}]}) \
+        == {"results": [{"user": "c", "error": "unknown user"}]}
+
+
+def test_models_are_bounded_and_locked_per_user() -> None:
+    service = RecommendService(lambda: load("v1"), lambda: "v1", {},
+                               max_models=2)
+    for user in ["a", "b", "c", "d"]:
+        service.handle({"requests": [request(user, 1, ["N1"])]})
+    assert list(service.models) == ["c", "d"]
+    # 学習中のユーザーがいても、他のユーザーには答える
+    with service.user_model("c").lock:
+        result = service.recommend("e", 1, make_corpus()[["ncode"]]
+                                   .assign(point=2).iloc[:1])
+    assert result["recommendations"][0]["ncode"] == "N3"
+    assert len(service.models) == 2
+
+
+@pytest.mark.parametrize("body", [
+    {"requests": [{"k": 1}]},
+    {"requests": [{"user": "a", "k": 0}]},
+    {"requests": [{"user": "a", "bookmarks": [{"ncode": "N1"}]}]},
+    {"requests": [{"user": "a", "bookmarks": [{"ncode": "N1",
+                                               "point": "2"}]}]},
+    {"user": "a"},
+])
+def test_invalid_request(body: dict) -> None:
+    service = RecommendService(lambda: load("v1"), lambda: "v1", {})
+    with pytest.raises(RequestError):
+        service.handle(body)
+    assert len(service.cache) == 0
+
+
+def test_server() -> None:
+    service = RecommendService(lambda: load("v1"), lambda: "v1", {})
+    server = ServiceServer(service)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        body = json.dumps({"requests": [request("a", 1, ["N1"])]})
+        with urllib.request.urlopen(urllib.request.Request(
+                server.url + "recommend", data=body.encode("utf-8"),
+                headers={"Content-Type": "application/json"})) as response:
+            result = json.load(response)
+        assert result["results"][0]["recommendations"][0]["ncode"] == "N3"
+        with urllib.request.urlopen(server.url + "status") as response:
+            assert json.load(response)["version"] == "v1"
+        # 形が正しくない要求には、400と理由を返す
+        body = json.dumps({"requests": [{"k": 1}]})
+        with pytest.raises(urllib.error.HTTPError) as error:
+            urllib.request.urlopen(urllib.request.Request(
+                server.url + "recommend", data=body.encode("utf-8")))
+        assert error.value.code == 400
+        assert "user" in json.load(error.value)["error"]
+    finally:
+        server.shutdown()
+        server.server_close()
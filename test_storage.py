@@ -0,0 +1,129 @@
+import pathlib
+import sqlite3
+import pandas
+import pytest
+import storage
+
+
+@pytest.fixture(params=["csv", "sqlite", "parquet"])
+def cache(request, tmp_path: pathlib.Path) -> storage.Storage:
+    if request.param == "parquet":
+        pytest.importorskip("pyarrow")
+    return storage.open_storage(request.param, str(tmp_path))
+
+
+def make_df(ncodes: list) -> pandas.DataFrame:
+    return pandas.DataFrame({"ncode": ncodes,
+                             "length": [100 * (i + 1)
+                                        for i in range(len(ncodes))]})
+
+
+def test_write_replaces_partition(cache: storage.Storage) -> None:
+    with cache.writer("101_0-10_1_t") as writer:
+        writer.write(make_df(["N1", "N2"]))
+        writer.write(make_df(["N3"]))
+    assert cache.count("101_0-10_1_t") == 3
+    with cache.writer("101_0-10_1_t") as writer:
+        writer.write(make_df(["N4"]))
+    assert cache.count("101_0-10_1_t") == 1
+    assert cache.keys() == ["101_0-10_1_t"]
+
+
+def test_abort_keeps_old_cache(cache: storage.Storage) -> None:
+    with cache.writer("101_0-10_1_t") as writer:
+        writer.write(make_df(["N1"]))
+    with pytest.raises(RuntimeError):
+        with cache.writer("101_0-10_1_t") as writer:
+            writer.write(make_df(["N2", "N3"]))
+            raise RuntimeError
+    assert list(cache.read()["ncode"]) == ["N1"]
+
+
+def test_read_projection(cache: storage.Storage) -> None:
+    with cache.writer("101_0-10_1_t") as writer:
+        writer.write(make_df(["N1"]))
+    with cache.writer("102_0-10_1_t") as writer:
+        writer.write(make_df(["N2", "N3"]))
+    df = cache.read(["102_0-10_1_t"], columns=["ncode"])
+    assert list(df.columns) == ["ncode"]
+    assert sorted(df["ncode"]) == ["N2", "N3"]
+    assert cache.count("missing") == 0
+
+
+def test_migrate_headerless_csv(tmp_path: pathlib.Path) -> None:
+    row = ["x"] * len(storage.api_columns)
+    row[storage.api_columns.index("ncode")] = "N1"
+    tmp_path.joinpath("101_0-10_1_t.csv").write_text(
+        ",".join(row) + "\n", encoding="utf-8")
+    src = storage.open_storage("csv", str(tmp_path))
+    dst = storage.open_storage("sqlite", str(tmp_path))
+    assert storage.migrate(src, dst) == 1
+    assert list(dst.read(columns=["ncode"])["ncode"]) == ["N1"]
+
+
+def test_upsert_by_ncode(cache: storage.Storage) -> None:
+    with cache.writer("101_0-10_1_t") as writer:
+        writer.write(make_df(["N1", "N2"]))
+    upserter = cache.upserter("101_0-10_1_t")
+    with upserter:
+        upserter.write(pandas.DataFrame({"ncode": ["N2", "N3"],
+                                         "length": [999, 5]}))
+    assert upserter.count == 3
+    df = cache.read(["101_0-10_1_t"]).set_index("ncode")
+    assert df.loc["N1", "length"] == 100
+    assert df.loc["N2", "length"] == 999
+    assert df.loc["N3", "length"] == 5
+
+
+def test_update_columns_keeps_other_columns(cache: storage.Storage) -> None:
+    df = make_df(["N1", "N2", "N3"])
+    df["story"] = ["a", None, None]
+    with cache.writer("101_0-10_1_t") as writer:
+        writer.write(df)
+    n = cache.update_columns("101_0-10_1_t", pandas.DataFrame(
+        {"ncode": ["N2", "N9"], "story": ["b", "z"]}))
+    assert n == 1
+    df = cache.read().set_index("ncode")
+    assert list(df["length"]) == [100, 200, 300]
+    assert df.loc["N1", "story"] == "a" and df.loc["N2", "story"] == "b"
+    assert pandas.isna(df.loc["N3", "story"]) and "N9" not in df.index
+
+
+def test_read_parallel(cache: storage.Storage) -> None:
+    for i in range(6):
+        with cache.writer("10{0}_0-10_1_t".format(i)) as writer:
+            writer.write(make_df(["N{0}{1}".format(i, j) for j in range(3)]))
+    serial = storage.read_parallel(cache, processes=1)
+    parallel = storage.read_parallel(cache, processes=3)
+    assert len(parallel) == 18
+    assert list(parallel.index) == list(range(18))
+    assert sorted(parallel["ncode"]) == sorted(serial["ncode"])
+    df = storage.read_parallel(cache, ["101_0-10_1_t", "missing"], ["ncode"],
+                               processes=2)
+    assert list(df["ncode"]) == ["N10", "N11", "N12"]
+
+
+def test_sqlite_reads_many_keys(tmp_path: pathlib.Path,
+                                monkeypatch: pytest.MonkeyPatch) -> None:
+    cache = storage.SqliteStorage(str(tmp_path.joinpath("narou.sqlite3")))
+    connect = cache.connect
+    if not hasattr(sqlite3.Connection, "setlimit"):
+        pytest.skip("Connection.setlimit needs Python 3.11")
+
+    def limited() -> sqlite3.Connection:
+        # SQLite 3.32より前の、プレースホルダーの上限にする
+        con = connect()
+        con.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+        return con
+
+    monkeypatch.setattr(cache, "connect", limited)
+    keys = ["101_{0}_1_t".format(i) for i in range(1200)]
+    for key in keys[:3] + keys[-2:]:
+        with cache.writer(key) as writer:
+            writer.write(make_df([key]))
+    assert sorted(cache.read(keys, ["ncode"])["ncode"]) \
+        == sorted(keys[:3] + keys[-2:])
+    df = cache.read_with_keys(keys, ["ncode"])
+    assert list(df["ncode"]) == list(df[storage.key_column])
+    assert len(df) == 5
+    assert len(cache.read([], ["ncode"])) == 0